@@ -0,0 +1,90 @@
+"""
+The command line shared by the benchmark scripts.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-09 16:40
+ Last modified: 2016-04-09 16:40
+
+   DESCRIPTION: Every benchmark runs, writes its results as JSON, and can
+                compare them to a stored baseline, exiting with 1 on a
+                regression. The scripts only differ in what they measure
+                and how they compare, so they add their own options to
+                get_parser() and pass their run and compare functions to
+                finish().
+
+         USAGE: parser = get_parser(__doc__, THRESHOLD)
+                parser.add_argument('--sizes', ...)
+                args = parser.parse_args(argv)
+                return finish(args, lambda: run_benchmarks(args.sizes),
+                              compare)
+
+============================================================================
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+
+def metadata():
+    """Return details of the machine and software."""
+    return {'time': time.time(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.machine(),
+            'cpus': os.cpu_count()}
+
+
+def get_parser(description, threshold):
+    """Return a parser with the output and baseline options.
+
+    :description: The module docstring of the script.
+    :threshold:   Default slowdown ratio counted as a regression.
+    """
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help='Write results JSON here')
+    parser.add_argument('-b', '--baseline',
+                        help='Compare to results JSON from an earlier run')
+    parser.add_argument('-c', '--compare',
+                        help='Compare this results JSON instead of running')
+    parser.add_argument('--threshold', type=float, default=threshold,
+                        help='Slowdown ratio counted as a regression')
+    return parser
+
+
+def finish(args, run, compare):
+    """Run or load the results, write them, and compare to a baseline.
+
+    :args:    The parsed arguments, see get_parser().
+    :run:     A function that runs the benchmarks and returns the results.
+    :compare: A function of (results, baseline, threshold) that returns
+              (report string, list of regressions).
+    :returns: The exit code, 1 if there are regressions.
+    """
+    if args.compare:
+        with open(args.compare) as fin:
+            results = json.load(fin)
+    else:
+        results = run()
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+    elif not args.compare:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        report, regressions = compare(results, baseline, args.threshold)
+        sys.stderr.write(report + '\n')
+        if regressions:
+            sys.stderr.write('{} regressions\n'.format(len(regressions)))
+            return 1
+    return 0
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Measure how long it takes to import pipeline and to check a pipeline status.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-09 14:30
+ Last modified: 2016-04-09 14:30
+
+   DESCRIPTION: Every measurement is made in a fresh interpreter, --repeat
+                times, and the fastest and median times are kept. Imports
+                are timed inside the interpreter, so interpreter startup is
+                not counted, the status command is timed from outside, so
+                it is.
+
+                Also records which of the heavy modules (multiprocessing,
+                subprocess, pickle, logging, and the profilers) each import
+                pulls in. `import pipeline` and `import pipeline.status`
+                should pull in none of them.
+
+                Results are written as JSON. With --baseline, the median
+                times are compared to a stored run, and the script exits
+                with 1 if any is slower than --threshold times the
+                baseline, or if an import pulls in a heavy module it did
+                not before.
+
+         USAGE: python benchmarks/bench_import.py -o new.json
+                python benchmarks/bench_import.py -o new.json \\
+                    --baseline benchmarks/import_baseline.json
+
+============================================================================
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+from time import perf_counter
+from _common import metadata, get_parser, finish
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+############################
+#  Customizable constants  #
+############################
+
+REPEAT    = 20
+THRESHOLD = 1.5    # Slowdown relative to baseline counted as a regression
+MIN_MS    = 2.0    # Ignore slowdowns smaller than this, they are noise
+STEPS     = 1000   # Steps in the pipeline the status command reads
+IMPORTS   = (('import', 'import pipeline'),
+             ('import_status', 'import pipeline.status'),
+             ('import_pipeline_class', 'from pipeline import Pipeline'))
+HEAVY     = ('multiprocessing', 'subprocess', 'pickle', 'logging', 'pstats',
+             'cProfile', 'tracemalloc', 'pipeline.pl')
+
+CHILD = """
+import sys, json
+from time import perf_counter
+start = perf_counter()
+{}
+seconds = perf_counter() - start
+print(json.dumps([seconds, [i for i in {!r} if i in sys.modules]]))
+"""
+
+
+###############################################################################
+#                                 Benchmarks                                  #
+###############################################################################
+
+
+def run_benchmarks(repeat=REPEAT):
+    """Time every import and the status command.
+
+    :returns: A dictionary of metadata and {name: result}.
+    """
+    results = {}
+    env = dict(os.environ, PYTHONPATH=HERE)
+    for name, statement in IMPORTS:
+        times = []
+        for _ in range(repeat):
+            out = subprocess.check_output(
+                [sys.executable, '-c', CHILD.format(statement, HEAVY)],
+                env=env, universal_newlines=True)
+            seconds, heavy = json.loads(out)
+            times.append(seconds)
+        results[name] = summarize(times, statement=statement, heavy=heavy)
+        report(name, results[name])
+
+    work = tempfile.mkdtemp(prefix='pipeline_bench_')
+    try:
+        state = make_pipeline(os.path.join(work, 'bench.pickle'), env)
+        command = [sys.executable, '-m', 'pipeline', 'status', state]
+        times = []
+        for _ in range(repeat):
+            start = perf_counter()
+            subprocess.check_call(command, env=env,
+                                  stdout=subprocess.DEVNULL)
+            times.append(perf_counter() - start)
+        results['status_command'] = summarize(times, steps=STEPS)
+        report('status_command', results['status_command'])
+    finally:
+        shutil.rmtree(work)
+    return {'meta': metadata(), 'results': results}
+
+
+def make_pipeline(path, env):
+    """Make a pipeline of STEPS steps at path, in a child process."""
+    subprocess.check_call([sys.executable, '-c', (
+        'import pipeline as pl\n'
+        'pip = pl.get_pipeline({!r})\n'
+        'pip.enable_status()\n'
+        'pip.add_many([{{"command": "true", "name": "step{{}}".format(i)}}\n'
+        '              for i in range({})])\n').format(path, STEPS)], env=env)
+    return path
+
+
+def summarize(times, **extra):
+    """Return the fastest and median times in milliseconds."""
+    times  = sorted(times)
+    result = {'min_ms': times[0] * 1000,
+              'median_ms': times[len(times) // 2] * 1000,
+              'repeat': len(times)}
+    result.update(extra)
+    return result
+
+
+def report(name, result):
+    """Write a single result to STDERR."""
+    sys.stderr.write('{:<24} {:>8.2f}ms median {:>8.2f}ms min{}\n'.format(
+        name, result['median_ms'], result['min_ms'],
+        '  loads ' + ', '.join(result['heavy']) if result.get('heavy')
+        else ''))
+
+
+###############################################################################
+#                                 Comparison                                  #
+###############################################################################
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Compare median times and heavy modules to a baseline.
+
+    :returns: (report string, list of (name, reason) regressions)
+    """
+    row   = '{:<24} {:>10.2f} {:>10.2f} {:>8.2f}{}'
+    lines = ['{:<24} {:>10} {:>10} {:>8}'.format(
+        'Measurement', 'Baseline', 'Current', 'Ratio')]
+    regressions = []
+    for name, now in sorted(results['results'].items()):
+        then = baseline['results'].get(name)
+        if not then:
+            continue
+        ratio = now['median_ms'] / then['median_ms'] if \
+            then['median_ms'] else 1.0
+        slow  = (ratio > threshold and
+                 now['median_ms'] - then['median_ms'] > MIN_MS)
+        if slow:
+            regressions.append((name, 'slower'))
+        new = sorted(set(now.get('heavy', ())) - set(then.get('heavy', ())))
+        if new:
+            regressions.append((name, 'loads ' + ', '.join(new)))
+        lines.append(row.format(
+            name, then['median_ms'], now['median_ms'], ratio,
+            (' REGRESSION' if slow else '') +
+            (' NOW LOADS ' + ', '.join(new) if new else '')))
+    return '\n'.join(lines), regressions
+
+
+###############################################################################
+#                               Run as a script                               #
+###############################################################################
+
+
+def main(argv=None):
+    """Run the benchmarks and/or compare to a baseline."""
+    parser = get_parser(__doc__, THRESHOLD)
+    parser.add_argument('-r', '--repeat', type=int, default=REPEAT,
+                        help='Fresh interpreters per measurement')
+    args = parser.parse_args(argv)
+    return finish(args, lambda: run_benchmarks(args.repeat), compare)
+
+if __name__ == '__main__':
+    sys.exit(main())
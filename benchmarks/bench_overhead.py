@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Measure the framework overhead of pipeline at scale.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-07 14:10
+ Last modified: 2016-04-07 14:10
+
+   DESCRIPTION: Builds synthetic pipelines of no-op Commands and Functions
+                with 10, 1k, 10k, and 100k steps (and a single step with the
+                same number of substeps) and times the framework around
+                them: add, save, get_pipeline, build_file_list,
+                _create_substeps, run_all, Step.run_parallel, print_stats,
+                and the size of the pickle.
+
+                Operations that would take longer than --budget seconds,
+                going by the time per item at the previous size, are
+                skipped and recorded with their estimate. add is stopped
+                when it runs over the budget, and the rest of the steps are
+                added without saving, so the big sizes still get measured.
+
+                Results are written as JSON. With --baseline, every
+                operation is compared to a stored run by time per item, and
+                the script exits with 1 if any is slower than --threshold
+                times the baseline.
+
+         USAGE: python benchmarks/bench_overhead.py -o new.json
+                python benchmarks/bench_overhead.py -o new.json \\
+                    --baseline benchmarks/baseline.json
+                python benchmarks/bench_overhead.py --compare new.json \\
+                    --baseline benchmarks/baseline.json
+
+============================================================================
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import pipeline as pl  # noqa: E402
+from pipeline.pl import build_file_list  # noqa: E402
+from _common import metadata, get_parser, finish  # noqa: E402
+
+############################
+#  Customizable constants  #
+############################
+
+SIZES       = (10, 1000, 10000, 100000)
+BUDGET      = 60.0  # Seconds allowed for a single operation
+THRESHOLD   = 1.5   # Slowdown relative to baseline counted as a regression
+MIN_SECONDS = 0.05  # Ignore operations faster than this, they are noise
+THREADS     = 2     # Pool size for run_parallel
+
+
+def noop(*args):
+    """The no-op function step."""
+    return 0
+
+
+###############################################################################
+#                                 Benchmarks                                  #
+###############################################################################
+
+
+def run_benchmarks(sizes=SIZES, budget=BUDGET, threads=THREADS):
+    """Run every benchmark at every size.
+
+    :returns: A dictionary of metadata and {size: {operation: result}}.
+    """
+    results = {}
+    rates   = {}  # Seconds per item of each operation at the last size
+    for size in sizes:
+        sys.stderr.write('Benchmarking {} steps\n'.format(size))
+        work = tempfile.mkdtemp(prefix='pipeline_bench_')
+        here = os.getcwd()
+        os.chdir(work)
+        try:
+            results[str(size)] = bench_size(size, budget, threads, rates)
+        finally:
+            os.chdir(here)
+            shutil.rmtree(work)
+    return {'meta': metadata(), 'results': results}
+
+
+def bench_size(size, budget, threads, rates):
+    """Run every benchmark with size steps in the current directory."""
+    result = {}
+
+    def run(name, function, items=size):
+        """Time function unless the estimate is over budget."""
+        estimate = rates.get(name, 0) * items
+        if estimate > budget:
+            result[name] = {'skipped': True, 'estimate': estimate,
+                            'items': items}
+            sys.stderr.write('    {:<16} skipped, about {:.0f}s\n'.format(
+                name, estimate))
+            return None
+        start = time.time()
+        out   = function()
+        record(name, time.time() - start, items)
+        return out
+
+    def record(name, seconds, items, **extra):
+        """Store the result and the rate for the next size."""
+        result[name] = {'seconds': seconds, 'items': items,
+                        'per_item': seconds / items}
+        result[name].update(extra)
+        rates[name] = seconds / items
+        sys.stderr.write('    {:<16} {:.4f}s\n'.format(name, seconds))
+
+    # Adding steps, stopped at the budget
+    pip   = pl.get_pipeline('bench.pickle')
+    start = time.time()
+    added = 0
+    while added < size and time.time() - start < budget:
+        add_step(pip, added)
+        added += 1
+    record('add', time.time() - start, added, truncated=added < size)
+    pip.save = lambda: None  # Add the rest without saving every time
+    while added < size:
+        add_step(pip, added)
+        added += 1
+    del pip.save
+
+    run('save', pip.save, 1)
+    result['pickle_bytes'] = os.path.getsize('bench.pickle')
+    run('get_pipeline', lambda: pl.get_pipeline('bench.pickle'), 1)
+    with open(os.devnull, 'w') as devnull:
+        run('print_stats', lambda: pip.print_stats(devnull, False))
+    run('run_all', pip.run_all)
+
+    # Substeps of a single step
+    os.mkdir('files')
+    for i in range(size):
+        open(os.path.join('files', 'file{}'.format(i)), 'w').close()
+    files = run('build_file_list',
+                lambda: build_file_list(r'file[0-9]+', 'files'))
+    if files is None:
+        files = [os.path.join('files', i) for i in os.listdir('files')]
+    subs = pl.get_pipeline('subs.pickle')
+    subs.add(noop, '<StepFile>', name='substeps', file_list=files)
+    step = subs['substeps']
+    step.steps = None
+    run('create_substeps', step._create_substeps)
+    if not step.steps:
+        step._create_substeps()
+    subs.save()
+    result['substep_pickle_bytes'] = os.path.getsize('subs.pickle')
+    run('run_parallel', lambda: step.run_parallel(threads=threads))
+    return result
+
+
+def add_step(pip, number):
+    """Add a no-op Command or Function step, alternating."""
+    if number % 2:
+        pip.add('true', name='step{}'.format(number))
+    else:
+        pip.add(noop, number, name='step{}'.format(number))
+
+
+###############################################################################
+#                                 Comparison                                  #
+###############################################################################
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Compare two result dictionaries by time per item and pickle size.
+
+    :returns: (report string, list of (size, operation, ratio) regressions)
+    """
+    row   = '{:>8} {:<20} {:>12} {:>12} {:>8.2f}{}'
+    lines = ['{:>8} {:<20} {:>12} {:>12} {:>8}'.format(
+        'Size', 'Operation', 'Baseline', 'Current', 'Ratio')]
+    regressions = []
+    for size, current in sorted(results['results'].items(),
+                                key=lambda i: int(i[0])):
+        old = baseline['results'].get(size, {})
+        for name, now in sorted(current.items()):
+            then = old.get(name)
+            if isinstance(now, dict) and isinstance(then, dict):
+                if now.get('skipped') or then.get('skipped'):
+                    continue
+                ratio = now['per_item'] / then['per_item'] if \
+                    then['per_item'] else 1.0
+                slow  = ratio > threshold and now['seconds'] > MIN_SECONDS
+                shown = ('{:.4f}s'.format(then['seconds']),
+                         '{:.4f}s'.format(now['seconds']))
+            elif isinstance(now, int) and isinstance(then, int) and then:
+                ratio = now / float(then)
+                slow  = ratio > threshold
+                shown = (then, now)
+            else:
+                continue
+            if slow:
+                regressions.append((size, name, ratio))
+            lines.append(row.format(size, name, shown[0], shown[1], ratio,
+                                    ' REGRESSION' if slow else ''))
+    return '\n'.join(lines), regressions
+
+
+###############################################################################
+#                               Run as a script                               #
+###############################################################################
+
+
+def main(argv=None):
+    """Run the benchmarks and/or compare to a baseline."""
+    parser = get_parser(__doc__, THRESHOLD)
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=list(SIZES), help='Numbers of steps')
+    parser.add_argument('--budget', type=float, default=BUDGET,
+                        help='Seconds allowed for one operation')
+    parser.add_argument('--threads', type=int, default=THREADS,
+                        help='Pool size for run_parallel')
+    args = parser.parse_args(argv)
+    return finish(args, lambda: run_benchmarks(args.sizes, args.budget,
+                                               args.threads), compare)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -34,20 +34,43 @@ Easily manage a complex pipeline with python.
                 pipeline.run_all()
                 pipeline['my_fun'].out  # Will return 3
 
-          TODO: Implement parallel running
-
 ============================================================================
 """
 
-# Allow top-level import
-from .pl import Pipeline
-from .pl import Step
-from .pl import Command
-from .pl import Function
-from .pl import get_pipeline
-from .pl import run_cmd
-from .pl import run_function
-from . import tests
-
-__all__ = ["Pipeline", "Step","Command", "Function", "get_pipeline", "pl",
-           "tests"]
+import sys
+
+# Allow top-level import, the modules are only loaded when first used, so
+# `import pipeline` and `python -m pipeline status` stay fast. Nothing is
+# imported for the side effects.
+_LAZY = {'Pipeline': 'pl', 'Step': 'pl', 'Command': 'pl', 'Function': 'pl',
+         'get_pipeline': 'pl', 'run_cmd': 'pl', 'run_function': 'pl',
+         'Retry': 'scheduler'}
+_MODULES = ('pl', 'tests', 'logme', 'status', 'report', 'trace', 'events',
+            'metrics', 'history', 'overhead', 'registry', 'scheduler')
+
+__all__ = ["Pipeline", "Step", "Command", "Function", "Retry", "get_pipeline",
+           "pl", "tests"]
+
+
+def __getattr__(name):
+    """Import the module holding name the first time it is used."""
+    from importlib import import_module
+    if name in _LAZY:
+        value = getattr(import_module('.' + _LAZY[name], __name__), name)
+    elif name in _MODULES:
+        value = import_module('.' + name, __name__)
+    else:
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name))
+    globals()[name] = value  # Only look it up once
+    return value
+
+
+def __dir__():
+    """Include the lazy names."""
+    return sorted(set(globals()) | set(_LAZY) | set(_MODULES))
+
+if sys.version_info < (3, 7):
+    # No module __getattr__, import everything now
+    for _name in list(_LAZY) + list(_MODULES):
+        __getattr__(_name)
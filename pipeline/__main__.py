@@ -0,0 +1,46 @@
+"""
+Command line tools for pipelines, run with python -m pipeline.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-09 10:15
+ Last modified: 2016-04-09 10:15
+
+   DESCRIPTION: status: Print the step counts, current step, failures, and
+                        ETA of a pipeline from its status summary, without
+                        loading the pipeline, see status.py.
+
+         USAGE: python -m pipeline status project.pickle
+                python -m pipeline status --json project.pickle
+
+============================================================================
+"""
+import sys
+import argparse
+
+from . import status
+
+
+def main(argv=None):
+    """Parse the command line and run the command."""
+    parser = argparse.ArgumentParser(
+        prog='python -m pipeline', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    stat = commands.add_parser('status', help='Show the state of a pipeline')
+    stat.add_argument('statefile',
+                      help='The pipeline pickle or its .status.json')
+    stat.add_argument('--json', action='store_true',
+                      help='Print the summary as JSON')
+    args = parser.parse_args(argv)
+
+    if args.command == 'status':
+        return status.main(args.statefile, args.json)
+    parser.print_help()
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
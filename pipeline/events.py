@@ -0,0 +1,132 @@
+"""
+Machine readable event stream of pipeline step lifecycles.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-05 14:20
+ Last modified: 2016-04-05 14:20
+
+   DESCRIPTION: Writes one JSON object per line (JSONL) for every step
+                event, so that tools can follow a pipeline without parsing
+                the log or loading the pickle. The file is only ever
+                appended to, when it grows past max_bytes it is rotated to
+                <file>.1 (gzipped if compress is True), <file>.1 to <file>.2,
+                and so on, keeping backups old files.
+
+                Events written by the Pipeline:
+                    added:    A step was added to the pipeline
+                    queued:   A substep was sent to the pool
+                    started:  A step or substep started running in this
+                              process
+                    finished: A step or substep completed successfully
+                    failed:   A step or substep failed
+                    skipped:  A step or substep was not run because it was
+                              already done, reason is 'donetest' if the
+                              donetest passed
+                    retry:    A step or substep failed and will run again
+                              after delay seconds, attempt is the run to come
+                    saved:    The pipeline was saved to its pickle file
+                    pool:     A step started (workers is the pool size) or
+                              stopped (workers is 0) its process pool
+
+                Every event has time, event, pipeline, step, and file (the
+                substep file, null for steps). Run events also have
+                start_time, end_time, duration, and code when known.
+                Substeps run in parallel have no started event, their
+                finished or failed event includes the start_time recorded
+                in the worker.
+
+         USAGE: project.enable_events()
+                project.run_all()
+                # Read pipeline_state.pickle.events.jsonl
+
+============================================================================
+"""
+import os
+import json
+import time
+import shutil
+
+__all__ = ['EventLog']
+
+############################
+#  Customizable constants  #
+############################
+
+MAX_BYTES = 104857600  # Rotate the event file at 100MB
+BACKUPS   = 5          # Rotated files to keep
+
+
+class EventLog(object):
+
+    """An append-only JSONL file of events with size based rotation."""
+
+    def __init__(self, path, max_bytes=MAX_BYTES, backups=BACKUPS,
+                 compress=True):
+        """Set the file to write, it is opened on the first event.
+
+        :path:      The file to write events to.
+        :max_bytes: Rotate the file when it is larger than this, None to
+                    never rotate.
+        :backups:   Number of rotated files to keep.
+        :compress:  gzip rotated files.
+        """
+        self.path      = os.path.abspath(str(path))
+        self.max_bytes = max_bytes
+        self.backups   = int(backups)
+        self.compress  = compress
+        self.handle    = None
+
+    def emit(self, event, **fields):
+        """Append a single event, fields must be JSON serializable.
+
+        Values that are not serializable are written as strings.
+        """
+        record = {'time': time.time(), 'event': event}
+        record.update(fields)
+        if not self.handle or self.handle.closed:
+            self.handle = open(self.path, 'a')
+        self.handle.write(json.dumps(record, default=str) + '\n')
+        self.handle.flush()
+        if self.max_bytes and self.handle.tell() > self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        """Move the current file to <path>.1, shifting older files up."""
+        self.close()
+        suffix = '.gz' if self.compress else ''
+        for i in range(self.backups - 1, 0, -1):
+            old = '{}.{}{}'.format(self.path, i, suffix)
+            if os.path.exists(old):
+                os.replace(old, '{}.{}{}'.format(self.path, i + 1, suffix))
+        if not os.path.exists(self.path):
+            return
+        if not self.backups:
+            os.remove(self.path)
+        elif self.compress:
+            import gzip
+            with open(self.path, 'rb') as fin:
+                with gzip.open(self.path + '.1.gz', 'wb') as fout:
+                    shutil.copyfileobj(fin, fout)
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.path + '.1')
+
+    def close(self):
+        """Close the file, it is reopened on the next event."""
+        if self.handle:
+            self.handle.close()
+        self.handle = None
+
+    def __getstate__(self):
+        """Do not pickle the open file."""
+        state = self.__dict__.copy()
+        state['handle'] = None
+        return state
+
+    def __repr__(self):
+        """Show the path."""
+        return '<EventLog(path={})>'.format(self.path)
@@ -0,0 +1,173 @@
+"""
+Persistent history of step runtimes, used to predict durations and ETAs.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-07 09:30
+ Last modified: 2016-04-07 09:30
+
+   DESCRIPTION: Every completed step or substep run is appended as one JSON
+                line to runtimes.jsonl in a cache directory, with the step
+                name, the input file and its size, and the runtime. The file
+                is only ever appended to, so several pipelines can share one
+                cache directory, each reads the lines the others added since
+                it last looked.
+
+                Runtimes are predicted per step name with a least squares
+                fit of runtime against input bytes. Steps that only ever ran
+                on one size of input (or on no input at all) are predicted
+                as the mean of their runs. Failed runs are recorded but not
+                used for predictions.
+
+         USAGE: project.enable_history()
+                project.run_all()
+                project['my_step'].predict_runtime()
+                project.get_eta()
+
+============================================================================
+"""
+import os
+import json
+import time
+from collections import deque
+
+__all__ = ['History']
+
+############################
+#  Customizable constants  #
+############################
+
+HISTORY_FILE = 'runtimes.jsonl'
+MAX_SAMPLES  = 1000  # Most recent runs per step used for predictions
+
+
+class History(object):
+
+    """A shared, append-only runtime database with a per step model."""
+
+    def __init__(self, cache_dir):
+        """Set the cache directory, it is created on the first record.
+
+        :cache_dir: Directory to hold runtimes.jsonl.
+        """
+        self.cache_dir = os.path.abspath(str(cache_dir))
+        self.path      = os.path.join(self.cache_dir, HISTORY_FILE)
+        self.handle    = None
+        self.offset    = 0   # Bytes of path already read
+        self.samples   = {}  # step: deque of (bytes, seconds)
+        self.models    = {}  # step: (intercept, slope)
+
+    def record(self, step, seconds, size=0, file=None, failed=False,
+               pipeline=None):
+        """Append a single run to the history.
+
+        :step:     The step name, substeps use the name of their parent.
+        :seconds:  Runtime of the step or substep.
+        :size:     Total bytes of input.
+        :file:     The substep file, if any.
+        :failed:   Failed runs are kept but not used for predictions.
+        :pipeline: The pipeline file, recorded for reference.
+        """
+        record = {'time': time.time(), 'step': step, 'file': file,
+                  'bytes': size, 'seconds': seconds, 'failed': failed,
+                  'pipeline': pipeline}
+        if not self.handle or self.handle.closed:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self.handle = open(self.path, 'a')
+        self.handle.write(json.dumps(record, default=str) + '\n')
+        self.handle.flush()
+        self.refresh()
+
+    def refresh(self):
+        """Read any runs appended since the last refresh."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size < self.offset:
+            # The file was replaced, start again
+            self.offset  = 0
+            self.samples = {}
+            self.models  = {}
+        if size == self.offset:
+            return
+        with open(self.path, 'rb') as fin:
+            fin.seek(self.offset)
+            data = fin.read(size - self.offset)
+        end = data.rfind(b'\n') + 1  # Leave a partly written line
+        self.offset += end
+        for line in data[:end].splitlines():
+            try:
+                self._add(json.loads(line.decode('utf8')))
+            except (ValueError, KeyError, TypeError):
+                continue
+
+    def predict(self, step, size=0):
+        """Return the expected runtime in seconds, None if never run.
+
+        :step: The step name, substeps use the name of their parent.
+        :size: Total bytes of input.
+        """
+        if step not in self.models:
+            if step not in self.samples:
+                return None
+            self.models[step] = fit(self.samples[step])
+        intercept, slope = self.models[step]
+        return max(intercept + slope * size, 0.0)
+
+    def close(self):
+        """Close the file, it is reopened on the next record."""
+        if self.handle:
+            self.handle.close()
+        self.handle = None
+
+    ###############
+    #  Internals  #
+    ###############
+
+    def _add(self, record):
+        """Add a single history record to the samples."""
+        if record.get('failed') or record['seconds'] is None:
+            return
+        step = record['step']
+        if step not in self.samples:
+            self.samples[step] = deque(maxlen=MAX_SAMPLES)
+        self.samples[step].append((record.get('bytes') or 0,
+                                   float(record['seconds'])))
+        self.models.pop(step, None)
+
+    def __getstate__(self):
+        """Only pickle the location, the history is read again on load."""
+        state = self.__dict__.copy()
+        state['handle']  = None
+        state['offset']  = 0
+        state['samples'] = {}
+        state['models']  = {}
+        return state
+
+    def __repr__(self):
+        """Show the path."""
+        return '<History(path={})>'.format(self.path)
+
+
+def fit(samples):
+    """Least squares fit of seconds against bytes.
+
+    :samples: A list of (bytes, seconds) tuples.
+    :returns: (intercept, slope), slope is 0 if there is only one input
+              size or if runtime falls with size.
+    """
+    count  = len(samples)
+    mean_x = sum(i[0] for i in samples) / float(count)
+    mean_y = sum(i[1] for i in samples) / float(count)
+    var_x  = sum((i[0] - mean_x) ** 2 for i in samples)
+    if not var_x:
+        return mean_y, 0.0
+    slope = sum((i[0] - mean_x) * (i[1] - mean_y) for i in samples) / var_x
+    if slope <= 0:
+        return mean_y, 0.0
+    return mean_y - slope * mean_x, slope
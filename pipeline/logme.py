@@ -33,19 +33,40 @@ Logging with timestamps and optional log files.
                 lm.log('Hi', level='debug')
                    Prints: 20160223 11:46:24.969 | DEBUG --> Hi
 
+   PERFORMANCE: Messages below the minimum level return before any
+                formatting. Plain logfiles are kept open between messages.
+                Calling start_writer() moves all logfile writes in this
+                process to a background thread fed by a queue, which writes
+                in batches. stop_writer() flushes and stops it, it is also
+                called at exit. Call close() after moving or deleting a
+                logfile, otherwise the handle is only replaced on the next
+                check, up to HANDLE_CHECK seconds later.
+
+                Pool workers should not write to the same logfile
+                themselves: create the pool with
+                initializer=logme.forward_to and initargs=(aggregator.queue,)
+                for a running Aggregator, and all logfile messages from the
+                workers are written by a single thread in the parent.
+
 
           NOTE: Uses terminal colors and STDERR, not compatible with non-unix
                 systems
 
 ===============================================================================
 """
+import os
 import sys
-import gzip
-import bz2
-import logging
+import time
+import atexit
+import threading
 from datetime import datetime as dt
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
 
-__all__ = ['log', 'MIN_LEVEL', 'LOGFILE']
+__all__ = ['log', 'MIN_LEVEL', 'LOGFILE', 'start_writer', 'stop_writer',
+           'flush', 'close', 'forward_to', 'Aggregator']
 
 ###################################
 #  Constants for printing colors  #
@@ -60,6 +81,22 @@ ENDC   = '\033[0m'
 MIN_LEVEL = 'info'
 LOGFILE   = sys.stderr
 
+# Level checking, not used with logging objects
+LEVEL_MAP = {'debug': 1, 'info': 2, 'warn': 3, 'error': 4, 'critical': 5,
+             'd': 1, 'i': 2, 'w': 3, 'e': 4, 'c': 5,
+             0: 1, 1: 2, 2: 3, 3: 4, 4: 5}
+FLAG_MAP  = {1: 'DEBUG', 2: 'INFO', 3: 'WARNING', 4: 'ERROR', 5: 'CRITICAL'}
+
+HANDLE_CHECK = 1.0   # Seconds between checks that a cached logfile still exists
+WRITER_BATCH = 1000  # Maximum messages written by the writer thread at once
+
+# Open handles for plain logfiles, by path, and the background writer
+_HANDLES = {'pid': None, 'files': {}, 'checked': {}}
+_LOCK    = threading.Lock()
+_WRITER  = None
+_FORWARD = {'queue': None, 'pid': None}  # Set in pool workers
+_STAMP   = [None, '']  # Cached (second, formatted time)
+
 
 def log(message, level='info', logfile=None, also_write=None,
         min_level=None, kind=None):
@@ -84,7 +121,6 @@ def log(message, level='info', logfile=None, also_write=None,
     """
     stdout = False
     stderr = False
-    message = str(message)
 
     if not logfile:
         logfile = LOGFILE
@@ -94,31 +130,33 @@ def log(message, level='info', logfile=None, also_write=None,
 
     min_level = min_level if min_level else MIN_LEVEL
 
-    # Level checking, not used with logging objects
-    level_map = {'debug': 1, 'info': 2, 'warn': 3, 'error': 4, 'critical': 5,
-                 'd': 1, 'i': 2, 'w': 3, 'e': 4, 'c': 5,
-                 0: 1, 1: 2, 2: 3, 3: 4, 4: 5}
-
     try:
-        level = level_map[level]
+        level = LEVEL_MAP[level]
     except KeyError:
         raise Exception('Invalid level {}'.format(level))
 
     try:
-        min_level = level_map[min_level]
+        min_level = LEVEL_MAP[min_level]
     except KeyError:
         raise Exception('Invalid min_level {}'.format(min_level))
 
+    is_logger = _is_logger(logfile)
+
+    # Return before doing any formatting if the level is filtered
+    if level < min_level and not is_logger:
+        return
+
+    message = str(message)
+
     if level > 3:
         if also_write != -1 or also_write != 'stdout':
             also_write = 'stderr'
 
     # Attempt to handle all file types
-    if isinstance(logfile, (logging.RootLogger, logging.Logger)):
+    if is_logger:
         _logit(message, logfile, level, color=False, min_level=min_level)
     elif isinstance(logfile, str):
-        with _open_zipped(logfile, 'a') as outfile:
-            _logit(message, outfile, level, color=False, min_level=min_level)
+        _write(logfile, _format(message, level))
     elif str(getattr(logfile, 'name')).strip('<>') == 'stdout':
         _logit(message, logfile, level, color=True, min_level=min_level)
         stdout = True
@@ -126,8 +164,7 @@ def log(message, level='info', logfile=None, also_write=None,
         _logit(message, logfile, level, color=True, min_level=min_level)
         stderr = True
     elif getattr(logfile, 'closed'):
-        with _open_zipped(logfile.name, 'a') as outfile:
-            _logit(message, outfile, level, color=False, min_level=min_level)
+        _write(logfile.name, _format(message, level))
     else:
         _logit(message, logfile, level, color=False, min_level=min_level)
 
@@ -138,11 +175,156 @@ def log(message, level='info', logfile=None, also_write=None,
         _logit(message, sys.stdout, level, color=True, min_level=min_level)
 
 
+def enabled(level, min_level=None):
+    """Return True if a message at level would be written.
+
+    Callers can use this to skip building expensive messages.
+    """
+    min_level = min_level if min_level else MIN_LEVEL
+    try:
+        return LEVEL_MAP[level] >= LEVEL_MAP[min_level]
+    except KeyError:
+        return True  # Let log() raise the error
+
+
 def clear(infile):
     """Truncate a file."""
     open(infile, 'w').close()
 
 
+def start_writer():
+    """Write all logfile messages from this process in a background thread.
+
+    Messages are put on a queue and written in batches by a single thread,
+    so log() returns without waiting on the filesystem. Only affects the
+    process that calls it, child processes keep writing directly.
+    """
+    global _WRITER
+    if _WRITER and _WRITER.pid == os.getpid() and _WRITER.is_alive():
+        return
+    _WRITER = _Writer()
+    _WRITER.start()
+
+
+def stop_writer():
+    """Write all queued messages and stop the background writer."""
+    global _WRITER
+    writer  = _WRITER
+    _WRITER = None
+    if writer and writer.pid == os.getpid() and writer.is_alive():
+        writer.queue.put(None)
+        writer.join()
+
+
+def flush():
+    """Block until all queued messages are written and flush open files."""
+    writer = _WRITER
+    if writer and writer.pid == os.getpid() and writer.is_alive():
+        writer.queue.join()
+    with _LOCK:
+        for handle in _HANDLES['files'].values():
+            handle.flush()
+
+
+def close():
+    """Close all cached logfile handles, e.g. after rotating logfiles."""
+    flush()
+    with _LOCK:
+        for handle in _HANDLES['files'].values():
+            handle.close()
+        _HANDLES['files'].clear()
+        _HANDLES['checked'].clear()
+
+
+def forward_to(queue):
+    """Send all logfile messages from this process to queue.
+
+    Intended as a multiprocessing Pool initializer, with the queue of a
+    running Aggregator in the parent process.
+    """
+    _FORWARD['queue'] = queue
+    _FORWARD['pid']   = os.getpid()
+
+
+atexit.register(stop_writer)
+
+
+###############################################################################
+#                      Aggregate Logs From Child Processes                    #
+###############################################################################
+
+
+class Aggregator(object):
+
+    """Write logfile messages sent by child processes from one thread.
+
+    Workers started with logme.forward_to(aggregator.queue) put messages on
+    the queue instead of opening the logfile themselves. A thread in this
+    process writes them in batches, sorted by the time they were logged, so
+    lines are never interleaved or torn.
+
+    Can be used as a context manager, stop() must be called after the
+    workers have exited to be sure every message is written.
+    """
+
+    def __init__(self):
+        """Create the queue and thread."""
+        from multiprocessing import Queue as ProcessQueue
+        self.queue  = ProcessQueue()
+        self.thread = None
+
+    def start(self):
+        """Start writing messages."""
+        self.thread = threading.Thread(target=self._run,
+                                       name='logme-aggregator')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Write all remaining messages and stop the thread."""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        """Write (logfile, time, line) tuples in batches until None."""
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < WRITER_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [i for i in batch if i is not None]
+            batch.sort(key=lambda i: i[1])  # sort is stable
+            files = {}
+            order = []
+            for logfile, _, line in batch:
+                if logfile not in files:
+                    files[logfile] = []
+                    order.append(logfile)
+                files[logfile].append(line)
+            for logfile in order:
+                try:
+                    _write_lines(logfile, files[logfile])
+                except Exception as e:
+                    sys.stderr.write('logme could not write to {}: {}\n'
+                                     .format(logfile, e))
+
+    def __enter__(self):
+        """Start the thread."""
+        return self.start()
+
+    def __exit__(self, *args):
+        """Stop the thread."""
+        self.stop()
+
+
 ###############################################################################
 #                             A Logging Exception                             #
 ###############################################################################
@@ -169,26 +351,136 @@ class LoggingException(Exception):
 ###############################################################################
 
 
-def _logit(message, output, level, color=False, min_level=None):
-    """Write message to file either with color or not.
-
-    output must be filehandle or logging object.
+class _Writer(threading.Thread):
+
+    """Background thread that writes queued (logfile, line) pairs."""
+
+    def __init__(self):
+        """Create the queue, the thread is a daemon."""
+        super(_Writer, self).__init__(name='logme-writer')
+        self.daemon = True
+        self.queue  = Queue()
+        self.pid    = os.getpid()
+
+    def run(self):
+        """Write messages in batches, grouped by logfile, until None."""
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < WRITER_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            files = {}
+            order = []
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                if item[0] not in files:
+                    files[item[0]] = []
+                    order.append(item[0])
+                files[item[0]].append(item[1])
+            for logfile in order:
+                try:
+                    _write_lines(logfile, files[logfile])
+                except Exception as e:
+                    sys.stderr.write('logme could not write to {}: {}\n'
+                                     .format(logfile, e))
+            for _ in batch:
+                self.queue.task_done()
+
+
+def _write(logfile, line):
+    """Write line to the path logfile, through the writer if running.
+
+    In a worker started with forward_to(), send it to the parent instead.
     """
-    now = dt.now()
-    timestamp = "{0}.{1:<3}".format(now.strftime("%Y%m%d %H:%M:%S"),
-                                    str(int(now.microsecond/1000)))
+    if _FORWARD['queue'] is not None and _FORWARD['pid'] == os.getpid():
+        _FORWARD['queue'].put((logfile, time.time(), line))
+        return
+    writer = _WRITER
+    if writer and writer.pid == os.getpid():
+        writer.queue.put((logfile, line))
+    else:
+        _write_lines(logfile, [line])
 
-    flag_map  = {1: 'DEBUG', 2: 'INFO', 3: 'WARNING', 4: 'ERROR',
-                 5: 'CRITICAL'}
 
-    flag = flag_map[level]
-    flag_len = len('{0} | {1} --> '.format(timestamp, flag)) - 2
+def _write_lines(logfile, lines):
+    """Append lines to the path logfile.
+
+    Plain files are kept open, the handle is reopened if the file is moved
+    or deleted (checked every HANDLE_CHECK seconds). Compressed files are
+    opened and closed for every call, otherwise they would have no trailer.
+    """
+    if logfile.endswith(('.gz', '.bz2')):
+        with _open_zipped(logfile, 'a') as outfile:
+            outfile.write(''.join(lines))
+        return
+    with _LOCK:
+        handles = _HANDLES['files']
+        if _HANDLES['pid'] != os.getpid():
+            # Handles inherited over fork belong to the parent
+            handles.clear()
+            _HANDLES['checked'].clear()
+            _HANDLES['pid'] = os.getpid()
+        handle = handles.get(logfile)
+        now    = time.time()
+        if handle and now - _HANDLES['checked'][logfile] > HANDLE_CHECK:
+            try:
+                stale = (os.stat(logfile).st_ino !=
+                         os.fstat(handle.fileno()).st_ino)
+            except OSError:
+                stale = True
+            if stale:
+                handle.close()
+                handle = None
+            _HANDLES['checked'][logfile] = now
+        if not handle:
+            handle = _open_zipped(logfile, 'a')
+            handles[logfile] = handle
+            _HANDLES['checked'][logfile] = now
+        handle.write(''.join(lines))
+        handle.flush()
+
+
+def _timestamp():
+    """Return the current time as a string, strftime is run once a second."""
+    now    = time.time()
+    second = int(now)
+    if _STAMP[0] != second:
+        _STAMP[1] = dt.fromtimestamp(second).strftime("%Y%m%d %H:%M:%S")
+        _STAMP[0] = second
+    return "{0}.{1:<3}".format(_STAMP[1], str(int((now - second) * 1000)))
+
+
+def _format(message, level, color=False):
+    """Return the formatted log line for message, ending in a newline."""
+    timestamp = _timestamp()
+    flag      = FLAG_MAP[level]
+
+    # Format multiline message
+    if '\n' in message:
+        flag_len = len('{0} | {1} --> '.format(timestamp, flag)) - 2
+        lines    = message.split('\n')
+        message  = lines[0] + '\n' + ''.join(
+            ''.ljust(flag_len, '-') + '> ' + line + '\n'
+            for line in lines[1:])
 
     if color:
         flag = _color(flag)
 
-    if isinstance(output, (logging.RootLogger, logging.Logger)):
-        message = ' {} --> {}'.format(timestamp, message)
+    return '{0} | {1} --> {2}\n'.format(timestamp, flag, message)
+
+
+def _logit(message, output, level, color=False, min_level=None):
+    """Write message to file either with color or not.
+
+    output must be filehandle or logging object.
+    """
+    if _is_logger(output):
+        message = ' {} --> {}'.format(_timestamp(), message)
         if level == 0:
             output.debug(message)
         if level == 1:
@@ -201,19 +493,15 @@ def _logit(message, output, level, color=False, min_level=None):
             output.critical(message)
     else:
         # Check min_level before proceeding
-        if level < min_level:
+        if min_level and level < min_level:
             return
+        output.write(_format(str(message), level, color))
+
 
-        # Format multiline message
-        lines = message.split('\n')
-        if len(lines) != 1:
-            message = lines[0] + '\n'
-            lines = lines[1:]
-            for line in lines:
-                message = message + (''.ljust(flag_len, '-') + '> ' +
-                                     line + '\n')
-        output.write('{0} | {1} --> {2}\n'.format(timestamp, flag,
-                                                  str(message)))
+def _is_logger(output):
+    """True if output is a logging Logger, without importing logging."""
+    logging = sys.modules.get('logging')  # Only loggers need logging
+    return logging is not None and isinstance(output, logging.Logger)
 
 
 def _color(flag):
@@ -235,16 +523,18 @@ def _color(flag):
 def _open_zipped(infile, mode='r'):
     """Return file handle of file regardless of zipped or not.
 
-    Text mode enforced for compatibility with python2
+    Text mode enforced for compatibility with python2, unless 'b' is in mode.
     """
-    mode   = mode[0] + 't'
+    mode   = mode[0] + ('b' if 'b' in mode else 't')
     p2mode = mode
     if hasattr(infile, 'write'):
         return infile
     if isinstance(infile, str):
         if infile.endswith('.gz'):
+            import gzip
             return gzip.open(infile, mode)
         if infile.endswith('.bz2'):
+            import bz2
             if hasattr(bz2, 'open'):
                 return bz2.open(infile, mode)
             else:
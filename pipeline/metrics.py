@@ -0,0 +1,340 @@
+"""
+Prometheus textfile metrics for long running pipelines.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-06 15:40
+ Last modified: 2016-04-06 15:40
+
+   DESCRIPTION: Keeps in memory counters that are updated from the same step
+                events that go to the event stream (see events.py), and
+                rewrites a file in the Prometheus text format every interval
+                seconds from a background thread. The file is written to a
+                temporary file and renamed into place, so the node_exporter
+                textfile collector never sees a partial file.
+
+                The steps are only scanned once, when metrics are enabled,
+                after that every count comes from events.
+
+                Metrics written, all labelled with the pipeline file:
+                    pipeline_steps:                   Steps and substeps by
+                                                      level and state
+                    pipeline_completed_total:         Completed runs by level
+                    pipeline_completed_per_minute:    Completed runs in the
+                                                      last minute by level
+                    pipeline_failures_total:          Failed runs by step
+                    pipeline_step_duration_seconds:   Histogram of run time
+                                                      by step and level
+                    pipeline_pool_workers:            Size of the running pool
+                    pipeline_pool_busy:               Pool workers with a task
+                    pipeline_pool_occupancy:          busy / workers
+                    pipeline_save_duration_seconds:   Histogram of the time
+                                                      taken to save the pickle
+                    pipeline_last_event_timestamp_seconds: Time of the most
+                                                      recent event, use this to
+                                                      alert on stalls
+
+         USAGE: project.enable_metrics('/var/lib/node_exporter/my.prom')
+                project.run_all()
+
+============================================================================
+"""
+import os
+import time
+import atexit
+import threading
+from collections import deque
+
+__all__ = ['Metrics']
+
+############################
+#  Customizable constants  #
+############################
+
+INTERVAL     = 15  # Seconds between rewrites of the metrics file
+RATE_WINDOW  = 60  # Seconds of completions used for the per minute rate
+STEP_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 14400, 86400)
+SAVE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+STATES = ('pending', 'queued', 'running', 'done', 'failed')
+LEVELS = ('step', 'substep')
+
+
+class Metrics(object):
+
+    """In memory pipeline counters written in the Prometheus text format."""
+
+    def __init__(self, path, pipeline=None, interval=INTERVAL):
+        """Set up the counters and seed the step states from pipeline.
+
+        :path:     The file to write, should end in .prom for node_exporter.
+        :pipeline: A Pipeline to take the current step states from.
+        :interval: Seconds between rewrites of path.
+        """
+        self.path       = os.path.abspath(str(path))
+        self.interval   = interval
+        self.name       = pipeline.file if pipeline is not None else ''
+        self.states     = {}  # (step, file): state
+        self.counts     = dict(((l, s), 0) for l in LEVELS for s in STATES)
+        self.completed  = dict((l, 0) for l in LEVELS)
+        self.recent     = dict((l, deque()) for l in LEVELS)
+        self.failures   = {}
+        self.durations  = {}  # (step, level): Histogram
+        self.saves      = Histogram(SAVE_BUCKETS)
+        self.in_pool    = set()
+        self.workers    = 0
+        self.last_event = None
+        self.lock       = threading.Lock()
+        self.thread     = None
+        self.stopped    = None
+        if pipeline is not None:
+            self.seed(pipeline)
+
+    def seed(self, pipeline):
+        """Set the state of every step and substep, the only full scan."""
+        with self.lock:
+            for step in pipeline:
+                self._set_state((step.name, None), _state(step))
+                for substep in step.steps or ():
+                    self._set_state((step.name, substep.name),
+                                    _state(substep))
+
+    def observe(self, event, fields):
+        """Update the counters from a single event, see Pipeline._emit."""
+        key   = (fields.get('step'), fields.get('file'))
+        level = 'substep' if key[1] is not None else 'step'
+        now   = time.time()
+        with self.lock:
+            self.last_event = now
+            if event == 'added':
+                self._set_state(key, 'pending')
+            elif event == 'queued':
+                self._set_state(key, 'queued')
+                self.in_pool.add(key)
+            elif event == 'started':
+                self._set_state(key, 'running')
+            elif event == 'retry':
+                self._set_state(key, 'queued')  # Waiting out the delay
+            elif event == 'skipped':
+                self._set_state(key, 'done')
+            elif event in ('finished', 'failed'):
+                self._set_state(key, 'done' if event == 'finished'
+                                else 'failed')
+                self.in_pool.discard(key)
+                self.completed[level] += 1
+                self.recent[level].append(now)
+                if event == 'failed':
+                    self.failures[key[0]] = self.failures.get(key[0], 0) + 1
+                if fields.get('duration') is not None:
+                    if (key[0], level) not in self.durations:
+                        self.durations[(key[0], level)] = Histogram(
+                            STEP_BUCKETS)
+                    self.durations[(key[0], level)].observe(
+                        fields['duration'])
+            elif event == 'pool':
+                self.workers = fields.get('workers', 0)
+                if not self.workers:
+                    self.in_pool.clear()
+            elif event == 'saved':
+                self.saves.observe(fields.get('duration', 0))
+        if self.thread is None:
+            self.start()
+
+    ##############################
+    #  Writing the metrics file  #
+    ##############################
+
+    def start(self):
+        """Start the background thread that rewrites the file."""
+        if self.thread is not None:
+            return self
+        self.write()
+        self.stopped = threading.Event()
+        self.thread  = threading.Thread(target=self._loop,
+                                        name='pipeline-metrics')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        """Stop the background thread and write the file one last time."""
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            try:
+                atexit.unregister(self.stop)
+            except AttributeError:
+                pass
+        self.write()
+
+    def write(self):
+        """Atomically replace the metrics file with the current counters."""
+        temp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp, 'w') as fout:
+            fout.write(self.render())
+        os.replace(temp, self.path)
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        with self.lock:
+            now = time.time()
+            for times in self.recent.values():
+                while times and times[0] < now - RATE_WINDOW:
+                    times.popleft()
+            base  = {'pipeline': self.name}
+            lines = []
+            _header(lines, 'pipeline_steps', 'gauge',
+                    'Steps and substeps by state.')
+            for (level, state), count in sorted(self.counts.items()):
+                _sample(lines, 'pipeline_steps', count, base, level=level,
+                        state=state)
+            _header(lines, 'pipeline_completed_total', 'counter',
+                    'Completed step and substep runs.')
+            for level in LEVELS:
+                _sample(lines, 'pipeline_completed_total',
+                        self.completed[level], base, level=level)
+            _header(lines, 'pipeline_completed_per_minute', 'gauge',
+                    'Runs completed in the last minute.')
+            for level in LEVELS:
+                _sample(lines, 'pipeline_completed_per_minute',
+                        len(self.recent[level]) * 60.0 / RATE_WINDOW, base,
+                        level=level)
+            _header(lines, 'pipeline_failures_total', 'counter',
+                    'Failed runs by step.')
+            for step, count in sorted(self.failures.items()):
+                _sample(lines, 'pipeline_failures_total', count, base,
+                        step=step)
+            _header(lines, 'pipeline_step_duration_seconds', 'histogram',
+                    'Run time of steps and substeps.')
+            for (step, level), hist in sorted(self.durations.items()):
+                hist.render(lines, 'pipeline_step_duration_seconds', base,
+                            step=step, level=level)
+            busy = min(len(self.in_pool), self.workers)
+            _header(lines, 'pipeline_pool_workers', 'gauge',
+                    'Processes in the running pool.')
+            _sample(lines, 'pipeline_pool_workers', self.workers, base)
+            _header(lines, 'pipeline_pool_busy', 'gauge',
+                    'Pool processes with a task.')
+            _sample(lines, 'pipeline_pool_busy', busy, base)
+            _header(lines, 'pipeline_pool_occupancy', 'gauge',
+                    'Fraction of pool processes with a task.')
+            _sample(lines, 'pipeline_pool_occupancy',
+                    float(busy) / self.workers if self.workers else 0, base)
+            _header(lines, 'pipeline_save_duration_seconds', 'histogram',
+                    'Time taken to save the pipeline pickle.')
+            self.saves.render(lines, 'pipeline_save_duration_seconds', base)
+            _header(lines, 'pipeline_last_event_timestamp_seconds', 'gauge',
+                    'Time of the most recent step event.')
+            _sample(lines, 'pipeline_last_event_timestamp_seconds',
+                    self.last_event or 0, base)
+        return '\n'.join(lines) + '\n'
+
+    ###############
+    #  Internals  #
+    ###############
+
+    def _loop(self):
+        """Rewrite the file every interval seconds until stopped."""
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except (IOError, OSError):
+                pass  # Try again on the next interval
+
+    def _set_state(self, key, state):
+        """Move key to state, keeping the counts in step."""
+        level = 'substep' if key[1] is not None else 'step'
+        old = self.states.get(key)
+        if old is not None:
+            self.counts[(level, old)] -= 1
+        self.states[key] = state
+        self.counts[(level, state)] += 1
+
+    def __getstate__(self):
+        """Do not pickle the lock or thread."""
+        with self.lock:
+            state = self.__dict__.copy()
+            state['states']   = dict(self.states)
+            state['failures'] = dict(self.failures)
+            state['in_pool']  = set()
+            state['workers']  = 0
+        state['lock']    = None
+        state['thread']  = None
+        state['stopped'] = None
+        return state
+
+    def __setstate__(self, state):
+        """Recreate the lock, the thread starts on the next event."""
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        """Show the path."""
+        return '<Metrics(path={})>'.format(self.path)
+
+
+class Histogram(object):
+
+    """A cumulative Prometheus histogram."""
+
+    def __init__(self, buckets):
+        """Set the upper bounds of the buckets, +Inf is added."""
+        self.buckets = tuple(buckets)
+        self.counts  = [0] * len(self.buckets)
+        self.count   = 0
+        self.sum     = 0.0
+
+    def observe(self, value):
+        """Add a single value."""
+        self.count += 1
+        self.sum   += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def render(self, lines, name, base, **labels):
+        """Append the bucket, sum, and count samples to lines."""
+        for bound, count in zip(self.buckets, self.counts):
+            _sample(lines, name + '_bucket', count, base, le=repr(bound),
+                    **labels)
+        _sample(lines, name + '_bucket', self.count, base, le='+Inf',
+                **labels)
+        _sample(lines, name + '_sum', self.sum, base, **labels)
+        _sample(lines, name + '_count', self.count, base, **labels)
+
+
+###############################################################################
+#                              Private Functions                              #
+###############################################################################
+
+
+def _state(step):
+    """Return the metrics state of a step from its flags."""
+    if step.failed:
+        return 'failed'
+    return 'done' if step.done else 'pending'
+
+
+def _header(lines, name, kind, description):
+    """Append the HELP and TYPE lines for a metric."""
+    lines.append('# HELP {} {}'.format(name, description))
+    lines.append('# TYPE {} {}'.format(name, kind))
+
+
+def _sample(lines, name, value, base, **labels):
+    """Append a single sample line."""
+    labels.update(base)
+    label = ','.join('{}="{}"'.format(k, _escape(v))
+                     for k, v in sorted(labels.items()))
+    lines.append('{}{{{}}} {}'.format(name, label, value))
+
+
+def _escape(value):
+    """Escape a label value."""
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
@@ -0,0 +1,193 @@
+"""
+Account for time spent in the framework rather than in the steps.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-08 10:05
+ Last modified: 2016-04-08 10:05
+
+   DESCRIPTION: Every bookkeeping phase of a run (saving, donetests, logging,
+                events, substep construction, result parsing, and so on) is
+                timed with a phase() block, usually through the timed()
+                method decorator. Phases nest, and each phase is only
+                charged for its own (exclusive) time, so a save() inside
+                _post_exec() counts as save, not as post_exec, and the
+                phases add up to the wall clock time of the run.
+
+                Phases in PAYLOAD are the steps themselves: execute is the
+                time spent running a step in this process, pool_wait is the
+                time spent waiting on pool workers to return results.
+                Everything else is framework time.
+
+         USAGE: project.run_all()
+                project.print_overhead()
+
+============================================================================
+"""
+import time
+import functools
+
+__all__ = ['Overhead', 'timed', 'timed_iter']
+
+PAYLOAD = ('execute', 'pool_wait')
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+
+class Overhead(object):
+
+    """Exclusive time and call counts of every timed phase."""
+
+    def __init__(self):
+        """Start with no phases."""
+        self.phases   = {}  # phase: [calls, seconds]
+        self.last_run = {}  # phases of the last Pipeline.run_all
+        self.stack    = []  # Time used by child phases of each open phase
+
+    def phase(self, name):
+        """Return a context manager that charges its time to name."""
+        return _Phase(self, name)
+
+    def add(self, name, seconds, calls=1):
+        """Charge seconds to name directly."""
+        if name not in self.phases:
+            self.phases[name] = [0, 0.0]
+        self.phases[name][0] += calls
+        self.phases[name][1] += seconds
+
+    def snapshot(self):
+        """Return a copy of the phases, see since()."""
+        return dict((k, list(v)) for k, v in self.phases.items())
+
+    def since(self, snapshot):
+        """Return the phases accumulated since snapshot was taken."""
+        delta = {}
+        for name, (calls, seconds) in self.phases.items():
+            old = snapshot.get(name, [0, 0.0])
+            if calls - old[0]:
+                delta[name] = [calls - old[0], seconds - old[1]]
+        return delta
+
+    def reset(self):
+        """Forget every phase."""
+        self.phases   = {}
+        self.last_run = {}
+
+    def split(self, phases=None):
+        """Return (payload seconds, framework seconds)."""
+        phases  = self.phases if phases is None else phases
+        payload = sum(v[1] for k, v in phases.items() if k in PAYLOAD)
+        total   = sum(v[1] for v in phases.values())
+        return payload, total - payload
+
+    def report(self, phases=None):
+        """Return a table of phases, longest first, with the split."""
+        phases = self.phases if phases is None else phases
+        if not phases:
+            return 'No timed phases'
+        payload, framework = self.split(phases)
+        total = payload + framework
+        lines = ['{:<20} {:>10} {:>12} {:>8}'.format(
+            'Phase', 'Calls', 'Seconds', 'Percent')]
+        for name, (calls, seconds) in sorted(
+                phases.items(), key=lambda i: i[1][1], reverse=True):
+            lines.append('{:<20} {:>10} {:>12.4f} {:>7.1%}'.format(
+                name + (' *' if name in PAYLOAD else ''), calls, seconds,
+                seconds / total if total else 0))
+        lines.append('')
+        lines.append('Payload (*):  {:.4f}s ({:.1%})'.format(
+            payload, payload / total if total else 0))
+        lines.append('Framework:    {:.4f}s ({:.1%})'.format(
+            framework, framework / total if total else 0))
+        return '\n'.join(lines)
+
+    def __getstate__(self):
+        """Do not pickle open phases, pickling happens inside save."""
+        state = self.__dict__.copy()
+        state['stack'] = []
+        return state
+
+
+class _Phase(object):
+
+    """Context manager for a single timed phase."""
+
+    __slots__ = ('overhead', 'name', 'start')
+
+    def __init__(self, overhead, name):
+        """Remember where to charge the time."""
+        self.overhead = overhead
+        self.name     = name
+        self.start    = None
+
+    def __enter__(self):
+        """Start the clock."""
+        self.overhead.stack.append(0.0)
+        self.start = _clock()
+        return self
+
+    def __exit__(self, *args):
+        """Charge the time not used by child phases."""
+        elapsed = _clock() - self.start
+        stack   = self.overhead.stack
+        child   = stack.pop() if stack else 0.0
+        self.overhead.add(self.name, elapsed - child)
+        if stack:
+            stack[-1] += elapsed
+        return False
+
+
+class _NullPhase(object):
+
+    """A phase that does nothing, for steps without a pipeline."""
+
+    def __enter__(self):
+        """Nothing to do."""
+        return self
+
+    def __exit__(self, *args):
+        """Nothing to do."""
+        return False
+
+NULL_PHASE = _NullPhase()
+
+
+def timed(phase):
+    """Decorator to time a Pipeline or Step method as phase.
+
+    The object must have an _overhead() method that returns an Overhead or
+    None.
+    """
+    def decorator(method):
+        """Wrap method."""
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            """Run method inside the phase."""
+            overhead = self._overhead()
+            if overhead is None:
+                return method(self, *args, **kwargs)
+            with overhead.phase(phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(overhead, name, iterable):
+    """Yield from iterable, charging the time spent waiting to name.
+
+    The time spent by the caller between items is not charged to name.
+    """
+    iterator = iter(iterable)
+    while True:
+        with overhead.phase(name) if overhead is not None else NULL_PHASE:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
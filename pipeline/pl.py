@@ -16,18 +16,30 @@ Core classes for pipeline module
 import os
 import re
 import sys
+import copy
 import time
-import traceback
+import threading
+from contextlib import contextmanager
 from datetime import datetime as dt
-from subprocess import call
-from subprocess import Popen
-from subprocess import PIPE
-from multiprocessing import Pool
+from datetime import timedelta
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows, resources are not recorded
 from . import logme
+from . import trace
+from . import report
+from . import status
+from .events import EventLog
+from .metrics import Metrics
+from .history import History
+from .registry import StepOrder
+from .overhead import Overhead, NULL_PHASE, timed, timed_iter
+from .scheduler import Dispatcher, Retry
 
 __all__ = ["Pipeline", "Step", "Command", "Function", "get_pipeline",
            "run_cmd", "run_function"]
@@ -38,10 +50,22 @@ __all__ = ["Pipeline", "Step", "Command", "Function", "get_pipeline",
 
 DEFAULT_FILE = './pipeline_state.pickle'
 DEFAULT_PROT = 2  # Support python2 pickling, can be 4 if using python3 only
-logme.MIN_LEVEL = 'debug'  # Controls level of logging
+DEFAULT_LOGLEV = 'debug'  # Controls level of logging, see Pipeline.loglev
+CHECK_THREADS  = 16  # Donetests run at once by check_all()
 # This will be replaced in step functions or commands with the contents of
 # file_list
 REGEX        = r'<StepFile>'
+# Resource usage recorded for every step, see Step.get_resources()
+RUSAGE_FIELDS = ('utime', 'stime', 'maxrss', 'inblock', 'oublock', 'nvcsw',
+                 'nivcsw')
+# The states counted by Pipeline.get_counts() and Step.get_counts()
+STATES        = ('pending', 'running', 'done', 'failed')
+# The arguments of add() that a spec passed to add_many() can have, in order
+ADD_ARGS      = ('command', 'args', 'name', 'kind', 'store', 'donetest',
+                 'pretest', 'depends', 'file_list')
+FUNCTION_ARGS = ('batched', 'batch_size', 'batch_bytes', 'profile')
+
+_PATHS = None  # Executable paths, cached inside a _path_cache() block
 
 
 ###############################################################################
@@ -60,30 +84,157 @@ class Pipeline(object):
         """Setup initial variables and save."""
         self.step     = 'start'
         self.steps    = {}  # Command object by name
-        self.order    = ()  # The order of the steps
+        self.order    = StepOrder()  # The order of the steps
         self.current  = None  # The current pipeline step
+        self._counts   = dict((i, 0) for i in STATES)  # Steps by state
+        self._failures = set()  # Names of failed steps
+        self._pointer  = None   # The first step that is not done
+        self._scan     = None   # Step to look for _pointer from if stale
+        self._earlier  = []     # Steps that may now come before _pointer
         self.file     = pickle_file
         self.logfile  = pickle_file + '.log'  # Not set by init
-        self.loglev   = logme.MIN_LEVEL
+        self.loglev   = DEFAULT_LOGLEV
         self.root_dir = os.path.abspath(str(root))
         self.prot     = int(prot)  # Can change version if required
+        self.events   = None  # An EventLog if enabled
+        self.metrics  = None  # A Metrics file writer if enabled
+        self.history  = None  # A runtime History if enabled
+        self.overhead = Overhead()  # Time spent in each framework phase
+        self.status_file = None  # A summary written on save if enabled
         self.save()
 
     #####################
     #  Step Management  #
     #####################
 
+    @timed('save')
     def save(self):
         """Save state to the provided pickle file.
 
         This will save all of the Step classes also, and should
         be called on every modification
         """
+        if getattr(self, '_deferred', 0):
+            self._unsaved = True
+            return
+        self._unsaved = False
+        start = time.time()
         with open(self.file, 'wb') as fout:
             pickle.dump(self, fout, protocol=self.prot)
+            size = fout.tell()
+        if getattr(self, 'status_file', None):
+            status.write(self, self.status_file)
+        self._emit('saved', duration=time.time() - start, bytes=size)
+
+    @contextmanager
+    def defer_save(self):
+        """Context manager to save once at the end instead of every change.
+
+        Calls to save() inside the block only mark the pipeline as changed,
+        it is saved when the outermost block exits. Blocks can be nested.
+        """
+        self._deferred = getattr(self, '_deferred', 0) + 1
+        try:
+            yield self
+        finally:
+            self._deferred -= 1
+            if not self._deferred and getattr(self, '_unsaved', False):
+                self.save()
+
+    def enable_events(self, path=None, max_bytes=None, backups=None,
+                      compress=True):
+        """Write step lifecycle events to a JSONL file, see events.py.
+
+        :path:      File to write, default: <pickle_file>.events.jsonl
+        :max_bytes: Rotate the file when larger than this.
+        :backups:   Number of rotated files to keep.
+        :compress:  gzip rotated files.
+        """
+        args = {'compress': compress}
+        if max_bytes is not None:
+            args['max_bytes'] = max_bytes
+        if backups is not None:
+            args['backups'] = backups
+        self.disable_events()
+        self.events = EventLog(path if path else self.file + '.events.jsonl',
+                               **args)
+        self.save()
+
+    def disable_events(self):
+        """Stop writing events."""
+        if getattr(self, 'events', None):
+            self.events.close()
+        self.events = None
+
+    def enable_metrics(self, path=None, interval=None):
+        """Keep a Prometheus textfile of run metrics, see metrics.py.
+
+        :path:     File to write, default: <pickle_file>.prom
+        :interval: Seconds between rewrites of the file.
+        """
+        self.disable_metrics()
+        args = {'interval': interval} if interval else {}
+        self.metrics = Metrics(path if path else self.file + '.prom',
+                               self, **args)
+        self.metrics.start()
+        self.save()
+
+    def disable_metrics(self):
+        """Write the metrics file a final time and stop updating it."""
+        if getattr(self, 'metrics', None):
+            self.metrics.stop()
+        self.metrics = None
+
+    def enable_history(self, cache_dir=None):
+        """Record every runtime to predict durations, see history.py.
+
+        :cache_dir: Directory for the runtime history, can be shared between
+                    pipelines, default: <root_dir>/.pipeline_cache
+        """
+        self.disable_history()
+        self.history = History(cache_dir if cache_dir else
+                               os.path.join(self.root_dir, '.pipeline_cache'))
+        self.history.refresh()
+        self.save()
+
+    def disable_history(self):
+        """Stop recording runtimes."""
+        if getattr(self, 'history', None):
+            self.history.close()
+        self.history = None
+
+    def enable_status(self, path=None):
+        """Write a JSON summary on every save for `pipeline status`.
+
+        :path: File to write, default: <pickle_file>.status.json
+        """
+        self.status_file = path if path else status.status_file(self.file)
+        self.save()
+
+    def disable_status(self):
+        """Stop writing the summary, the last one is left in place."""
+        self.status_file = None
+
+    def get_eta(self, threads=1):
+        """Return expected seconds until every step is done.
+
+        Predictions come from the runtime history, so enable_history() must
+        have been called. Steps that have never run are not counted.
+
+        :threads: Number of workers substeps will be run on.
+        :returns: Seconds, None if history is off or nothing is known.
+        """
+        history = getattr(self, 'history', None)
+        if not history:
+            return None
+        history.refresh()
+        times = [step._get_eta(history, threads) for step in self]
+        times = [i for i in times if i is not None]
+        return sum(times) if times else None
 
     def add(self, command=None, args=None, name=None, kind='', store=True,
-            donetest=None, pretest=None, depends=None, file_list=None):
+            donetest=None, pretest=None, depends=None, file_list=None,
+            position=None, **kwargs):
         """Wrapper for add_command and add_function.
 
         Attempts to detect kind, defaults to function
@@ -116,6 +267,10 @@ class Pipeline(object):
                     for the same word. If the word does not exist, the filename
                     will be added to the end of the command or arglist. If this
                     is not possible a StepError Exception will be raised.
+        :position:  Insert the step before this position in the order,
+                    default is to add it at the end.
+        :kwargs:    Any other keyword arguments are passed to add_function,
+                    e.g. batched, batch_size, and batch_bytes.
         """
         if kind != 'pipeline' and not command:
             raise self.PipelineError('Cannot add a non-pipeline step ' +
@@ -127,13 +282,14 @@ class Pipeline(object):
                 kind = 'function'
         if kind == 'command':
             self.add_command(command, args, name, store, donetest, pretest,
-                             depends, file_list)
+                             depends, file_list, position)
         elif kind == 'function':
             self.add_function(command, args, name, store, donetest, pretest,
-                              depends, file_list)
+                              depends, file_list, position=position, **kwargs)
         elif kind == 'pipeline':
             self.add_pipeline(name=name, donetest=donetest, pretest=pretest,
-                              depends=depends, file_list=file_list)
+                              depends=depends, file_list=file_list,
+                              position=position)
         else:
             raise self.PipelineError('Invalid step type: {}'.format(kind),
                                      self.logfile)
@@ -141,72 +297,135 @@ class Pipeline(object):
     def delete(self, name):
         """Delete a step by name."""
         if name in self.steps:
-            self.steps.pop(name)
+            self._step_counts()[self.steps.pop(name).state] -= 1
+            self._failure_names().discard(name)
         else:
             self.log('{} not in steps dict'.format(name), level='warn')
         if name in self.order:
-            ind = self.order.index(name)
-            self.order = self.order[:ind] + self.order[ind + 1:]
+            if name in (self._pointer, self._scan):
+                # Look for the pointer from the next step when it is read
+                position = self.order.index(name)
+                self.order.remove(name)
+                self._pointer = None
+                self._scan    = (self.order[position]
+                                 if position < len(self.order) else None)
+            else:
+                self.order.remove(name)
         else:
-            self.log('{} not in order tuple'.format(name), level='warn')
+            self.log('{} not in step order'.format(name), level='warn')
         self.save()
 
     def add_command(self, program, args=None, name=None, store=True,
                     donetest=None, pretest=None, depends=None,
-                    file_list=None):
+                    file_list=None, position=None):
         """Add a simple pipeline step via a Command object."""
-        name = name if name else program.split(' ')[0].split('/')[-1]
-        if name not in self.steps:
-            self.steps[name] = Command(program, args, store, parent=self,
-                                       donetest=donetest, pretest=pretest,
-                                       name=name, depends=depends,
-                                       file_list=file_list)
-            self.order = self.order + (name,)
-        else:
-            self.log(('{} already in steps. Please choose another ' +
-                      'or delete it').format(name), level='error')
-        self._get_current()
-        self.save()
+        name = name if name else _command_name(program)
+        with self.defer_save():
+            if name not in self.steps:
+                self._register(name, Command(
+                    program, args, store, parent=self, donetest=donetest,
+                    pretest=pretest, name=name, depends=depends,
+                    file_list=file_list), position)
+            else:
+                self.log(('{} already in steps. Please choose another ' +
+                          'or delete it').format(name), level='error')
+            self._get_current()
+            self.save()
 
     def add_function(self, function_call, args=None, name=None, store=True,
                      donetest=None, pretest=None, depends=None,
-                     file_list=None):
-        """Add a function as a pipeline step via a Function object."""
-        if not name:
-            parts = str(function_call).strip('<>').split(' ')
-            parts.remove('function')
-            try:
-                parts.remove('built-in')
-            except ValueError:
-                pass
-            name = parts[0]
-        if name not in self.steps:
-            self.steps[name] = Function(function_call, args, store,
-                                        parent=self, donetest=donetest,
-                                        pretest=pretest, name=name,
-                                        depends=depends, file_list=file_list)
-            self.order = self.order + (name,)
-        else:
-            self.log(('{} already in steps. Please choose another ' +
-                      'or delete it').format(name), level='error')
-        self._get_current()
-        self.save()
+                     file_list=None, batched=False, batch_size=None,
+                     batch_bytes=None, profile=False, position=None):
+        """Add a function as a pipeline step via a Function object.
+
+        :batched:     Call the function once per batch of files instead of
+                      once per file, see Function for details.
+        :batch_size:  Maximum number of files per batch.
+        :batch_bytes: Maximum total size of the files in a batch.
+        :profile:     Run the function under cProfile, 'memory' to also
+                      record allocations, see Function for details.
+        :position:    Insert before this position in the order, default last.
+        """
+        name = name if name else _function_name(function_call)
+        with self.defer_save():
+            if name not in self.steps:
+                self._register(name, Function(
+                    function_call, args, store, parent=self,
+                    donetest=donetest, pretest=pretest, name=name,
+                    depends=depends, file_list=file_list, batched=batched,
+                    batch_size=batch_size, batch_bytes=batch_bytes,
+                    profile=profile), position)
+            else:
+                self.log(('{} already in steps. Please choose another ' +
+                          'or delete it').format(name), level='error')
+            self._get_current()
+            self.save()
 
     def add_pipeline(self, name=None, donetest=None, pretest=None,
-                     depends=None, file_list=None):
+                     depends=None, file_list=None, position=None):
         """Add a sub-pipeline step via a PipelineStep object."""
         name = name if name else 'unknown pipeline'
-        if name not in self.steps:
-            self.steps[name] = PipelineStep(parent=self, name=name,
-                                            donetest=donetest, pretest=pretest,
-                                            depends=depends,
-                                            file_list=file_list)
-            self.order = self.order + (name,)
-        else:
-            self.log(('{} already in steps. Please choose another ' +
-                      'or delete it').format(name), level='error')
-        self._get_current()
-        self.save()
+        with self.defer_save():
+            if name not in self.steps:
+                self._register(name, PipelineStep(
+                    parent=self, name=name, donetest=donetest,
+                    pretest=pretest, depends=depends, file_list=file_list),
+                    position)
+            else:
+                self.log(('{} already in steps. Please choose another ' +
+                          'or delete it').format(name), level='error')
+            self._get_current()
+            self.save()
+
+    def add_many(self, specs, position=None):
+        """Add many steps at once, much faster than calling add() for each.
+
+        Every spec is checked before any step is added, so either all steps
+        are added or a PipelineError listing every problem is raised. Each
+        executable is only looked up once, the current step is only found
+        once, and the pipeline is only saved once.
+
+        :specs:    An iterable of step specs, each either a tuple of the
+                   positional arguments to add() or a dict of the keyword
+                   arguments to add(). A table with a to_dict('records')
+                   method, e.g. a pandas DataFrame, is read as one step per
+                   row, with missing (NaN) values treated as None.
+        :position: Insert the steps, in order, before this position, default
+                   is to add them at the end.
+        :returns:  A list of the names of the added steps.
+        """
+        if hasattr(specs, 'to_dict'):
+            specs = specs.to_dict('records')
+        specs  = [_parse_spec(spec) for spec in specs]
+        errors = [spec['error'] for spec in specs if 'error' in spec]
+        names  = set()
+        with _path_cache():
+            for number, spec in enumerate(specs):
+                if 'error' in spec:
+                    continue
+                problem = _check_spec(spec)
+                if not problem and spec['name'] in self.steps:
+                    problem = 'already in steps'
+                if not problem and spec['name'] in names:
+                    problem = 'name used twice'
+                if problem:
+                    errors.append('Step {} ({}): {}'.format(
+                        number, spec['name'], problem))
+                names.add(spec['name'])
+            if errors:
+                raise self.PipelineError(
+                    '{} invalid step specs, first: {}\n{}'.format(
+                        len(errors), errors[0], '\n'.join(errors)),
+                    self.logfile)
+            with self.defer_save():
+                for spec in specs:
+                    self._register(spec['name'], self._new_step(spec),
+                                   position)
+                    if position is not None:
+                        position += 1
+                self._get_current()
+                self.save()
+        return [spec['name'] for spec in specs]
 
     #############
     #  Running  #
@@ -219,14 +438,10 @@ class Pipeline(object):
         """
         self._get_current()
         if step == 'current':
-            cur = None
             if not self.order:
                 self.log('No steps added yet, not running', level='warn')
                 return
-            for step in self:
-                if not step.done:
-                    cur = step.name
-                    break
+            cur = self._first_incomplete()
             if not cur:
                 self.log('All steps already complete, not running',
                          level='warn')
@@ -248,13 +463,38 @@ class Pipeline(object):
     def run_all(self, skip_pre_donecheck=False, force=False):
         """Run all steps in order if not already complete.
 
+        The time spent in each phase of the run is kept in
+        self.overhead.last_run, see get_overhead().
+
         :skip_pre_donecheck: Do not run the donecheck at start. Otherwise
                              donecheck is always run on every step (even
                              completed) to determine if a re-run is needed.
         :force:              Run every step, irrespective of state.
         """
+        overhead = self._overhead()
+        mark     = overhead.snapshot()
+        try:
+            self._run_steps(skip_pre_donecheck, force)
+        finally:
+            overhead.last_run = overhead.since(mark)
+            payload, framework = overhead.split(overhead.last_run)
+            self.log('Run finished, payload {:.3f}s, framework {:.3f}s'.format(
+                payload, framework), level='info')
+
+    @timed('run_all')
+    def _run_steps(self, skip_pre_donecheck=False, force=False):
+        """Run all steps, see run_all()."""
         self._get_current()
         self.save()
+        # Predict every step once, only if the ETA will be logged, and
+        # count down as steps finish
+        etas, eta = {}, None
+        history = getattr(self, 'history', None)
+        if history and logme.enabled('info', self.loglev):
+            history.refresh()
+            etas  = dict((i.name, i._get_eta(history)) for i in self)
+            known = [i for i in etas.values() if i is not None]
+            eta   = sum(known) if known else None
         for step in self:
             # Get done state
             done = step.done
@@ -262,8 +502,17 @@ class Pipeline(object):
                 if step.donetest:
                     done = step.run_done_test()
             if not force and done:
+                step._emit('skipped', reason='donetest' if step.donetest
+                           and not skip_pre_donecheck else 'done')
+                if eta is not None:
+                    eta -= etas.get(step.name) or 0
                 continue
+            if eta is not None:
+                self.log('Running {}, pipeline ETA {}'.format(
+                    step.name, _format_seconds(eta)), level='info')
             step.run()
+            if eta is not None:
+                eta -= etas.get(step.name) or 0
         self._get_current()
         self.save()
 
@@ -271,45 +520,202 @@ class Pipeline(object):
     #  Parallel Running  #
     ######################
 
-    def run_parallel(self, job_list, auto_resubmit=False, tries=5, delay=60,
-                     raise_on_error=False):
+    @timed('run_parallel')
+    def run_parallel(self, job_list=None, auto_resubmit=False, tries=5,
+                     delay=60, raise_on_error=False, threads=None, retry=None,
+                     force=False):
         """Run job_list (tuple of step names) in parallel.
 
         Runs all jobs in job_list (a tuple or list) in parallel. It is
         HIGHLY recommended that the dependency lists for all jobs are
         populated before running this. Jobs will not run until their
-        dependencies are satisfied.
+        dependencies are satisfied, and jobs that depend on a failed job
+        are not run at all. Steps and the substeps of every step share a
+        single process pool.
 
         It is possible to have jobs autoresubmit on failure, up to a max of
-        'tries' times, with a pause of 'delay' seconds between attempts.
+        'tries' times, with a pause of 'delay' seconds between attempts. A
+        job waiting to be resubmitted does not hold a worker. Pass a
+        scheduler.Retry as retry for exponential backoff with jitter.
 
-        :job_list:       Tuple or list of valid step names.
+        :job_list:       Tuple or list of valid step names, None for all.
         :auto_resubmit:  If true, autoresubmit jobs 'tries' times.
         :tries:          Number of times to auto_resubmit.
         :delay:          Time in seconds between resubmits.
-        :raise_on_error: Abort with CommandFailed if job fails.
-        :returns: None
+        :raise_on_error: Raise a PipelineError at the end if any job failed
+                         or was not run.
+        :threads:        Number of processes to run. If None, use all CPUs.
+        :retry:          A scheduler.Retry to use instead of auto_resubmit,
+                         tries, and delay, e.g. to only retry some codes.
+        :force:          Run jobs even if they are already done.
+        :returns:        A list of the jobs that are not done.
         """
-        pass  # TODO
+        job_list = list(job_list) if job_list else list(self.order)
+        for name in job_list:
+            if name not in self.steps:
+                raise self.PipelineError('{} is not a step'.format(name),
+                                         self.logfile)
+        if retry is None and auto_resubmit:
+            # tries counts resubmits, a fixed delay between them
+            retry = Retry(tries + 1, delay, backoff=1, jitter=0)
+
+        from multiprocessing import Pool, cpu_count
+        threads  = threads if threads else cpu_count()
+        overhead = self._overhead()
+        with overhead.phase('pool_start'):
+            aggregator = logme.Aggregator().start()
+            pool = Pool(threads, initializer=logme.forward_to,
+                        initargs=(aggregator.queue,))
+        dispatcher = Dispatcher(pool, threads)
+        run = _ParallelRun(self, job_list, dispatcher, retry, force)
+        self._emit('pool', workers=threads)
+        try:
+            with self.defer_save():
+                run.start()
+            for chunk in timed_iter(overhead, 'pool_wait',
+                                    dispatcher.run(_run_task)):
+                with self.defer_save():
+                    run.handle(chunk)
+        finally:
+            with overhead.phase('pool_stop'):
+                pool.close()
+                pool.join()
+                aggregator.stop()
+            self._emit('pool', workers=0)
+        self._get_current()
+        self.save()
+
+        for name, error in sorted(run.exceptions.items()):
+            self.log('{} failed:\n{}'.format(name, error), 'error')
+        not_done = [i for i in job_list if not self.steps[i].done]
+        if run.blocked:
+            self.log('Not run as dependencies are not done: {}'.format(
+                ', '.join(i for i in job_list if i in run.blocked)), 'error')
+        if not_done and raise_on_error:
+            raise self.PipelineError(
+                '{} jobs not done: {}'.format(len(not_done), ', '.join(
+                    '{} ({})'.format(i, 'not run' if i in run.blocked
+                                     else self.steps[i].state)
+                    for i in not_done)), self.logfile)
+        return not_done
 
     ################
     #  Job Checks  #
     ################
 
-    def check(self, step, fail_on_error=False, raise_on_error=False):
+    def check(self, step, fail_on_error=False, raise_on_error=False,
+              threads=None, processes=False):
         """Run donetest on 'step' and mark done if true.
 
         The point of this function is to quickly mark a jobs that pass a
-        donetest as done so that it won't have to run again.
+        donetest as done so that it won't have to run again. The donetests
+        of substeps are run concurrently, see check_all().
+
+        :step:           A step name or Step.
         :fail_on_error:  Mark job as 'failed' if donetest fails.
-        :raise_on_error: Raise a FailedTest Exception on failing donetest.
-        :returns: None
+        :raise_on_error: Raise a PipelineError on failing donetest.
+        :threads:        Number of donetests to run at once.
+        :processes:      Run donetests in processes instead of threads.
+        :returns:        True if every donetest passed.
         """
-        pass  # TODO
-
-    def check_all(self, fail_on_error=False, raise_on_error=False):
-        """Run check() (donetest) on every job and mark done if true."""
-        pass  # TODO
+        if isinstance(step, Step):
+            step = step.name
+        if step not in self.steps:
+            raise self.PipelineError('{} is not a step'.format(step),
+                                     self.logfile)
+        return not self._check([self.steps[step]], fail_on_error,
+                               raise_on_error, threads, processes)
+
+    def check_all(self, fail_on_error=False, raise_on_error=False,
+                  threads=None, processes=False):
+        """Run check() (donetest) on every job and mark done if true.
+
+        The donetests of every step and substep are run at once in a pool,
+        the results are then applied together and the pipeline saved once.
+        Threads suit donetests that wait on the filesystem, which most do,
+        processes suit donetests that use a lot of CPU, like checksums, but
+        every donetest must then be picklable (no lambdas).
+
+        Afterwards, run_all(skip_pre_donecheck=True) skips the steps found
+        done without running their donetests again.
+
+        :fail_on_error:  Mark jobs as 'failed' if donetest fails.
+        :raise_on_error: Raise a PipelineError if any donetest fails, after
+                         every result is applied.
+        :threads:        Number of donetests to run at once, default
+                         CHECK_THREADS.
+        :processes:      Run donetests in processes instead of threads.
+        :returns:        (number passed, number failed)
+        """
+        checked  = []
+        failures = self._check(list(self), fail_on_error, raise_on_error,
+                               threads, processes, checked)
+        return len(checked) - len(failures), len(failures)
+
+    @timed('donetest')
+    def _check(self, steps, fail_on_error, raise_on_error, threads=None,
+               processes=False, checked=None):
+        """Run the donetests of steps and their substeps together.
+
+        :checked: A list to add every checked step and substep to.
+        :returns: A list of the steps and substeps that failed.
+        """
+        start = time.time()
+        jobs  = []  # Steps and substeps with a donetest
+        for step in steps:
+            if step.file_list:
+                if not step.steps:
+                    step._create_substeps()
+                jobs.extend(i for i in step.steps
+                            if i.donetest and i._test_test(i.donetest))
+            if step.donetest and step._test_test(step.donetest):
+                jobs.append(step)  # A step-level test, also with substeps
+        tested = set(id(i) for i in jobs)
+        if checked is not None:
+            checked.extend(jobs)
+        results  = _run_tests([i.donetest for i in jobs],
+                              threads if threads else CHECK_THREADS,
+                              processes)
+        failures = []
+        with self.defer_save():
+            for job, (passed, error) in zip(jobs, results):
+                was_done = job.done
+                job.failed_done = not passed
+                if passed:
+                    job.done   = True
+                    job.failed = False
+                    if not was_done:
+                        job._emit_skipped()
+                else:
+                    job.done   = False
+                    if fail_on_error:
+                        job.failed = True
+                    failures.append((job, error))
+            for step in steps:
+                if step.file_list and step.steps:
+                    # With a step test, substeps without a test can't veto
+                    counts = step.get_counts()
+                    own    = id(step) in tested
+                    if own:
+                        step.done = step.done and not any(
+                            id(i) in tested and not i.done
+                            for i in step.steps)
+                    else:
+                        step.done = counts['done'] == len(step.steps)
+                    if fail_on_error or not counts['failed']:
+                        step.failed = bool(counts['failed']) or (
+                            fail_on_error and own and step.failed_done)
+            self._get_current()
+            self.save()
+        self.log('Checked {} donetests in {:.2f}s, {} failed'.format(
+            len(jobs), time.time() - start, len(failures)), level='info')
+        if failures and raise_on_error:
+            job, error = failures[0]
+            raise self.PipelineError(
+                '{} donetests failed, first: {}{}'.format(
+                    len(failures), job.name,
+                    ' ({})'.format(error) if error else ''), self.logfile)
+        return [i[0] for i in failures]
 
     ##########################
     #  Print detailed stats  #
@@ -322,7 +728,8 @@ class Pipeline(object):
         :returns: None, just prints.
         """
         outfile.write('#\tStep\tCompleted\tFailed\tPretest\tDonetest\t' +
-                      'Command\tArgs\tOutput\tSTDERR\tCode\n')
+                      'Command\tArgs\tOutput\tSTDERR\tCode\t' +
+                      'CPU_Seconds\tMax_RSS_KB\tBlocks_In\tBlocks_Out\n')
         i = 0
         for step in self:
             if step.pretest:
@@ -333,36 +740,85 @@ class Pipeline(object):
                 donetest = 'Failed' if step.failed_done else 'Passed'
             else:
                 donetest = 'None'
+            usage = step.get_resources()
+            if usage:
+                usage = ['{:.3f}'.format(usage['utime'] + usage['stime']),
+                         str(usage['maxrss']), str(usage['inblock']),
+                         str(usage['oublock'])]
+            else:
+                usage = ['NA'] * 4
             outfile.write('\t'.join(
                 [str(i), step.name, str(step.done), str(step.failed), pretest,
-                 donetest, str(step.command), str(step.args)]) + '\n')
+                 donetest, str(step.command), str(step.args),
+                 str(bool(step.out)), str(bool(step.err)), str(step.code)] +
+                usage) + '\n')
             i += 1
 
-    def get_stats(self, include_outputs=False):
+    def get_stats(self, include_outputs=False, failed=False, pattern=None,
+                  offset=0, limit=None, substep_limit=None):
         """Return pretty string of details pipeline stats.
 
+        Use print_stats() for big pipelines, it does not build the string.
+
         :include_outputs: Also print step.out and step.err
+        :failed:          Only show failed steps and substeps
+        :pattern:         Only show steps whose name matches this regex
+        :offset:          Skip this many matching steps, for paging
+        :limit:           Show at most this many steps
+        :substep_limit:   Show at most this many substeps of each step
         :returns:         String for printing
         """
-        output = str(self) + '\n\n'
-        output = output + 'Individual step stats:'
-        for step in self:
-            output = output + '\n\n' + str(step)
-            if include_outputs:
-                output = output + '\n' + step.get_outputs()
-            if step.file_list:
-                for line in step.get_steps(include_outputs).split('\n'):
-                    output = output + '\n\t{}'.format(line)
-        return output
+        return ''.join(report.iter_stats(
+            self, include_outputs, failed, pattern, offset, limit,
+            substep_limit))
 
-    def print_stats(self, outfile=sys.stdout, include_outputs=True):
+    def print_stats(self, outfile=sys.stdout, include_outputs=False,
+                    failed=False, pattern=None, offset=0, limit=None,
+                    substep_limit=None):
         """Pretty print detailed stats on pipeline to output.
 
+        The stats are written a step at a time, see get_stats() for the
+        filters.
+
         :outfile:         File handle to write to
         :include_outputs: Also print step.out and step.err
         :returns:         None, just prints.
         """
-        outfile.write(self.get_stats(include_outputs) + '\n')
+        report.write(report.iter_stats(
+            self, include_outputs, failed, pattern, offset, limit,
+            substep_limit), outfile)
+
+    def get_overhead(self, last_run=False):
+        """Return a table of time spent in each phase, see overhead.py.
+
+        Phases marked with * are the steps themselves (payload), the rest is
+        framework time: saving, tests, logging, events, and so on.
+
+        :last_run: Only show the most recent run_all(), otherwise show
+                   everything since the pipeline was created or
+                   reset_overhead() was called.
+        """
+        overhead = self._overhead()
+        return overhead.report(overhead.last_run if last_run else None)
+
+    def print_overhead(self, outfile=sys.stdout, last_run=False):
+        """Print the overhead report to outfile, see get_overhead()."""
+        outfile.write(self.get_overhead(last_run) + '\n')
+
+    def reset_overhead(self):
+        """Clear all phase timers."""
+        self._overhead().reset()
+        self.save()
+
+    def export_trace(self, path):
+        """Write a Chrome Trace Event timeline of the last run, see trace.py.
+
+        Open path in chrome://tracing or https://ui.perfetto.dev.
+
+        :path:    The JSON file to write.
+        :returns: A text summary of pool utilisation and the critical path.
+        """
+        return trace.export_trace(self, path)
 
     ###############
     #  Internals  #
@@ -370,16 +826,159 @@ class Pipeline(object):
 
     def log(self, message, level='debug'):
         """Wrapper for logme log function."""
-        logme.log(message, logfile=self.logfile, level=level, min_level=self.loglev)
+        if not logme.enabled(level, self.loglev):
+            return
+        with self._overhead().phase('log'):
+            logme.log(message, logfile=self.logfile, level=level,
+                      min_level=self.loglev)
+
+    @timed('events')
+    def _emit(self, event, step=None, **fields):
+        """Write an event to the event log if enabled.
+
+        :step: The Step or substep the event is about.
+        """
+        events  = getattr(self, 'events', None)
+        metrics = getattr(self, 'metrics', None)
+        history = getattr(self, 'history', None)
+        if not events and not metrics and not history:
+            return
+        fields['pipeline'] = self.file
+        if step is not None and isinstance(step.parent, Step):
+            fields['step'] = step.parent.name
+            fields['file'] = step.name
+        else:
+            fields['step'] = step.name if step is not None else None
+            fields['file'] = None
+        if events:
+            events.emit(event, **fields)
+        if (history and event in ('finished', 'failed') and not step.steps
+                and fields.get('duration') is not None):
+            history.record(fields['step'], fields['duration'],
+                           _input_size(step) if fields['file'] else 0,
+                           fields['file'], event == 'failed', self.file)
+        if metrics:
+            metrics.observe(event, fields)
+
+    def _new_step(self, spec):
+        """Return a new Step from a checked spec, see add_many()."""
+        common = dict(parent=self, donetest=spec['donetest'],
+                      pretest=spec['pretest'], name=spec['name'],
+                      depends=spec['depends'], file_list=spec['file_list'])
+        if spec['kind'] == 'command':
+            return Command(spec['command'], spec['args'], spec['store'],
+                           **common)
+        if spec['kind'] == 'function':
+            for arg in FUNCTION_ARGS:
+                if spec.get(arg) is not None:
+                    common[arg] = spec[arg]
+            return Function(spec['command'], spec['args'], spec['store'],
+                            **common)
+        return PipelineStep(**common)
+
+    def _register(self, name, step, position=None):
+        """Store step as name and add it to the order.
+
+        :position: Insert before this position, default is at the end.
+        """
+        self.steps[name] = step
+        if position is None:
+            self.order.append(name)
+        else:
+            self.order.insert(position, name)
+        self._step_counts()[step.state] += 1
+        if step.state == 'failed':
+            self._failure_names().add(name)
+        if step.state != 'done':
+            if position is not None:
+                self._point_at(name)
+            elif self._pointer is None and self._scan is None:
+                self._pointer = name  # Anything stale is found when read
+        self._emit('added', step)
+
+    def _overhead(self):
+        """Return the phase timers, created if loaded from an old pickle."""
+        overhead = getattr(self, 'overhead', None)
+        if overhead is None:
+            self.overhead = overhead = Overhead()
+        return overhead
+
+    def get_counts(self):
+        """Return the number of steps in each state.
+
+        :returns: A dict of pending, running, done, and failed counts. A
+                  step with substeps is counted once, see Step.get_counts()
+                  for the substeps.
+        """
+        return dict(self._step_counts())
 
     def _get_current(self):
         """Set self.current to most recent 'Not run' or 'Failed' step."""
-        if self.order:
-            for step in self:
+        self.current = self._first_incomplete()
+
+    def _step_counts(self):
+        """Return the live state counts, counted once for old pickles."""
+        counts = self.__dict__.get('_counts')
+        if counts is None:
+            counts = self._counts = _count_states(self)
+        return counts
+
+    def _failure_names(self):
+        """Return the live set of failed step names."""
+        failures = self.__dict__.get('_failures')
+        if failures is None:
+            failures = self._failures = set(
+                name for name, step in self.steps.items() if step.failed)
+        return failures
+
+    def _step_changed(self, step, old, new):
+        """Update the counts and pointer when a step changes state."""
+        if self.steps.get(step.name) is not step:
+            return  # Not added yet
+        counts = self._step_counts()
+        counts[old] -= 1
+        counts[new] += 1
+        if new == 'failed':
+            self._failure_names().add(step.name)
+        elif old == 'failed':
+            self._failure_names().discard(step.name)
+        if new == 'done':
+            if self.__dict__.get('_pointer') == step.name:
+                self._pointer, self._scan = None, step.name
+        elif old == 'done':
+            self._point_at(step.name)
+
+    def _first_incomplete(self):
+        """Return the name of the first step that is not done, or None.
+
+        Changes only mark the pointer stale, it is worked out here. It only
+        moves forward from where it went stale, so finding it is O(1)
+        amortized over a run.
+        """
+        if self._scan is not None:
+            self._pointer = None
+            for position in range(self.order.index(self._scan),
+                                  len(self.order)):
+                step = self.steps[self.order[position]]
                 if not step.done or step.failed:
-                    self.current = step.name
-                    return
-        self.current = None
+                    self._pointer = step.name
+                    break
+            self._scan = None
+        if self._earlier:
+            for name in self._earlier:
+                step = self.steps.get(name)
+                if step is None or (step.done and not step.failed):
+                    continue  # Deleted or done since
+                if self._pointer is None or \
+                        self.order.index(name) < \
+                        self.order.index(self._pointer):
+                    self._pointer = name
+            self._earlier = []
+        return self._pointer
+
+    def _point_at(self, name):
+        """Move the pointer back to name, if it is earlier, when next read."""
+        self._earlier.append(name)
 
     def __getitem__(self, item):
         """Return a Step from self.steps."""
@@ -412,7 +1011,7 @@ class Pipeline(object):
 
     def __contains__(self, item):
         """Check in self.order."""
-        return True if item in self.order else False
+        return item in self.order
 
     def __iter__(self):
         """Iterate through steps."""
@@ -425,37 +1024,25 @@ class Pipeline(object):
 
     def __str__(self):
         """Simple information about the class."""
-        output = 'Pipeline:\n'
-        if self.steps:
-            names = ()
-            steps = ()
-            statuses = ()
-            for step in self.order:
-                names = names + (step,)
-                steps = steps + (self.order.index(step),)
-                stat = 'Done' if self.steps[step].done else 'Not run'
-                stat = 'FAILED' if self.steps[step].failed else stat
-                statuses = statuses + (stat,)
-            len1 = 7
-            len2 = max(len(i) for i in names) + 4
-            output = output + ('Step'.ljust(len1) + 'Name'.ljust(len2) +
-                               'Status\n')
-            for step in steps:
-                output = output + (str(step).ljust(len1) +
-                                   names[step].ljust(len2) +
-                                   statuses[step] + '\n')
-        else:
-            output = output + "No steps assigned"
-        return output
+        return ''.join(report.iter_table(self, list(enumerate(self))))
+
+    def __setstate__(self, state):
+        """Restore, converting the order of old pickles to a StepOrder."""
+        _upgrade_flags(state)
+        self.__dict__.update(state)
+        if not isinstance(self.order, StepOrder):
+            self.order = StepOrder(self.order)
+        # Find the first incomplete step again when it is next needed
+        self._pointer, self._earlier = None, []
+        self._scan = self.order[0] if self.order else None
 
     def __repr__(self):
         """Detailed information about the class."""
         output = ("<Pipeline(file={}, steps={}, " +
                   "done={}, failed={})>").format(
                       self.file,
-                      len(self.order),
-                      len([i for i in self.steps.values() if i.done]),
-                      len([i for i in self.steps.values() if i.failed]))
+                      len(self.order), self._step_counts()['done'],
+                      self._step_counts()['failed'])
         return output
 
     class PipelineError(logme.LoggingException):
@@ -528,6 +1115,11 @@ class Step(object):
         self.code        = None
         self.out         = None    # STDOUT or returned data
         self.err         = None    # STDERR only
+        self.resources   = None    # CPU, memory, and I/O from last run
+        self.worker      = None    # pid of the process of the last run
+        self.batched     = False   # Only Function steps can be batched
+        self.batch_size  = None
+        self.batch_bytes = None
         # Add parent if exists
         if isinstance(parent, (Pipeline, Step, None)):
             self.parent = parent  # The Pipeline object that created us
@@ -537,11 +1129,11 @@ class Step(object):
             self.parent = None
         self.logfile     = self.parent.logfile if self.parent else None
         self.loglev      = self.parent.loglev if self.parent \
-            else logme.MIN_LEVEL
+            else DEFAULT_LOGLEV
         # Make sure dependencies are stored as a list
         if isinstance(depends, str):
             self.depends = [depends]
-        elif isinstance(depends, tuple):
+        elif isinstance(depends, (tuple, list)):
             self.depends = list(depends)
         # Test the tests now to avoid frustration
         if donetest:
@@ -633,6 +1225,7 @@ class Step(object):
             else:
                 return False
 
+    @timed('donetest')
     def run_done_test(self, fail_step_on_error=False, raise_on_fail=True):
         """Run a fail test with run_test and set self.failed & self done."""
         if not self.donetest:
@@ -709,11 +1302,14 @@ class Step(object):
 
     def log(self, message, level='debug'):
         """Wrapper for logme log function."""
+        if not logme.enabled(level, self.loglev):
+            return
         args = {'level': level, 'min_level': self.loglev}
         if self.logfile:
             args.update({'logfile': self.logfile})
         message = self.name + ' > ' + str(message)
-        logme.log(message, **args)
+        with self._phase('log'):
+            logme.log(message, **args)
 
     ################
     #  Commenting  #
@@ -751,6 +1347,7 @@ class Step(object):
     #  Running  #
     #############
 
+    @timed('step_run_all')
     def run_all(self, force=False):
         """If multiple files, execute all substeps in serial.
 
@@ -774,35 +1371,52 @@ class Step(object):
             if self.parent:
                 self.parent.save()
         self.start_time = time.time()
-        for step in self.steps:
-            if step.donetest and not force:
-                step.run_done_test(fail_step_on_error=True,
-                                   raise_on_fail=False)
-            if force or not step.done:
-                step.run()
-            if self.parent:
-                self.parent.save()
+        self._emit('started')
+        if self.batched:
+            self._run_batches(force)
+        else:
+            for step in self.steps:
+                if step.donetest and not force:
+                    step.run_done_test(fail_step_on_error=True,
+                                       raise_on_fail=False)
+                if force or not step.done:
+                    step.run()
+                else:
+                    step._emit_skipped()
+                if self.parent:
+                    self.parent.save()
         self.end_time = time.time()
+        if getattr(self, 'profile', False):
+            self.merge_profiles()
         # Run the donetest if available
         if self._test_test(self.donetest):
             self.run_done_test(fail_step_on_error=True, raise_on_fail=True)
             if self.done and not force:
                 return
-        if False not in [i.done for i in self.steps]:
-            self.done   = True
-        if True in [i.failed for i in self.steps]:
-            self.done   = False
-            self.failed = True
-        else:
-            self.failed = False
+        self._set_from_substeps()
+        self._emit_finished()
         if self.parent:
             self.parent.save()
 
-    def run_parallel(self, threads=None, force=False):
+    @timed('run_parallel')
+    def run_parallel(self, threads=None, force=False, chunksize=None,
+                     order=None, retry=None):
         """If multiple files, execute all substeps in parallel.
 
-        :threads: Number of processes to run. If None, use all CPUs.
-        :force:   Run anyway even if already done.
+        Substeps are sent to the pool in chunks, the chunk size adapts to the
+        measured runtime of the substeps (see scheduler.Dispatcher), and
+        results are handled in the order that chunks complete.
+
+        :threads:   Number of processes to run. If None, use all CPUs.
+        :force:     Run anyway even if already done.
+        :chunksize: Use a fixed number of substeps per chunk instead of
+                    adapting. Batched steps always send one batch per chunk.
+        :order:     The order to dispatch substeps in, see order_substeps().
+                    None keeps the file_list order, 'size' or 'runtime' run
+                    the longest substeps first to shorten the total runtime.
+        :retry:     A scheduler.Retry, failed substeps it accepts are run
+                    again after its delay, without holding a worker while
+                    they wait.
         """
         # If no file list, abort parallel run
         if not self.file_list:
@@ -820,32 +1434,74 @@ class Step(object):
         if self.parent:
             self.parent.save()
 
-        # Initialize threads
-        pool = Pool(threads)
+        # Initialize threads, worker logs are written by the aggregator
+        from multiprocessing import Pool, cpu_count
+        threads = threads if threads else cpu_count()
+        with self._phase('pool_start'):
+            aggregator = logme.Aggregator().start()
+            pool = Pool(threads, initializer=logme.forward_to,
+                        initargs=(aggregator.queue,))
 
         # Run the threads
-        jobs = []
         self.start_time = time.time()
-        for step in self.steps:
-            if step.donetest and not force:
-                step.run_done_test(fail_step_on_error=False,
-                                   raise_on_fail=False)
-            if force or not step.done:
-                # Execution here
-                jobs.append((step, pool.apply_async(step._execute)))
-
-        # Block until all threads are done, handle multiple fails.
+        self._emit('started')
+        pending = self.order_substeps(self._pending_substeps(force), order)
+        for step in pending:
+            step._emit('queued')
+        if self.batched:
+            # One task per batch of files, the function splits the results
+            tasks     = [_pool_task(batch)
+                         for batch in self._get_batches(pending)]
+            chunksize = 1
+        else:
+            tasks = [_pool_task([step]) for step in pending]
+        dispatcher = Dispatcher(pool, threads, chunksize=chunksize)
+        self._emit('pool', workers=threads)
+        history = self._history()
+        if history is not None:
+            history.refresh()
+            expected  = dict((step.name, step._predict(history) or 0)
+                             for step in pending)
+            remaining = sum(expected.values())
+            left      = len(pending)
+
+        # Handle results as each chunk completes, handle multiple fails.
         failed_jobs = []
         exceptions  = {}
-        for step, job in jobs:
-            out = job.get()
-            try:
-                step._parse_return(out)
-            except Exception as e:
-                exceptions[step.name] = traceback.format_exc()
-            if step.failed:
-                failed_jobs.append(e)
+        attempts    = {}
+        try:
+            for chunk in timed_iter(self._overhead(), 'pool_wait',
+                                    dispatcher.run(_run_task, tasks)):
+                for batch, out in chunk:
+                    results = _task_results(batch, out)
+                    for step in _defer_retries(dispatcher, retry, attempts,
+                                               batch, results):
+                        try:
+                            step._parse_return(results[step.name],
+                                               save=False)
+                        except Exception:
+                            import traceback
+                            exceptions[step.name] = traceback.format_exc()
+                        if step.failed:
+                            failed_jobs.append(step.name)
+                        if history is not None:
+                            remaining -= expected[step.name]
+                            left      -= 1
+                if history is not None:
+                    self.log('{}: {} substeps left, ETA {}'.format(
+                        self.name, left, _format_seconds(remaining / threads)),
+                        level='info')
+                if self.parent:
+                    self.parent.save()
+        finally:
+            with self._phase('pool_stop'):
+                pool.close()
+                pool.join()
+                aggregator.stop()
+            self._emit('pool', workers=0)
         self.end_time = time.time()
+        if getattr(self, 'profile', False):
+            self.merge_profiles()
         if self.parent:
             self.parent.save()
         if failed_jobs:
@@ -859,13 +1515,8 @@ class Step(object):
         if self._test_test(self.donetest):
             self.run_done_test(fail_step_on_error=True, raise_on_fail=True)
         # Set as done only if all steps are done.
-        if False not in [i.done for i in self.steps]:
-            self.done   = True
-        if True in [i.failed for i in self.steps]:
-            self.done   = False
-            self.failed = True
-        else:
-            self.failed = False
+        self._set_from_substeps()
+        self._emit_finished()
         if self.parent:
             self.parent.save()
 
@@ -873,31 +1524,35 @@ class Step(object):
     #  Display  #
     #############
 
-    def get_steps(self, include_outputs=True):
+    def get_steps(self, include_outputs=False, failed=False, pattern=None,
+                  offset=0, limit=None):
         """Return detailed information about all substeps if it exists.
 
+        Use print_steps() for many substeps, it does not build the string.
+
         :include_outputs: Also print step.out and step.err
-        :returns:         None, just prints.
+        :failed:          Only show failed substeps
+        :pattern:         Only show substeps whose file matches this regex
+        :offset:          Skip this many matching substeps, for paging
+        :limit:           Show at most this many substeps
+        :returns:         String for printing
         """
-        if not self.file_list:
-            return 'No substeps in {}'.format(self)
-        if not self.steps:
-            self._create_substeps()
-        output = ''
-        for step in self.steps:
-            output = output + '\n\n' + str(step)
-            if include_outputs:
-                output = output + '\n' + step.get_outputs()
-        return output
+        return ''.join(report.iter_steps(self, include_outputs, failed,
+                                         pattern, offset, limit))
 
-    def print_steps(self, outfile=sys.stdout, include_outputs=True):
+    def print_steps(self, outfile=sys.stdout, include_outputs=False,
+                    failed=False, pattern=None, offset=0, limit=None):
         """Print detailed information about all substeps if it exists.
 
+        The substeps are written one at a time, see get_steps() for the
+        filters.
+
         :outfile:         File handle to write to
         :include_outputs: Also print step.out and step.err
         :returns:         None, just prints.
         """
-        outfile.write(self.get_steps(include_outputs) + '\n')
+        report.write(report.iter_steps(self, include_outputs, failed,
+                                       pattern, offset, limit), outfile)
 
     ###############
     #  Internals  #
@@ -911,6 +1566,58 @@ class Step(object):
         return str(dt.fromtimestamp(self.end_time) -
                    dt.fromtimestamp(self.start_time))
 
+    def predict_runtime(self):
+        """Return the expected runtime in seconds from the runtime history.
+
+        Substeps are predicted from their file size, a step with substeps is
+        the sum of its substeps.
+
+        :returns: Seconds, None if history is off or the step never ran.
+        """
+        history = self._history()
+        if history is None:
+            return None
+        history.refresh()
+        if self.file_list and not self.steps:
+            self._create_substeps()
+        return self._predict(history)
+
+    def get_eta(self, threads=1):
+        """Return the expected seconds until this step is done.
+
+        :threads: Number of workers substeps will be run on.
+        :returns: Seconds, None if history is off or the step never ran.
+        """
+        history = self._history()
+        if history is None:
+            return None
+        history.refresh()
+        if self.file_list and not self.steps:
+            self._create_substeps()
+        return self._get_eta(history, threads)
+
+    def get_resources(self):
+        """Return resource usage of the last run, None if not recorded.
+
+        For a step with substeps, CPU time, I/O and context switches are
+        summed over all substeps, maxrss is the largest of any substep.
+
+        :returns: A dictionary with utime and stime (seconds of user and
+                  system CPU), maxrss (peak resident memory in KB), inblock
+                  and oublock (filesystem blocks read and written), and
+                  nvcsw and nivcsw (voluntary and involuntary context
+                  switches).
+        """
+        if not self.steps:
+            return getattr(self, 'resources', None)
+        usages = [i.resources for i in self.steps
+                  if getattr(i, 'resources', None)]
+        if not usages:
+            return None
+        total = dict((k, sum(i[k] for i in usages)) for k in RUSAGE_FIELDS)
+        total['maxrss'] = max(i['maxrss'] for i in usages)
+        return total
+
     def get_outputs(self):
         """Return a formatted string containing self.out and self.err."""
         output = ''
@@ -920,7 +1627,8 @@ class Step(object):
             output = output + "\nSTDERR:\n{}".format(self.err)
         return output
 
-    def _parse_return(self, return_dict):
+    @timed('parse_return')
+    def _parse_return(self, return_dict, save=True):
         """Save all values in return_dict as attributes to self.
 
         This is required because multiprocessing doesn't preserve self in
@@ -929,21 +1637,347 @@ class Step(object):
         :return_dict: A dictionary of attributes to be added to self and
                       saved. If 'EXCEPTION' is in the dict, it will be raised
                       after saving is complete.
+        :save:        Save the parent after parsing, callers parsing many
+                      substeps at once can set False and save once at the end.
         """
         for k, v in return_dict.items():
             if k != 'EXCEPTION':
                 self.__setattr__(k, v)
-        if self.parent:
+        self._emit_finished(return_dict.get('failed', False))
+        if save and self.parent:
             self.parent.save()
         if 'EXCEPTION' in return_dict:
             raise return_dict['EXCEPTION']
 
+    def _pending_substeps(self, force=False):
+        """Run the substep donetests, return the substeps still to run."""
+        pending = []
+        for step in self.steps:
+            if step.donetest and not force:
+                step.run_done_test(fail_step_on_error=False,
+                                   raise_on_fail=False)
+            if force or not step.done:
+                pending.append(step)
+            else:
+                step._emit_skipped()
+        return pending
+
+    def _parallel_batches(self, force=False):
+        """Return the lists of steps to send to a pool to run this step.
+
+        Runs the pretest and donetests first, a step that is already done,
+        or whose substeps are all done, returns an empty list.
+        """
+        if not self._pre_exec():
+            return []
+        if self.done and not force:
+            self._emit_skipped()
+            return []
+        if not self.file_list:
+            self._emit('queued')
+            return [[self]]
+        if not self.steps:
+            self._create_substeps()
+        self.start_time = time.time()
+        self._emit('started')
+        pending = self._pending_substeps(force)
+        if not pending:
+            self._set_from_substeps()
+            self._emit_finished()
+            return []
+        for step in pending:
+            step._emit('queued')
+        if self.batched:
+            return self._get_batches(pending)
+        return [[step] for step in pending]
+
+    def _get_batches(self, steps):
+        """Split steps into lists of substeps using the batch limits."""
+        files = [i.name for i in steps]
+        by_name = dict(zip(files, steps))
+        return [[by_name[i] for i in chunk] for chunk in
+                chunk_files(files, self.batch_size, self.batch_bytes)]
+
+    def _run_batches(self, force=False):
+        """Run all substeps in serial, one function call per batch.
+
+        Substep donetests are run before and after each batch exactly as
+        they would be by run_all() for unbatched substeps.
+        """
+        pending = []
+        for step in self.steps:
+            if step.donetest and not force:
+                step.run_done_test(fail_step_on_error=True,
+                                   raise_on_fail=False)
+            if force or not step.done:
+                pending.append(step)
+            else:
+                step._emit_skipped()
+        for batch in self._get_batches(pending):
+            for step in batch:
+                step._emit('started')
+            with self._phase('execute'):
+                results = run_batch(self.command, self.args,
+                                    [i.name for i in batch])
+            error = None
+            for step in batch:
+                try:
+                    step._parse_return(results[step.name], save=False)
+                except Exception as e:
+                    error = error if error else e
+            if self.parent:
+                self.parent.save()
+            if error:
+                raise error
+            for step in batch:
+                if step.done:
+                    step._post_exec()
+            if self.parent:
+                self.parent.save()
+
+    def order_substeps(self, steps, order=None):
+        """Return steps sorted longest expected runtime first.
+
+        Starting the longest substeps first (LPT scheduling) stops the pool
+        from idling at the end of a run while one worker finishes a huge file.
+
+        :steps: A list of substeps, named by their file.
+        :order: None:      Keep the current order.
+                'size':    Largest input file first.
+                'runtime': Longest previous runtime first. Substeps that have
+                           not run before are predicted from the runtime
+                           history if enabled, otherwise estimated from their
+                           file size and the seconds per byte of those that
+                           have.
+                callable:  Called on every step, largest value first.
+        :returns: A new list.
+        """
+        if not order:
+            return list(steps)
+        if hasattr(order, '__call__'):
+            key = order
+        elif order == 'size':
+            key = _input_size
+        elif order == 'runtime':
+            sizes    = dict((step.name, _input_size(step)) for step in steps)
+            runtimes = dict((step.name, step.end_time - step.start_time)
+                            for step in steps
+                            if step.start_time and step.end_time)
+            known = sum(sizes[i] for i in runtimes)
+            rate  = sum(runtimes.values()) / known if known else 0
+            history = self._history()
+            if history is not None:
+                history.refresh()
+
+            def key(step):
+                """Previous runtime, prediction, or size based estimate."""
+                if step.name in runtimes:
+                    return runtimes[step.name]
+                if history is not None:
+                    predicted = history.predict(self.name, sizes[step.name])
+                    if predicted is not None:
+                        return predicted
+                return sizes[step.name] * rate if rate else sizes[step.name]
+        else:
+            raise self.StepError(('Invalid order: {}. Must be None, ' +
+                                  "'size', 'runtime', or a function").format(
+                                      order), self.logfile)
+        return sorted(steps, key=key, reverse=True)
+
+    ####################
+    #  State tracking  #
+    ####################
+
+    @property
+    def done(self):
+        """True if the step completed successfully."""
+        return self.__dict__.get('_done', False)
+
+    @done.setter
+    def done(self, value):
+        """Set done, updating the counts of the parent."""
+        self._set_flag('_done', value)
+
+    @property
+    def failed(self):
+        """True if the step failed."""
+        return self.__dict__.get('_failed', False)
+
+    @failed.setter
+    def failed(self, value):
+        """Set failed, updating the counts of the parent."""
+        self._set_flag('_failed', value)
+
+    @property
+    def running(self):
+        """True from when the step starts or is queued until it ends."""
+        return self.__dict__.get('_running', False)
+
+    @running.setter
+    def running(self, value):
+        """Set running, updating the counts of the parent."""
+        self._set_flag('_running', value)
+
+    @property
+    def state(self):
+        """One of 'pending', 'running', 'done', or 'failed'."""
+        flags = self.__dict__
+        if flags.get('_failed'):
+            return 'failed'
+        if flags.get('_done'):
+            return 'done'
+        return 'running' if flags.get('_running') else 'pending'
+
+    def get_counts(self):
+        """Return the number of substeps in each state.
+
+        :returns: A dict of pending, running, done, and failed counts, all 0
+                  if the step has no substeps.
+        """
+        return dict(self._substep_counts())
+
+    def _set_flag(self, flag, value):
+        """Set a state flag and tell the parent if the state changed."""
+        old = self.state
+        self.__dict__[flag] = value
+        parent = self.__dict__.get('parent')
+        if parent is not None:
+            new = self.state
+            if new != old:
+                parent._step_changed(self, old, new)
+
+    def _substep_counts(self):
+        """Return the live substep counts, recounted if steps changed."""
+        steps = self.steps or []
+        key   = (id(steps), len(steps))
+        if self.__dict__.get('_counted') != key:
+            self._counts  = _count_states(steps)
+            self._counted = key
+        return self._counts
+
+    def _step_changed(self, step, old, new):
+        """Update the substep counts when a substep changes state."""
+        steps = self.steps or []
+        if self.__dict__.get('_counted') == (id(steps), len(steps)):
+            self._counts[old] -= 1
+            self._counts[new] += 1
+
+    def _set_from_substeps(self):
+        """Set done and failed from the substep counts."""
+        counts = self._substep_counts()
+        if counts['done'] == len(self.steps):
+            self.done   = True
+        if counts['failed']:
+            self.done   = False
+            self.failed = True
+        else:
+            self.failed = False
+
+    def __setstate__(self, state):
+        """Restore, moving the state flags of old pickles."""
+        _upgrade_flags(state)
+        self.__dict__.update(state)
+
+    def _overhead(self):
+        """Return the phase timers of the pipeline, None if detached."""
+        pipeline = self._pipeline()
+        return pipeline._overhead() if pipeline is not None else None
+
+    def _phase(self, name):
+        """Return a context manager that times a phase, see overhead.py."""
+        overhead = self._overhead()
+        return overhead.phase(name) if overhead is not None else NULL_PHASE
+
+    def _history(self):
+        """Return the History of the pipeline, None if not enabled."""
+        pipeline = self._pipeline()
+        return getattr(pipeline, 'history', None) if pipeline else None
+
+    def _predict(self, history):
+        """Return the predicted runtime without refreshing history."""
+        if self.steps:
+            times = [i._predict(history) for i in self.steps]
+            times = [i for i in times if i is not None]
+            return sum(times) if times else None
+        if isinstance(self.parent, Step):
+            return history.predict(self.parent.name, _input_size(self))
+        return history.predict(self.name)
+
+    def _get_eta(self, history, threads=1):
+        """Return the expected seconds until done, see get_eta().
+
+        Substeps that have never run are assumed to take as long as the
+        average of those that have.
+        """
+        if self.done:
+            return 0.0
+        if not self.steps:
+            return self._predict(history)
+        times = [i._predict(history) for i in self.steps if not i.done]
+        known = [i for i in times if i is not None]
+        if not known:
+            return None
+        mean  = sum(known) / len(known)
+        times = [mean if i is None else i for i in times]
+        return max(sum(times) / max(int(threads), 1), max(times))
+
+    def _pipeline(self):
+        """Return the Pipeline this step belongs to, None if detached."""
+        parent = self.parent
+        while parent is not None and not isinstance(parent, Pipeline):
+            parent = getattr(parent, 'parent', None)
+        return parent
+
+    def _emit(self, event, **fields):
+        """Write an event about this step to the pipeline event log."""
+        if event in ('started', 'queued'):
+            self.running = True
+        pipeline = self._pipeline()
+        if pipeline is not None and (getattr(pipeline, 'events', None) or
+                                     getattr(pipeline, 'metrics', None) or
+                                     getattr(pipeline, 'history', None)):
+            pipeline._emit(event, self, **fields)
+
+    def _emit_skipped(self):
+        """Emit a skipped event, the reason depends on the donetest."""
+        self._emit('skipped', reason='donetest' if self.donetest and
+                   not self.failed_done else 'done')
+
+    def _emit_finished(self, failed=None):
+        """Emit a finished or failed event with the run times."""
+        self.running = False
+        failed = self.failed if failed is None else failed
+        fields = {'start_time': self.start_time, 'end_time': self.end_time,
+                  'duration': None, 'code': self.code,
+                  'resources': self.get_resources()}
+        if self.start_time and self.end_time:
+            fields['duration'] = self.end_time - self.start_time
+        self._emit('failed' if failed else 'finished', **fields)
+
+    def _detach(self):
+        """Return a shallow copy without parent or substeps.
+
+        This is what gets pickled and sent to the pool, a substep with its
+        parent attached would pickle the entire pipeline for every task.
+        """
+        step = copy.copy(self)
+        step.parent = None
+        step.steps  = None
+        return step
+
+    @timed('create_substeps')
     def _create_substeps(self):
         """Use self.file_list to add sub_steps to self."""
         if not self.file_list:
             raise self.StepError('Cannot add substeps without a file list')
         if not self.steps:
             self.steps = []  # Make sure steps is a list
+        pipeline = self._pipeline()
+        with pipeline.defer_save() if pipeline is not None else NULL_PHASE:
+            self._add_substeps()
+
+    def _add_substeps(self):
+        """Create a substep for every file, see _create_substeps()."""
         for file in self.file_list:
             file = str(file)
             # If args exist, replace REGEX in args, ignore command.
@@ -973,7 +2007,8 @@ class Step(object):
                 self.steps.append(Function(
                     step_command, step_args, store=self.store, parent=self,
                     donetest=donetest, pretest=pretest, name=file,
-                    depends=self.depends, file_list=None))
+                    depends=self.depends, file_list=None,
+                    profile=getattr(self, 'profile', False)))
 
     def _test_test(self, test):
         """Test a single test instance to make sure it is usable.
@@ -1011,6 +2046,7 @@ class Step(object):
                         return False
         return True
 
+    @timed('pre_exec')
     def _pre_exec(self):
         """A shortcut to hold standard pretest and donetest calls."""
         # Run pretest first if available
@@ -1023,6 +2059,7 @@ class Step(object):
             self.run_done_test(fail_step_on_error=False, raise_on_fail=False)
         return True
 
+    @timed('post_exec')
     def _post_exec(self):
         """A shortcut to hold standard post exec stuff."""
         # Run the donetest if available
@@ -1070,6 +2107,18 @@ class Step(object):
                 'Ran on:',
                 time.ctime(self.start_time))
             output = output + "\n{0:<11}{1}".format('Runtime:', timediff)
+            usage = self.get_resources()
+            if usage:
+                output = output + "\n{0:<11}{1:.3f}s user, {2:.3f}s sys".format(
+                    'CPU time:', usage['utime'], usage['stime'])
+                output = output + "\n{0:<11}{1} KB".format(
+                    'Max RSS:', usage['maxrss'])
+                output = output + "\n{0:<11}{1} in, {2} out".format(
+                    'Blocks:', usage['inblock'], usage['oublock'])
+                output = output + ("\n{0:<11}{1} voluntary, {2} " +
+                                   "involuntary").format(
+                                       'Switches:', usage['nvcsw'],
+                                       usage['nivcsw'])
             output = output + "\n{0:<11}{1}".format(
                 'Output:', 'True' if self.out else 'False')
             output = output + "\n{0:<11}{1}".format(
@@ -1148,11 +2197,29 @@ class Function(Step):
 
     NOTE: The command argument must be an actual function handle,
           not a string
+
+    If batched is True, a step with a file_list calls the function once per
+    batch of files instead of once per file. Every arg containing '<StepFile>'
+    is replaced with a list (one entry per file in the batch) and the function
+    must return a dictionary of file->output. Files missing from the returned
+    dictionary, or mapped to an Exception, are marked failed. Batches are
+    limited by batch_size (number of files) and batch_bytes (total size of the
+    files), if neither is set all files are passed in a single call.
+
+    If profile is True the function is run under cProfile and the stats are
+    written to <pickle_file>.profiles/<name>.prof, substeps are written to
+    <pickle_file>.profiles/<name>/<file>.prof and merged into <name>.prof
+    after every run. If profile is 'memory', a tracemalloc snapshot is also
+    written to a .snapshot file next to every .prof file (these are not
+    merged). Load them with pstats.Stats() and
+    tracemalloc.Snapshot.load(). Profiling is not supported for batched
+    steps.
     """
 
     def __init__(self, function, args=None, store=True, parent=None,
                  donetest=None, pretest=None, name='unknown function',
-                 depends=None, file_list=None):
+                 depends=None, file_list=None, batched=False, batch_size=None,
+                 batch_bytes=None, profile=False):
         """Build the function."""
         # Make sure function is callable
         if not hasattr(function, '__call__'):
@@ -1160,12 +2227,22 @@ class Function(Step):
                                   'is of type {}').format(function,
                                                           type(function)),
                                  self.logfile)
+        if batched and not file_list:
+            raise self.StepError('batched requires a file_list')
+        if profile not in (False, None, True, 'cpu', 'memory'):
+            raise self.StepError("profile must be True, 'cpu', or 'memory'")
+        if batched and profile:
+            raise self.StepError('Cannot profile batched steps')
+        self.profile = profile  # Set before substeps are created
         # Make sure args are a tuple
         if args:
             if not isinstance(args, tuple):
                 args = (args,)
         super(Function, self).__init__(function, args, store, parent, donetest,
                                        pretest, name, depends, file_list)
+        self.batched     = bool(batched)
+        self.batch_size  = batch_size
+        self.batch_bytes = batch_bytes
 
     def run(self, kind='', parallel=False):
         """Execute the function with the provided args.
@@ -1188,6 +2265,7 @@ class Function(Step):
             kind = 'get' if self.store else 'check'
 
         # Run the function
+        self._emit('started')
         self._parse_return(self._execute(kind))
 
         if self.parent:
@@ -1199,10 +2277,16 @@ class Function(Step):
         if self.parent:
             self.parent.save()
 
+    @timed('execute')
     def _execute(self, kind=''):
         """Actually execute the function and return a dictionary of values."""
-        return_dict = {'start_time': time.time()}
+        return_dict = {'start_time': time.time(), 'worker': os.getpid()}
         args = (self.command, self.args) if self.args else (self.command,)
+        before = get_rusage('self')
+        profile_file = self._profile_file()
+        if profile_file:
+            profiler = _Profiler(profile_file, self.profile == 'memory')
+            profiler.start()
         try:
             return_dict['out'] = run_function(*args)
         except Exception as e:
@@ -1212,9 +2296,55 @@ class Function(Step):
             return_dict['done'] = True
         finally:
             return_dict['end_time'] = time.time()
+            return_dict['resources'] = rusage_delta(before,
+                                                    get_rusage('self'))
+            if profile_file:
+                return_dict['profile_stats'] = profiler.stop()
 
         return return_dict
 
+    def merge_profiles(self):
+        """Merge the profiles of all substeps into one .prof file.
+
+        :returns: The path to the merged file, None if no profiles exist.
+        """
+        if not self.steps:
+            return getattr(self, 'profile_stats', None)
+        if not getattr(self, 'profile', False):
+            return None
+        files = [i.profile_stats for i in self.steps
+                 if getattr(i, 'profile_stats', None) and
+                 os.path.exists(i.profile_stats)]
+        if not files:
+            return None
+        import pstats
+        stats = pstats.Stats(*files)
+        self.profile_stats = self._profile_file() + '.prof'
+        stats.dump_stats(self.profile_stats)
+        return self.profile_stats
+
+    def _profile_file(self):
+        """Return the path to write profiles to, without extension.
+
+        None if this step is not profiled.
+        """
+        if not getattr(self, 'profile', False):
+            return None
+        pipeline = self._pipeline()
+        if pipeline is None:
+            return getattr(self, 'profile_to', None)  # Set by _detach
+        directory = pipeline.file + '.profiles'
+        if isinstance(self.parent, Step):
+            return os.path.join(directory, _safe_name(self.parent.name),
+                                _safe_name(self.name))
+        return os.path.join(directory, _safe_name(self.name))
+
+    def _detach(self):
+        """Return a shallow copy without parent, keep the profile path."""
+        step = super(Function, self)._detach()
+        step.profile_to = self._profile_file()
+        return step
+
 
 class Command(Step):
 
@@ -1264,6 +2394,7 @@ class Command(Step):
         self._pre_exec()
 
         # Actually execute
+        self._emit('started')
         self._parse_return(self._execute(kind))
 
         if self.parent:
@@ -1285,9 +2416,10 @@ class Command(Step):
         if self.parent:
             self.parent.save()
 
+    @timed('execute')
     def _execute(self, kind=''):
         """Actually execute the command and return a dictionary of values."""
-        return_dict = {}
+        return_dict = {'worker': os.getpid()}
         # Set kind from storage option
         if not kind:
             kind = 'get' if self.store else 'check'
@@ -1299,8 +2431,7 @@ class Command(Step):
             elif isinstance(self.args, str):
                 args = self.args
             else:
-                raise self.StepError('Invalid argument type',
-                                     self.parent.logfile)
+                raise self.StepError('Invalid argument type', self.logfile)
             command = self.command + ' ' + args
         else:
             command = self.command
@@ -1308,12 +2439,20 @@ class Command(Step):
         # Actually run the command
         return_dict['start_time'] = time.time()
         try:
-            if kind == 'get':
-                (return_dict['code'],
-                 return_dict['out'],
-                 return_dict['err']) = run_cmd(command)
-            elif kind == 'check':
-                return_dict['code'] = call(command, shell=True)
+            if resource is None:
+                if kind == 'get':
+                    (return_dict['code'],
+                     return_dict['out'],
+                     return_dict['err']) = run_cmd(command)
+                elif kind == 'check':
+                    from subprocess import call
+                    return_dict['code'] = call(command, shell=True)
+            else:
+                (return_dict['code'], out, err,
+                 return_dict['resources']) = run_cmd_rusage(
+                     command, capture=kind == 'get')
+                if kind == 'get':
+                    return_dict['out'], return_dict['err'] = out, err
         except Exception as e:
             return_dict['failed'] = True
             return_dict['EXCEPTION'] = e
@@ -1416,6 +2555,7 @@ def run_cmd(cmd):
 
     cmd is run with shell, so must be a string.
     """
+    from subprocess import Popen, PIPE
     pp = Popen(str(cmd), shell=True, universal_newlines=True,
                stdout=PIPE, stderr=PIPE)
     out, err = pp.communicate()
@@ -1427,6 +2567,278 @@ def run_cmd(cmd):
     return code, out, err
 
 
+class _ParallelRun(object):
+
+    """The dependencies and progress of a Pipeline.run_parallel() call."""
+
+    def __init__(self, pipeline, job_list, dispatcher, retry=None,
+                 force=False):
+        """Find the dependencies of every job that are not done yet.
+
+        :raises: PipelineError if a dependency is not a step, or is neither
+                 done nor in job_list.
+        """
+        self.pipeline   = pipeline
+        self.order      = job_list
+        self.dispatcher = dispatcher
+        self.retry      = retry
+        self.force      = force
+        self.blocked    = {}  # Job: dependencies not done, until queued
+        self.dependents = {}  # Job: jobs that depend on it
+        self.remaining  = {}  # Queued job: substeps not finished
+        self.attempts   = {}  # id(step): runs so far, see _defer_retries
+        self.exceptions = {}  # Step or 'step: substep': traceback
+        jobs = set(job_list)
+        for name in job_list:
+            self.blocked[name] = set()
+            for depend in pipeline.steps[name].depends:
+                if depend not in pipeline.steps:
+                    raise pipeline.PipelineError(
+                        '{} depends on {}, which is not a step'.format(
+                            name, depend), pipeline.logfile)
+                if depend in jobs:
+                    self.blocked[name].add(depend)
+                    self.dependents.setdefault(depend, []).append(name)
+                elif not pipeline.steps[depend].done:
+                    raise pipeline.PipelineError(
+                        ('{} depends on {}, which is not done and not in ' +
+                         'job_list').format(name, depend), pipeline.logfile)
+
+    def start(self):
+        """Queue every job that has no dependencies left."""
+        ready = [i for i in self.order if not self.blocked[i]]
+        for name in ready:
+            del self.blocked[name]
+        self._queue(ready)
+
+    def handle(self, chunk):
+        """Parse the results of a chunk, then queue the jobs it releases."""
+        released = []
+        for batch, out in chunk:
+            results = _task_results(batch, out)
+            for step in _defer_retries(self.dispatcher, self.retry,
+                                       self.attempts, batch, results):
+                job = step.parent if isinstance(step.parent, Step) else step
+                try:
+                    step._parse_return(results[step.name], save=False)
+                except Exception:
+                    self._error(step)
+                self.remaining[job.name] -= 1
+                if not self.remaining[job.name]:
+                    del self.remaining[job.name]
+                    self._finish(job)
+                    released.extend(self._release(job))
+        self._queue(released)
+        self.pipeline.save()
+
+    def _queue(self, names):
+        """Send the tasks of jobs to the pool, finish jobs with none."""
+        names = list(names)
+        while names:
+            step = self.pipeline.steps[names.pop(0)]
+            try:
+                batches = step._parallel_batches(self.force)
+            except Exception:
+                self._error(step)
+                continue
+            if batches:
+                self.remaining[step.name] = sum(len(i) for i in batches)
+                self.dispatcher.add([_pool_task(i) for i in batches])
+            else:
+                names.extend(self._release(step))
+
+    def _finish(self, step):
+        """Run the donetest of a job whose tasks are all parsed."""
+        try:
+            if step.steps:
+                step.end_time = time.time()
+                if step._test_test(step.donetest):
+                    step.run_done_test(fail_step_on_error=True,
+                                       raise_on_fail=True)
+                step._set_from_substeps()
+                step._emit_finished()
+            elif step.done:
+                step._post_exec()
+        except Exception:
+            self._error(step)
+
+    def _release(self, step):
+        """Return the jobs that can run now that step is finished."""
+        if not step.done:
+            return []
+        ready = []
+        for name in self.dependents.get(step.name, ()):
+            self.blocked[name].discard(step.name)
+            if not self.blocked[name]:
+                del self.blocked[name]
+                ready.append(name)
+        return ready
+
+    def _error(self, step):
+        """Keep the traceback of the exception being handled for step."""
+        import traceback
+        name = step.name
+        if isinstance(step.parent, Step):
+            name = '{}: {}'.format(step.parent.name, step.name)
+        self.exceptions[name] = traceback.format_exc()
+
+
+class _Profiler(object):
+
+    """Run cProfile, and optionally tracemalloc, and write the results."""
+
+    def __init__(self, path, memory=False):
+        """Set the output path, without extension."""
+        import cProfile
+        self.path     = path
+        self.memory   = memory
+        self.profiler = cProfile.Profile()
+        self.tracing  = False
+
+    def start(self):
+        """Start profiling."""
+        if self.memory:
+            import tracemalloc  # Python 3.4+, only needed for memory
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+        self.profiler.enable()
+
+    def stop(self):
+        """Stop profiling and write the files, return the .prof path."""
+        self.profiler.disable()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # Made by another worker
+        if self.memory:
+            import tracemalloc
+            tracemalloc.take_snapshot().dump(self.path + '.snapshot')
+            if self.tracing:
+                tracemalloc.stop()
+        self.profiler.dump_stats(self.path + '.prof')
+        return self.path + '.prof'
+
+
+def _safe_name(name):
+    """Make a step or file name safe to use as a file name."""
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', str(name)).strip('_') or 'step'
+
+
+def run_cmd_rusage(cmd, capture=True):
+    """Run command and return status, output, stderr, and resource usage.
+
+    Like run_cmd(), but the child is reaped with os.wait4() so the resource
+    usage is exactly that of this command (and its own children).
+
+    :capture: Capture STDOUT and STDERR, otherwise they are inherited and
+              out and err are None.
+    :returns: code, out, err, resources (see Step.get_resources())
+    """
+    from subprocess import Popen, PIPE
+    pipe = PIPE if capture else None
+    pp = Popen(str(cmd), shell=True, universal_newlines=True,
+               stdout=pipe, stderr=pipe)
+    outputs = {}
+    readers = []
+
+    def read(name, stream):
+        """Read all of stream into outputs[name]."""
+        outputs[name] = stream.read()
+
+    if capture:
+        # Read both pipes in threads so neither can fill up and block
+        for name, stream in (('out', pp.stdout), ('err', pp.stderr)):
+            reader = threading.Thread(target=read, args=(name, stream))
+            reader.start()
+            readers.append(reader)
+    for reader in readers:
+        reader.join()
+    _, status, usage = os.wait4(pp.pid, 0)
+    if os.WIFSIGNALED(status):
+        code = -os.WTERMSIG(status)
+    else:
+        code = os.WEXITSTATUS(status)
+    pp.returncode = code
+    out = err = None
+    if capture:
+        pp.stdout.close()
+        pp.stderr.close()
+        out, err = outputs['out'], outputs['err']
+        if out[-1:] == '\n':
+            out = out[:-1]
+        if err[-1:] == '\n':
+            err = err[:-1]
+    return code, out, err, _rusage_dict(usage)
+
+
+def get_rusage(who='self'):
+    """Return resource usage of this process ('self') or its 'children'.
+
+    :returns: A dictionary of RUSAGE_FIELDS, None if resource is missing.
+    """
+    if resource is None:
+        return None
+    return _rusage_dict(resource.getrusage(
+        resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN))
+
+
+def rusage_delta(before, after):
+    """Return the usage between two get_rusage() calls.
+
+    maxrss is a peak, not a counter, so the value from after is kept.
+    """
+    if before is None or after is None:
+        return None
+    delta = dict((k, after[k] - before[k]) for k in RUSAGE_FIELDS)
+    delta['maxrss'] = after['maxrss']
+    return delta
+
+
+def _rusage_dict(usage):
+    """Convert a struct_rusage into a dictionary, maxrss in KB."""
+    result = dict((k, getattr(usage, 'ru_' + k)) for k in RUSAGE_FIELDS)
+    if sys.platform == 'darwin':
+        result['maxrss'] = result['maxrss'] // 1024  # Bytes on macOS
+    return result
+
+
+def _run_tests(tests, threads=CHECK_THREADS, processes=False):
+    """Run many donetests at once, see Pipeline.check_all().
+
+    :returns: A list of (passed, error message or None), in order.
+    """
+    if threads < 2 or len(tests) < 2:
+        return [_run_check(i) for i in tests]
+    if processes:
+        from concurrent.futures import ProcessPoolExecutor as Executor
+    else:
+        from concurrent.futures import ThreadPoolExecutor as Executor
+    executor = Executor(max_workers=min(threads, len(tests)))
+    # chunksize saves round trips for processes, it is new in Python 3.5
+    options = {}
+    if processes and sys.version_info >= (3, 5):
+        options['chunksize'] = max(len(tests) // (threads * 4), 1)
+    try:
+        return list(executor.map(_run_check, tests, **options))
+    finally:
+        executor.shutdown()
+
+
+def _run_check(test):
+    """Run a single donetest, passes like Step.run_test()."""
+    try:
+        if isinstance(test, tuple):
+            out = run_function(*test)
+        else:
+            out = run_function(test)
+    except Exception as err:
+        return False, '{}: {}'.format(type(err).__name__, err)
+    return out is True or (out == 0 and not isinstance(out, bool)), None
+
+
 def run_function(function_call, args=None):
     """Run a function with args and return output."""
     if not hasattr(function_call, '__call__'):
@@ -1444,17 +2856,275 @@ def run_function(function_call, args=None):
     return out
 
 
+def _count_states(steps):
+    """Return a dict of the number of steps in each state."""
+    counts = dict((i, 0) for i in STATES)
+    for step in steps:
+        counts[step.state] += 1
+    return counts
+
+
+def _upgrade_flags(state):
+    """Move done and failed of pickles from older versions to _done etc."""
+    for flag in ('done', 'failed', 'running'):
+        if flag in state:
+            state['_' + flag] = state.pop(flag)
+
+
+def _command_name(program):
+    """Return the default step name for a command."""
+    return program.split(' ')[0].split('/')[-1]
+
+
+def _function_name(function_call):
+    """Return the default step name for a function."""
+    parts = str(function_call).strip('<>').split(' ')
+    parts.remove('function')
+    try:
+        parts.remove('built-in')
+    except ValueError:
+        pass
+    return parts[0]
+
+
+def _parse_spec(spec):
+    """Return an add_many() spec as a dict with every add() argument.
+
+    Problems that stop the spec being read are returned in 'error'.
+    """
+    if isinstance(spec, dict):
+        parsed = dict((k, None if _missing(v) else v)
+                      for k, v in spec.items())
+    elif isinstance(spec, (tuple, list)):
+        if len(spec) > len(ADD_ARGS):
+            return {'error': 'Too many values in spec: {}'.format(spec)}
+        parsed = dict(zip(ADD_ARGS, spec))
+    else:
+        return {'error': 'Spec must be a tuple or dict: {}'.format(spec)}
+    unknown = set(parsed) - set(ADD_ARGS) - set(FUNCTION_ARGS)
+    if unknown:
+        return {'error': 'Unknown arguments {} in spec: {}'.format(
+            sorted(unknown), spec)}
+    for arg in ADD_ARGS:
+        parsed.setdefault(arg, None)
+    if parsed['store'] is None:
+        parsed['store'] = True
+    command = parsed['command']
+    if not parsed['kind']:
+        parsed['kind'] = 'command' if isinstance(command, str) else 'function'
+    if not parsed['name'] and command:
+        if parsed['kind'] == 'command' and isinstance(command, str):
+            parsed['name'] = _command_name(command)
+        elif parsed['kind'] == 'function':
+            parsed['name'] = _function_name(command)
+    elif not parsed['name']:
+        parsed['name'] = 'unknown pipeline'
+    return parsed
+
+
+def _check_spec(spec):
+    """Return a description of the problem with a parsed spec, or None.
+
+    Resolves the executable of single word commands with get_path().
+    """
+    kind    = spec['kind']
+    command = spec['command']
+    if kind not in ('command', 'function', 'pipeline'):
+        return 'invalid step type: {}'.format(kind)
+    if kind != 'pipeline' and not command:
+        return 'no command or function call'
+    if kind != 'function' and any(spec.get(i) is not None
+                                  for i in FUNCTION_ARGS):
+        return 'batched and profile are only for functions'
+    if kind == 'function' and not hasattr(command, '__call__'):
+        return 'function must be callable'
+    if kind == 'command':
+        if not isinstance(command, str):
+            return 'command must be a string'
+        if len(command.split(' ')) == 1:
+            try:
+                get_path(command)
+            except PathError:
+                return '{} is not in your path'.format(command)
+        elif spec['args']:
+            return 'cannot have a multi-word command and args'
+    if spec['file_list'] and not isinstance(spec['file_list'],
+                                            (str, list, tuple)):
+        return 'file_list must be a str, list, or tuple'
+    return None
+
+
+def _missing(value):
+    """True if value is a missing (NaN) table value."""
+    return isinstance(value, float) and value != value
+
+
+def _input_size(step):
+    """Return the size of the file a substep is named for, 0 if missing."""
+    try:
+        return os.path.getsize(step.name)
+    except OSError:
+        return 0
+
+
+def _format_seconds(seconds):
+    """Return seconds as Hours:Minutes:Seconds."""
+    return str(timedelta(seconds=int(round(max(seconds, 0)))))
+
+
+def _execute_step(step):
+    """Run step._execute() in a pool worker."""
+    return step._execute()
+
+
+def _run_task(task):
+    """Run a (function, payload) task from _pool_task() in a pool worker."""
+    function, payload = task
+    return function(payload)
+
+
+def _pool_task(batch):
+    """Return the Dispatcher (key, payload) task to run a list of steps.
+
+    The substeps of a batched step are run with one function call, any
+    other list holds a single step.
+    """
+    if _is_batch(batch):
+        parent = batch[0].parent
+        return batch, (_run_batch_task, (parent.command, parent.args,
+                                         [i.name for i in batch]))
+    # Send detached copies, otherwise the whole pipeline is pickled
+    return batch, (_execute_step, batch[0]._detach())
+
+
+def _is_batch(batch):
+    """True if batch is run by a single batched function call."""
+    parent = batch[0].parent
+    return isinstance(parent, Step) and parent.batched
+
+
+def _task_results(batch, out):
+    """Return {step name: return_dict} from the output of a pool task."""
+    if isinstance(out, Exception):
+        out = {'failed': True, 'EXCEPTION': out}
+        return dict((i.name, out) for i in batch)
+    if _is_batch(batch):
+        return out
+    return {batch[0].name: out}
+
+
+def _defer_retries(dispatcher, retry, attempts, batch, results):
+    """Send the steps of batch that retry accepts back to the dispatcher.
+
+    The retried steps wait in the dispatcher, not in a worker, and are sent
+    as one new task.
+
+    :attempts: {id(step): runs so far} of retried steps, updated.
+    :returns:  The steps of batch that are not retried, to be parsed.
+    """
+    if retry is None:
+        return batch
+    again = [i for i in batch if retry.should_retry(
+        results[i.name], attempts.get(id(i), 1))]
+    if not again:
+        return batch
+    attempt = max(attempts.get(id(i), 1) for i in again)
+    wait    = retry.wait(attempt)
+    for step in again:
+        attempts[id(step)] = attempts.get(id(step), 1) + 1
+        result = results[step.name]
+        step.log('Failed{}, try {} of {} in {:.1f}s'.format(
+            ' with code {}'.format(result['code'])
+            if result.get('code') is not None else '',
+            attempts[id(step)], retry.tries, wait), 'warn')
+        step._emit('retry', attempt=attempts[id(step)], delay=wait,
+                   code=result.get('code'))
+    dispatcher.defer(_pool_task(again), wait)
+    retried = set(id(i) for i in again)
+    return [i for i in batch if id(i) not in retried]
+
+
+def _run_batch_task(task):
+    """Run run_batch() on a (function_call, args, files) tuple."""
+    return run_batch(*task)
+
+
+def run_batch(function_call, args, files):
+    """Run function_call once on a batch of files and split the output.
+
+    Every arg containing REGEX is replaced with a list, one entry per file.
+    function_call must return a dictionary of file->output.
+
+    :returns: A dictionary of file->return_dict, each return_dict is in the
+              format returned by Function._execute().
+    """
+    start_time = time.time()
+    before = get_rusage('self')
+    try:
+        out = run_function(function_call, sub_batch_args(args, REGEX, files))
+        if not isinstance(out, dict):
+            raise FunctionError(('Batched function {} must return a dict, ' +
+                                 'not {}').format(function_call, type(out)))
+    except Exception as e:
+        end_time = time.time()
+        return dict((file, {'start_time': start_time, 'end_time': end_time,
+                            'worker': os.getpid(), 'failed': True,
+                            'EXCEPTION': e})
+                    for file in files)
+    end_time = time.time()
+    # Resource use is split evenly between the files, except memory
+    resources = rusage_delta(before, get_rusage('self'))
+    if resources:
+        for k in RUSAGE_FIELDS:
+            if k != 'maxrss':
+                resources[k] = resources[k] / len(files)
+    return_dicts = {}
+    for file in files:
+        return_dict = {'start_time': start_time, 'end_time': end_time,
+                       'resources': resources, 'worker': os.getpid()}
+        if file not in out:
+            return_dict['failed'] = True
+            return_dict['err'] = 'No output returned for {}'.format(file)
+        elif isinstance(out[file], Exception):
+            return_dict['failed'] = True
+            return_dict['err'] = repr(out[file])
+        else:
+            return_dict['out'] = out[file]
+            return_dict['done'] = True
+        return_dicts[file] = return_dict
+    return return_dicts
+
+
 def get_path(executable, log=None):
     """Use `which` to get the path of an executable.
 
+    Inside a _path_cache() block every executable is only looked up once.
+
     Raises PathError on failure
     :returns: Full absolute path on success
     """
+    if _PATHS is not None and executable in _PATHS:
+        return _PATHS[executable]
     code, out, err = run_cmd('which {}'.format(executable))
     if code != 0 or err == '{} not found'.format(executable):
         raise PathError('{} is not in your path'.format(executable), log)
-    else:
-        return os.path.abspath(out)
+    path = os.path.abspath(out)
+    if _PATHS is not None:
+        _PATHS[executable] = path
+    return path
+
+
+@contextmanager
+def _path_cache():
+    """Cache the results of get_path() inside the block."""
+    global _PATHS
+    outer = _PATHS
+    if outer is None:
+        _PATHS = {}
+    try:
+        yield
+    finally:
+        _PATHS = outer
 
 
 def build_file_list(file_regex, root='.'):
@@ -1522,6 +3192,63 @@ def sub_args(args, args_regex, sub):
         return step_args
 
 
+def sub_batch_args(args, args_regex, files):
+    """Replace every arg containing args_regex with a list, one per file.
+
+    :args:       tuple, list, or dict
+    :args_regex: r'' expression to replace
+    :files:      list of strings to replace regex with
+    :returns:    args, with every matching arg replaced by a list
+
+    """
+    step_regex = re.compile(args_regex)
+
+    def sub_one(arg):
+        """Return a list for matching args, else arg unchanged."""
+        if isinstance(arg, str) and step_regex.search(arg):
+            return [step_regex.sub(file, arg) for file in files]
+        return arg
+
+    if isinstance(args, (tuple, list)):
+        return tuple(sub_one(arg) for arg in args)
+    elif isinstance(args, dict):
+        return dict((k, sub_one(v)) for k, v in args.items())
+    return sub_one(args)
+
+
+def chunk_files(files, size=None, max_bytes=None):
+    """Split files into lists of at most size files or max_bytes bytes.
+
+    A single file larger than max_bytes is placed in a batch on its own.
+
+    :files:     list of file paths
+    :size:      Maximum number of files per chunk
+    :max_bytes: Maximum total file size per chunk
+    :returns:   list of lists
+
+    """
+    chunks = []
+    chunk  = []
+    total  = 0
+    for file in files:
+        nbytes = 0
+        if max_bytes:
+            try:
+                nbytes = os.path.getsize(file)
+            except OSError:
+                pass
+        if chunk and ((size and len(chunk) >= size) or
+                      (max_bytes and total + nbytes > max_bytes)):
+            chunks.append(chunk)
+            chunk = []
+            total = 0
+        chunk.append(file)
+        total += nbytes
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
 def sub_tests(test, test_regex, sub):
     """Run sub_args() on test objects.
 
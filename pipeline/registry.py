@@ -0,0 +1,192 @@
+"""
+An ordered, indexed list of step names.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-08 15:30
+ Last modified: 2016-04-08 15:30
+
+   DESCRIPTION: Pipeline.order used to be a tuple that was copied on every
+                add and delete and searched on every lookup. StepOrder keeps
+                the names in blocks of about LOAD names, with a dictionary
+                of name to block, so membership tests are a dictionary
+                lookup and appends are list appends. An insert or delete
+                only changes one block, and a position is the start of the
+                block plus the position in the block. The block starts are
+                worked out again when the blocks change, which is a pass
+                over the blocks, not the names, so any mix of inserts,
+                deletes, and lookups costs about one block each.
+
+                Iteration is over a copy of the names, so adding or deleting
+                steps while iterating does not change what is iterated, as
+                with the old tuple.
+
+         USAGE: order = StepOrder(['first', 'second'])
+                order.append('third')
+                order.insert(0, 'zeroth')
+                order.index('second')  # 2
+                order.remove('first')
+
+============================================================================
+"""
+from bisect import bisect_right as _bisect
+from itertools import chain as _chain
+
+__all__ = ['StepOrder']
+
+###############################################################################
+#                            Customizable constants                           #
+###############################################################################
+
+LOAD = 500  # Names per block, blocks are split at twice this
+
+
+class StepOrder(object):
+
+    """An ordered collection of unique names with fast lookup."""
+
+    def __init__(self, names=()):
+        """Create from an iterable of names, in order."""
+        self._blocks  = []    # Lists of names, in order
+        self._block   = {}    # name: the block it is in
+        self._starts  = None  # Position of the first name of every block
+        self._numbers = None  # id(block): position of the block
+        for name in names:
+            self.append(name)
+
+    def append(self, name):
+        """Add name to the end."""
+        if name in self._block:
+            raise ValueError('{} is already in the order'.format(name))
+        if not self._blocks or len(self._blocks[-1]) >= LOAD:
+            self._blocks.append([])
+            self._starts = None
+        self._blocks[-1].append(name)
+        self._block[name] = self._blocks[-1]
+
+    def insert(self, position, name):
+        """Add name before position, like list.insert()."""
+        if name in self._block:
+            raise ValueError('{} is already in the order'.format(name))
+        if position < 0:
+            position = max(len(self) + position, 0)
+        if position >= len(self):
+            self.append(name)
+            return
+        number, offset = self._locate(position)
+        block = self._blocks[number]
+        block.insert(offset, name)
+        self._block[name] = block
+        if len(block) >= 2 * LOAD:
+            tail = block[LOAD:]
+            del block[LOAD:]
+            self._blocks.insert(number + 1, tail)
+            for moved in tail:
+                self._block[moved] = tail
+        self._starts = None
+
+    def remove(self, name):
+        """Remove name, raises ValueError if missing."""
+        block = self._block.pop(name, None)
+        if block is None:
+            raise ValueError('{} is not in the order'.format(name))
+        block.remove(name)
+        if not block:
+            self._index()
+            number = self._numbers.get(id(block))
+            if number is not None:  # Not already dropped by _rebalance()
+                del self._blocks[number]
+        self._starts = None
+
+    def index(self, name):
+        """Return the position of name, raises ValueError if missing."""
+        if name not in self._block:
+            raise ValueError('{} is not in the order'.format(name))
+        self._index()  # Can move names to new blocks
+        block = self._block[name]
+        return self._starts[self._numbers[id(block)]] + block.index(name)
+
+    ###############
+    #  Internals  #
+    ###############
+
+    def _index(self):
+        """Work out the start of every block, only if the blocks changed."""
+        if self._starts is not None:
+            return
+        if len(self._blocks) > 2 * (len(self) // LOAD) + 2:
+            self._rebalance()
+        self._starts, self._numbers = [], {}
+        start = 0
+        for number, block in enumerate(self._blocks):
+            self._starts.append(start)
+            self._numbers[id(block)] = number
+            start += len(block)
+
+    def _rebalance(self):
+        """Refill the blocks after deletes left too many small ones."""
+        names = list(_chain.from_iterable(self._blocks))
+        self._blocks = [names[i:i + LOAD] for i in range(0, len(names), LOAD)]
+        for block in self._blocks:
+            for name in block:
+                self._block[name] = block
+
+    def _locate(self, position):
+        """Return (block number, position in the block) for a position."""
+        self._index()
+        number = _bisect(self._starts, position) - 1
+        return number, position - self._starts[number]
+
+    def __contains__(self, name):
+        """Dictionary lookup."""
+        return name in self._block
+
+    def __getitem__(self, position):
+        """Return the name at position, or a tuple for a slice."""
+        if isinstance(position, slice):
+            return tuple(self)[position]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('StepOrder index out of range')
+        number, offset = self._locate(position)
+        return self._blocks[number][offset]
+
+    def __iter__(self):
+        """Iterate over a copy of the names."""
+        return iter(tuple(_chain.from_iterable(self._blocks)))
+
+    def __len__(self):
+        """Number of names."""
+        return len(self._block)
+
+    def __eq__(self, other):
+        """Equal to any sequence with the same names in the same order."""
+        if isinstance(other, StepOrder):
+            other = tuple(other)
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        """Inverse of __eq__."""
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __getstate__(self):
+        """Pickle the names only."""
+        return {'names': tuple(self)}
+
+    def __setstate__(self, state):
+        """Rebuild the index."""
+        self.__init__(state['names'])
+
+    def __repr__(self):
+        """Show the names."""
+        return 'StepOrder({!r})'.format(tuple(self))
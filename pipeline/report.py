@@ -0,0 +1,180 @@
+"""
+Streaming, filtered reports of pipeline and substep state.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-08 17:20
+ Last modified: 2016-04-08 17:20
+
+   DESCRIPTION: Every report is a generator of string chunks, so a report
+                can be written to a file a step at a time without ever
+                holding the whole thing in memory, which matters with
+                hundreds of thousands of substeps. Pipeline.get_stats() and
+                Step.get_steps() just join the chunks, print_stats() and
+                print_steps() write them as they come.
+
+                Steps can be filtered to failed steps only and by a regular
+                expression on the step name (the file name for substeps),
+                and paged with offset and limit. When a page is full, the
+                report ends with the offset of the next page. Step outputs
+                (STDOUT and STDERR) are only included on request.
+
+         USAGE: project.print_stats(failed=True, limit=20)
+                project.print_stats(pattern='^align', offset=20, limit=20)
+                project['my_step'].print_steps(failed=True, limit=100)
+
+============================================================================
+"""
+import re
+from datetime import timedelta
+
+__all__ = ['iter_stats', 'iter_steps', 'iter_table', 'select', 'write']
+
+STATUSES = {'pending': 'Not run', 'running': 'Running', 'done': 'Done',
+            'failed': 'FAILED'}
+
+
+def iter_stats(pipeline, include_outputs=False, failed=False, pattern=None,
+               offset=0, limit=None, substep_limit=None):
+    """Yield the detailed stats of a pipeline in chunks.
+
+    :pipeline:        The Pipeline to report on.
+    :include_outputs: Also include step.out and step.err.
+    :failed:          Only include failed steps, and their failed substeps.
+    :pattern:         Only include steps whose name matches this regex.
+    :offset:          Skip this many matching steps.
+    :limit:           Include at most this many steps.
+    :substep_limit:   Include at most this many substeps of each step.
+    """
+    rows = list(select(pipeline, failed, pattern, offset, _more(limit)))
+    more = limit is not None and len(rows) > limit
+    if more:
+        rows.pop()
+    for chunk in iter_table(pipeline, rows):
+        yield chunk
+    yield '\n\n'
+    eta = pipeline.get_eta()
+    if eta is not None:
+        yield 'Estimated time remaining: {}\n\n'.format(
+            timedelta(seconds=int(round(max(eta, 0)))))
+    yield 'Individual step stats:'
+    for _, step in rows:
+        yield '\n\n' + str(step)
+        if include_outputs:
+            yield '\n' + step.get_outputs()
+        if step.file_list:
+            yield '\n\t'
+            for chunk in iter_steps(step, include_outputs, failed,
+                                    limit=substep_limit):
+                yield chunk.replace('\n', '\n\t')
+    if more:
+        yield _next_page(offset + limit)
+
+
+def iter_steps(step, include_outputs=False, failed=False, pattern=None,
+               offset=0, limit=None):
+    """Yield the details of every substep of step in chunks.
+
+    :step:            The Step to report on, substeps are created if needed.
+    :include_outputs: Also include substep.out and substep.err.
+    :failed:          Only include failed substeps.
+    :pattern:         Only include substeps whose file matches this regex.
+    :offset:          Skip this many matching substeps.
+    :limit:           Include at most this many substeps.
+    """
+    if not step.file_list:
+        yield 'No substeps in {}'.format(step)
+        return
+    if not step.steps:
+        step._create_substeps()
+    shown = 0
+    for _, substep in select(step.steps, failed, pattern, offset,
+                             _more(limit)):
+        if shown == limit:
+            yield _next_page(offset + limit)
+            return
+        shown += 1
+        yield '\n\n' + str(substep)
+        if include_outputs:
+            yield '\n' + substep.get_outputs()
+
+
+def iter_table(pipeline, rows):
+    """Yield the step table of str(pipeline) in chunks.
+
+    :pipeline: The Pipeline, used to tell an empty pipeline from no match.
+    :rows:     A list of (position, step) to include, see select().
+    """
+    yield 'Pipeline:\n'
+    if not pipeline.steps:
+        yield 'No steps assigned'
+        return
+    if not rows:
+        yield 'No matching steps\n'
+        return
+    len1 = 7
+    len2 = max(len(step.name) for _, step in rows) + 4
+    yield 'Step'.ljust(len1) + 'Name'.ljust(len2) + 'Status\n'
+    for position, step in rows:
+        yield (str(position).ljust(len1) + step.name.ljust(len2) +
+               STATUSES[step.state] + '\n')
+
+
+def select(steps, failed=False, pattern=None, offset=0, limit=None):
+    """Yield (position, step) for every step that passes the filters.
+
+    :steps:   An iterable of steps or substeps.
+    :failed:  Only yield failed steps, or steps with failed substeps.
+    :pattern: A regex string or compiled regex to search step names with.
+    :offset:  Skip this many matching steps.
+    :limit:   Stop after this many steps.
+    """
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern)
+    shown = 0
+    for position, step in enumerate(steps):
+        if failed and not _has_failed(step):
+            continue
+        if pattern and not pattern.search(step.name):
+            continue
+        if offset:
+            offset -= 1
+            continue
+        if shown == limit:
+            return
+        shown += 1
+        yield position, step
+
+
+def write(chunks, outfile):
+    """Write chunks to outfile as they are made, ending with a newline."""
+    for chunk in chunks:
+        outfile.write(chunk)
+    outfile.write('\n')
+
+
+###############################################################################
+#                              Private Functions                              #
+###############################################################################
+
+
+def _has_failed(step):
+    """True if the step or any of its substeps failed, without a scan."""
+    if step.failed:
+        return True
+    return bool(step.steps and step.get_counts()['failed'])
+
+
+def _more(limit):
+    """Ask for one row past limit, to know if there is a next page."""
+    return None if limit is None else limit + 1
+
+
+def _next_page(offset):
+    """Return the note that ends a full page."""
+    return '\n\nMore steps not shown, use offset={} for the next page'.format(
+        offset)
+
@@ -0,0 +1,263 @@
+"""
+Feed many small tasks to a multiprocessing pool in adaptive chunks.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-04 10:12
+ Last modified: 2016-04-04 10:12
+
+   DESCRIPTION: Submitting one apply_async per task and collecting results in
+                submission order means that with many sub-second tasks most
+                of the time is spent on IPC. The Dispatcher here groups tasks
+                into chunks, sizes the chunks from the measured per-task
+                runtime in the workers, and returns results as chunks
+                complete rather than in the order they were submitted.
+
+                Tasks can be added while the dispatcher runs, and failed
+                tasks can be deferred, to be run again after a delay. Delayed
+                tasks wait in a heap ordered by due time, not in the pool, so
+                they hold no worker and new results are still handled while
+                they wait. Retry decides whether a failure is worth another
+                try and how long to wait, with exponential backoff and
+                jitter so that tasks failing together do not retry together.
+
+         USAGE: pool = Pool(4)
+                dispatcher = Dispatcher(pool, 4)
+                retry = Retry(tries=3, delay=10, codes=(75,))
+                for chunk in dispatcher.run(function, tasks):
+                    for key, result in chunk:
+                        if retry.should_retry(result, attempt):
+                            dispatcher.defer((key, payload),
+                                             retry.wait(attempt))
+
+============================================================================
+"""
+import time
+import heapq
+import random
+from collections import deque
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+__all__ = ['Dispatcher', 'Retry']
+
+############################
+#  Customizable constants  #
+############################
+
+CHUNK_TARGET = 0.5  # Seconds of work to aim for in each chunk
+IN_FLIGHT    = 2    # Chunks in flight per worker
+TAIL_SPLIT   = 4    # Keep at least this many chunks per worker for the tail
+TRIES        = 5    # Default runs of a task, including the first
+DELAY        = 60   # Default seconds before the first retry
+BACKOFF      = 2    # Default multiplier of the delay for every retry
+MAX_DELAY    = 3600  # Longest wait between tries
+JITTER       = 0.5  # Waits are randomly up to this fraction longer or shorter
+
+
+class Dispatcher(object):
+
+    """Run tasks on a pool in chunks sized from measured task latency.
+
+    The first chunk for every worker contains a single task, after that the
+    chunk size is chosen so that a chunk takes about CHUNK_TARGET seconds,
+    based on a moving average of the per-task runtime reported by the
+    workers. Chunks are capped so that the remaining tasks are still split
+    into at least TAIL_SPLIT chunks per worker, which keeps the pool busy
+    when task durations vary a lot.
+    """
+
+    def __init__(self, pool, workers, chunksize=None, target=CHUNK_TARGET):
+        """Set up the dispatcher.
+
+        :pool:      A multiprocessing Pool.
+        :workers:   The number of processes in pool.
+        :chunksize: Use a fixed chunk size instead of adapting.
+        :target:    Seconds of work to aim for in each chunk.
+        """
+        self.pool      = pool
+        self.workers   = max(int(workers), 1)
+        self.chunksize = chunksize
+        self.target    = target
+        self.latency   = None  # Moving average of seconds per task
+        self.ready     = deque()  # (key, payload) waiting for the pool
+        self.delayed   = []  # Heap of (due time, number, (key, payload))
+        self.deferred  = 0   # Number of tasks ever deferred, orders the heap
+
+    def run(self, function, tasks=()):
+        """Run function on every task, yield results as chunks complete.
+
+        More tasks can be given to add() or defer() while iterating, the
+        run ends when every task, including the delayed ones, is done.
+
+        :function: A picklable function that takes a single payload.
+        :tasks:    A list of (key, payload) tuples, key stays in this process.
+        :yields:   A list of (key, result) tuples for every completed chunk,
+                   result is the Exception instance if function raised.
+        """
+        self.add(tasks)
+        results   = Queue()
+        chunks    = {}
+        in_flight = 0
+        chunk_id  = 0
+        while self.ready or self.delayed or in_flight:
+            self._release()
+            while self.ready and in_flight < self.workers * IN_FLIGHT:
+                size  = self._next_size(len(self.ready), chunk_id)
+                chunk = [self.ready.popleft()
+                         for _ in range(min(size, len(self.ready)))]
+                chunks[chunk_id] = [i[0] for i in chunk]
+                self._submit(function, chunk_id, [i[1] for i in chunk],
+                             results)
+                chunk_id  += 1
+                in_flight += 1
+            wait = self._next_due()
+            if not in_flight:
+                time.sleep(wait)  # Only delayed tasks are left
+                continue
+            try:
+                done_id, elapsed, outputs = results.get(timeout=wait)
+            except Empty:
+                continue  # A delayed task is due
+            in_flight -= 1
+            keys = chunks.pop(done_id)
+            if isinstance(outputs, Exception):
+                # The whole chunk failed, e.g. the payload was not picklable
+                outputs = [outputs] * len(keys)
+            else:
+                self._update_latency(elapsed / len(keys))
+            yield list(zip(keys, outputs))
+
+    def add(self, tasks):
+        """Queue (key, payload) tasks to run as soon as there is room."""
+        self.ready.extend(tasks)
+
+    def defer(self, task, delay):
+        """Queue a single (key, payload) task to run in delay seconds."""
+        self.deferred += 1
+        heapq.heappush(self.delayed,
+                       (time.time() + delay, self.deferred, task))
+
+    ###############
+    #  Internals  #
+    ###############
+
+    def _release(self):
+        """Move delayed tasks that are due to the front of the queue."""
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            self.ready.appendleft(heapq.heappop(self.delayed)[2])
+
+    def _next_due(self):
+        """Return seconds until the next delayed task, None if none."""
+        if not self.delayed:
+            return None
+        return max(self.delayed[0][0] - time.time(), 0)
+
+    def _submit(self, function, chunk_id, payloads, results):
+        """Submit a chunk, results are put on the results queue."""
+        def callback(out):
+            """Put the chunk results on the queue."""
+            results.put((chunk_id, out[0], out[1]))
+
+        def error_callback(error):
+            """Put the failure on the queue for every task in chunk."""
+            results.put((chunk_id, 0, error))
+
+        self.pool.apply_async(run_chunk, (function, payloads),
+                              callback=callback,
+                              error_callback=error_callback)
+
+    def _next_size(self, remaining, chunk_id):
+        """Return the size of the next chunk."""
+        if self.chunksize:
+            return int(self.chunksize)
+        if self.latency is None or chunk_id < self.workers:
+            return 1
+        size = int(self.target / self.latency) if self.latency else remaining
+        cap  = -(-remaining // (self.workers * TAIL_SPLIT))  # Ceiling divide
+        return max(1, min(size, cap))
+
+    def _update_latency(self, latency):
+        """Update the moving average of seconds per task."""
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.7 * self.latency + 0.3 * latency
+
+
+class Retry(object):
+
+    """When to run a failed task again, and how long to wait first.
+
+    The wait before try n + 1 is delay * backoff ** (n - 1), capped at
+    max_delay, then moved randomly by up to jitter of itself.
+    """
+
+    def __init__(self, tries=TRIES, delay=DELAY, backoff=BACKOFF,
+                 max_delay=MAX_DELAY, jitter=JITTER, codes=None):
+        """Set the policy.
+
+        :tries:     Total runs of a task, including the first.
+        :delay:     Seconds to wait before the first retry.
+        :backoff:   Multiply the wait by this for every further retry.
+        :max_delay: Never wait longer than this.
+        :jitter:    Fraction of the wait to randomly add or remove.
+        :codes:     Only retry on these exit codes, a failure without an
+                    exit code (e.g. an Exception) is then not retried. None
+                    retries every failure.
+        """
+        self.tries     = max(int(tries), 1)
+        self.delay     = float(delay)
+        self.backoff   = float(backoff)
+        self.max_delay = float(max_delay)
+        self.jitter    = min(max(float(jitter), 0.0), 1.0)
+        self.codes     = frozenset(codes) if codes is not None else None
+
+    def should_retry(self, result, attempt):
+        """True if a result should be run again.
+
+        :result:  The return dictionary of the task, or an Exception.
+        :attempt: The number of the run that produced result, from 1.
+        """
+        if attempt >= self.tries:
+            return False
+        if isinstance(result, Exception):
+            return self.codes is None
+        if not result.get('failed'):
+            return False
+        return self.codes is None or result.get('code') in self.codes
+
+    def wait(self, attempt):
+        """Return the seconds to wait after a failed run number attempt."""
+        delay = min(self.delay * self.backoff ** (attempt - 1),
+                    self.max_delay)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def __repr__(self):
+        """Show the policy."""
+        return ('Retry(tries={}, delay={}, backoff={}, max_delay={}, ' +
+                'jitter={}, codes={})').format(
+                    self.tries, self.delay, self.backoff, self.max_delay,
+                    self.jitter, sorted(self.codes) if self.codes else None)
+
+
+def run_chunk(function, payloads):
+    """Run function on every payload, executed in the worker processes.
+
+    :returns: (seconds taken, list of outputs), exceptions raised by
+              function are returned in place of the output.
+    """
+    start   = time.time()
+    outputs = []
+    for payload in payloads:
+        try:
+            outputs.append(function(payload))
+        except Exception as e:
+            outputs.append(e)
+    return time.time() - start, outputs
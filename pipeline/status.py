@@ -0,0 +1,172 @@
+"""
+A small JSON summary of pipeline state that can be read without unpickling.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-09 10:15
+ Last modified: 2016-04-09 10:15
+
+   DESCRIPTION: After Pipeline.enable_status(), every save also writes
+                <pickle_file>.status.json, holding the step counts, the
+                current step and its substep counts, the first few failed
+                steps, and the ETA. The file is written to a temporary file
+                and renamed into place, so it can be read at any time, even
+                while a run is saving.
+
+                Everything in the summary is kept up to date by the
+                pipeline as steps change state, so writing it does not scan
+                the steps. The ETA does need a scan, so it is only
+                recalculated every ETA_INTERVAL seconds.
+
+                Reading the summary only needs json, so it works on machines
+                that do not have the modules of the step functions, and
+                takes milliseconds however big the pipeline is. This module
+                must not import pl.py at the top level, it is what
+                `python -m pipeline status` imports.
+
+         USAGE: project.enable_status()
+                python -m pipeline status project.pickle
+                python -m pipeline status --json project.pickle
+
+============================================================================
+"""
+import os
+import sys
+import json
+import time
+
+__all__ = ['write', 'read', 'summarize', 'format_status', 'status_file']
+
+############################
+#  Customizable constants  #
+############################
+
+SUFFIX       = '.status.json'
+MAX_FAILED   = 10  # Failed step names listed in the summary
+ETA_INTERVAL = 10  # Seconds between ETA calculations
+
+_ETAS = {}  # pipeline file: (time calculated, eta)
+
+
+def status_file(path):
+    """Return the summary file of a pickle file, or path if it is one."""
+    path = str(path)
+    return path if path.endswith(SUFFIX) else path + SUFFIX
+
+
+def summarize(pipeline):
+    """Return the summary of pipeline as a dictionary."""
+    current = pipeline._first_incomplete()
+    failed  = pipeline._failure_names()
+    if current is not None and pipeline.steps[current].steps:
+        substeps = pipeline.steps[current].get_counts()
+    else:
+        substeps = None
+    return {'file': pipeline.file, 'updated': time.time(),
+            'pid': os.getpid(), 'steps': len(pipeline.order),
+            'counts': pipeline.get_counts(), 'current': current,
+            'current_substeps': substeps, 'failed_total': len(failed),
+            'failed': sorted(failed, key=pipeline.order.index)[:MAX_FAILED],
+            'eta': _eta(pipeline) if current is not None else 0.0}
+
+
+def write(pipeline, path=None):
+    """Atomically replace the summary file of pipeline.
+
+    :path: The summary file, default: <pickle_file>.status.json
+    """
+    path = path if path else status_file(pipeline.file)
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp, 'w') as fout:
+        json.dump(summarize(pipeline), fout)
+    os.replace(temp, path)
+
+
+def read(path):
+    """Return the summary for a pickle file or summary file as a dict.
+
+    :raises: OSError if there is no summary, ValueError if it is corrupt.
+    """
+    with open(status_file(path)) as fin:
+        return json.load(fin)
+
+
+def format_status(status):
+    """Return a summary dictionary as a short, human readable report."""
+    counts = status['counts']
+    lines  = ['{:<11}{}'.format('Pipeline:', status['file'])]
+    lines.append('{:<11}{} ({} ago, pid {})'.format(
+        'Updated:', time.ctime(status['updated']),
+        _format_seconds(time.time() - status['updated']), status['pid']))
+    lines.append('{:<11}{} ({} done, {} running, {} pending, {} failed)'
+                 .format('Steps:', status['steps'], counts['done'],
+                         counts['running'], counts['pending'],
+                         counts['failed']))
+    if status['current'] is None:
+        lines.append('{:<11}{}'.format('Current:', 'None, all steps done'))
+    elif status['current_substeps']:
+        subs = status['current_substeps']
+        lines.append('{:<11}{} ({} of {} substeps done, {} failed)'.format(
+            'Current:', status['current'], subs['done'], sum(subs.values()),
+            subs['failed']))
+    else:
+        lines.append('{:<11}{}'.format('Current:', status['current']))
+    if status['failed']:
+        more = status['failed_total'] - len(status['failed'])
+        lines.append('{:<11}{}{}'.format(
+            'Failed:', ', '.join(status['failed']),
+            ' and {} more'.format(more) if more else ''))
+    if status['eta'] is not None:
+        lines.append('{:<11}{}'.format('ETA:',
+                                       _format_seconds(status['eta'])))
+    return '\n'.join(lines)
+
+
+def main(path, as_json=False, outfile=sys.stdout):
+    """Print the status of the pipeline at path, for `pipeline status`.
+
+    Pipelines without a summary, see Pipeline.enable_status(), are
+    unpickled instead, which is slow and needs the step modules.
+
+    :returns: 0, or 1 if there is no pipeline at path.
+    """
+    try:
+        status = read(path)
+    except (IOError, OSError, ValueError):
+        if path.endswith(SUFFIX) or not os.path.isfile(path):
+            sys.stderr.write('No pipeline status at {}\n'.format(path))
+            return 1
+        from .pl import restore_pipeline
+        status = summarize(restore_pipeline(path))
+    if as_json:
+        outfile.write(json.dumps(status, indent=2, sort_keys=True) + '\n')
+    else:
+        outfile.write(format_status(status) + '\n')
+    return 0
+
+
+###############################################################################
+#                              Private Functions                              #
+###############################################################################
+
+
+def _eta(pipeline):
+    """Return the ETA of pipeline, recalculated every ETA_INTERVAL."""
+    if not getattr(pipeline, 'history', None):
+        return None
+    now = time.time()
+    last, eta = _ETAS.get(pipeline.file, (0, None))
+    if now - last > ETA_INTERVAL:
+        eta = pipeline.get_eta()
+        _ETAS[pipeline.file] = (now, eta)
+    return eta
+
+
+def _format_seconds(seconds):
+    """Return seconds as Hours:Minutes:Seconds."""
+    seconds = int(round(max(seconds, 0)))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60,
+                                     seconds % 60)
@@ -18,48 +18,671 @@ Test functions compatible with pretest and donetest.
 ============================================================================
 """
 import os
+import re
+import json
+import mmap
+import stat
+import zlib
+import codecs
+import struct
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from .logme import _open_zipped
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows, caches are only thread safe
 
-__all__ = ["exists", "tail_match"]
+__all__ = ["exists", "tail_match", "checksum", "hash_files", "gzip_ok",
+           "bz2_ok", "bgzf_ok", "compressed_ok"]
 
+############################
+#  Customizable constants  #
+############################
 
-def exists(file_list, kind=None):
+BLOCK_SIZE  = 65536    # Bytes read at a time when searching from the end
+TAIL_WINDOW = 1048576  # Default number of bytes from the end to search
+THREADS     = 8        # Default number of threads used for file lists
+SCANDIR_MIN = 8        # List a directory if checking at least this many
+HASH_BUFFER = 4194304  # Bytes read at a time when hashing
+HASH_CACHE  = '.pipeline_hashes'  # Digest cache written in each directory
+
+# The empty block at the end of every complete BGZF (e.g. BAM) file
+BGZF_EOF  = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43'
+             b'\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+BZ2_EOS   = 0x177245385090  # 48 bit bzip2 end of stream magic
+BGZF_EXTS = ('.bam', '.bcf', '.bgz')  # Extensions that must be BGZF
+DEFLATE_RATIO = 1032  # Most bytes one compressed byte can decompress to
+
+_CACHE_LOCKS = {}  # Directory: threading.Lock for its digest cache
+_LOCKS_LOCK  = threading.Lock()
+
+
+def exists(file_list, kind=None, threads=1):
     """Wrapper for os.path.exists. Supports strings, tuples, lists or dicts.
 
+    Lists and dicts are grouped by parent directory and each directory is
+    listed once with scandir rather than calling stat on every path, which
+    matters on network filesystems. Checking stops at the first missing path.
+
     :file_list: A file or directory that should exits. If this is a string,
                 list, or tuple, the search is agnostic to file or directory,
                 unless type is specified.
                 If a dictionary is provided, it must have the format:
                     {'path_point': 'file', 'path_point': 'directory'}
     :kind:      Either 'file' or 'directory'. Not used if file_list is dict.
+    :threads:   Number of threads to list directories with.
     :returns:   True on success, False on failure
 
     """
-    tests = []
     if isinstance(file_list, dict):
-        for file, kind in file_list.items():
-            tests.append(_test_file(file, kind))
+        paths = file_list.items()
     elif isinstance(file_list, (tuple, list)):
-        for file in file_list:
-            if kind:
-                tests.append(_test_file(file, kind))
-            else:
-                tests.append(os.path.exists(file))
+        paths = [(file, kind) for file in file_list]
     elif isinstance(file_list, str):
-        tests.append(os.path.exists(file_list))
+        if kind:
+            return _test_file(file_list, kind)
+        return os.path.exists(file_list)
     else:
         raise Exception('Invalid object type: {}. '.format(type(file_list)) +
                         'Must be string, tuple, list, or dictionary.')
-    return False if False in tests else True
 
+    # Group by directory, checking kinds now so that bad kinds always raise
+    directories = {}
+    for file, file_kind in paths:
+        if file_kind:
+            _check_kind(file_kind)
+        directory, name = os.path.split(file)
+        directories.setdefault(directory, []).append((name, file_kind, file))
+
+    def check(directory):
+        """Check all paths in one directory."""
+        return _exists_in_dir(directory, directories[directory])
 
-def tail_match(file_list, match_string):
-    """Search the end of a file with tail for 'match_string'.
+    return _check_files(check, list(directories), threads)
+
+
+def tail_match(file_list, match_string, regex=False, window=TAIL_WINDOW,
+               threads=None):
+    """Search the end of every file for 'match_string'.
+
+    Plain files are read backwards from the end in BLOCK_SIZE blocks (or
+    searched in place with mmap if regex is True), so the cost depends on
+    window and not on the size of the file. Files ending in .gz or .bz2 must
+    be decompressed from the start, only the last window bytes are kept.
 
     :file_list:    string, list, or tuple of file names to search
     :match_string: string to match against
-    :returns:   True on success, False on failure
+    :regex:        Treat match_string as a regular expression, otherwise it
+                   is matched literally.
+    :window:       Only search this many bytes from the end of each file,
+                   None to search the whole file.
+    :threads:      Number of threads to check a list of files with, defaults
+                   to THREADS, 1 to check in serial.
+    :returns:   True if every file matches, False on failure
+    """
+    if isinstance(match_string, str):
+        match_string = match_string.encode()
+    pattern = re.compile(match_string) if regex else match_string
+
+    def check(file):
+        """Check a single file, missing files fail."""
+        try:
+            return _tail_match_file(file, pattern, regex, window)
+        except (IOError, OSError, EOFError):
+            return False
+
+    return _check_files(check, _to_list(file_list), threads)
+
+
+def checksum(file_list, expected=None, algorithm='md5', cache=True,
+             threads=None):
+    """Check that the digest of every file matches the expected digest.
+
+    Digests are cached in a HASH_CACHE file in each directory, keyed by file
+    name, size, and modification time, so only changed files are hashed
+    again on later runs.
+
+    :file_list: string, list, or tuple of file names to check
+    :expected:  A dictionary of file->digest, the path to a checksum file in
+                the format written by md5sum/sha256sum, or None to compare
+                every file to a '<file>.<algorithm>' file (e.g. out.bam.md5)
+                in the same format.
+    :algorithm: Any algorithm in hashlib.
+    :cache:     Read and update the digest cache.
+    :threads:   Number of threads to hash with, defaults to THREADS.
+    :returns:   True if every file matches, False on failure
     """
-    pass
+    files = _to_list(file_list)
+    if isinstance(expected, dict):
+        expected = dict((os.path.abspath(k), v.lower())
+                        for k, v in expected.items())
+    elif expected:
+        try:
+            expected = _read_checksum_file(expected)
+        except (IOError, OSError):
+            return False
+    else:
+        expected = {}
+        for file in files:
+            try:
+                expected.update(_read_checksum_file(
+                    '{}.{}'.format(file, algorithm), file))
+            except (IOError, OSError):
+                return False
+    digests = hash_files(files, algorithm, cache, threads)
+    for file in files:
+        digest = digests[file]
+        if digest is None or expected.get(os.path.abspath(file)) != digest:
+            return False
+    return True
+
+
+def hash_files(file_list, algorithm='md5', cache=True, threads=None):
+    """Return the hex digest of every file, hashing files in parallel.
+
+    :file_list: string, list, or tuple of file names to hash
+    :algorithm: Any algorithm in hashlib.
+    :cache:     Read and update the HASH_CACHE file in each directory.
+    :threads:   Number of threads to hash with, defaults to THREADS.
+    :returns:   A dictionary of file->digest, digest is None if the file
+                cannot be read.
+    """
+    files   = _to_list(file_list)
+    digests = {}
+    caches  = {}
+    stats   = {}
+    stale   = []
+    for file in files:
+        try:
+            info = os.stat(file)
+        except OSError:
+            digests[file] = None
+            continue
+        stats[file] = [info.st_size, info.st_mtime_ns, algorithm]
+        directory, name = os.path.split(file)
+        if cache and directory not in caches:
+            caches[directory] = _load_hash_cache(directory)
+        cached = caches[directory].get(name) if cache else None
+        if cached and cached[:3] == stats[file]:
+            digests[file] = cached[3]
+        else:
+            stale.append(file)
+
+    if stale:
+        threads  = threads if threads else THREADS
+        executor = ThreadPoolExecutor(max_workers=min(threads, len(stale)))
+        try:
+            for file, digest in zip(stale, executor.map(
+                    lambda i: _hash_file(i, algorithm), stale)):
+                digests[file] = digest
+        finally:
+            executor.shutdown()
+
+    if cache:
+        updates = {}
+        for file in stale:
+            if digests[file] is not None:
+                directory, name = os.path.split(file)
+                updates.setdefault(directory, {})[name] = (stats[file] +
+                                                           [digests[file]])
+        for directory, hashes in updates.items():
+            _save_hash_cache(directory, hashes)
+    return digests
+
+
+def _hash_file(file, algorithm):
+    """Hash a single file with large reads into a reused buffer."""
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(HASH_BUFFER)
+    view   = memoryview(buffer)
+    try:
+        with open(file, 'rb', buffering=0) as fin:
+            while True:
+                size = fin.readinto(buffer)
+                if not size:
+                    break
+                digest.update(view[:size])
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+def _read_checksum_file(checksum_file, file=None):
+    """Read an md5sum style file into a dictionary of abspath->digest.
+
+    :file: Use this file name for every line instead of the names in the
+           checksum file, used for '<file>.md5' files.
+    """
+    root = os.path.dirname(os.path.abspath(checksum_file))
+    expected = {}
+    with open(checksum_file) as fin:
+        for line in fin:
+            fields = line.strip().split(None, 1)
+            if not fields:
+                continue
+            if file:
+                path = os.path.abspath(file)
+            else:
+                path = os.path.join(root, fields[1].lstrip('*'))
+            expected[path] = fields[0].lower()
+    return expected
+
+
+def _load_hash_cache(directory):
+    """Return the digest cache for directory, empty if missing or corrupt."""
+    try:
+        with open(os.path.join(directory, HASH_CACHE)) as fin:
+            return json.load(fin)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_hash_cache(directory, updates):
+    """Merge updates into the digest cache for directory, errors ignored.
+
+    The cache is re-read and atomically replaced under a lock, so donetests
+    running at once in the same directory keep each other's digests.
+    """
+    cache_file = os.path.join(directory, HASH_CACHE)
+    try:
+        with _cache_lock(directory):
+            hashes = _load_hash_cache(directory)
+            hashes.update(updates)
+            handle, temp_file = tempfile.mkstemp(prefix=HASH_CACHE + '.',
+                                                 dir=directory or '.')
+            try:
+                with os.fdopen(handle, 'w') as fout:
+                    json.dump(hashes, fout)
+                os.replace(temp_file, cache_file)
+            except (IOError, OSError):
+                os.remove(temp_file)
+                raise
+    except (IOError, OSError):
+        pass
+
+
+@contextmanager
+def _cache_lock(directory):
+    """Hold the digest cache of directory for one thread and one process."""
+    directory = os.path.abspath(directory)
+    with _LOCKS_LOCK:
+        lock = _CACHE_LOCKS.setdefault(directory, threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(directory, HASH_CACHE + '.lock'),
+                  'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def gzip_ok(file_list, deep=None, threads=None):
+    """Check that gzip files are complete without decompressing if possible.
+
+    BGZF files (bgzip, BAM) are checked for the BGZF EOF block at the end of
+    the file, reading 28 bytes. With deep, every BGZF block header is walked
+    using the block sizes, still without decompressing.
+
+    Plain gzip files do not record the compressed length of a member, so a
+    truncated file can only be reliably detected by decompressing it. By
+    default the file is streamed through zlib, every member is checked (CRC
+    and ISIZE), and the decompressed data is discarded, so memory use is
+    constant. With deep=False only the header, length, and a plausible
+    ISIZE in the trailer are checked, which misses some truncations.
+
+    :file_list: string, list, or tuple of file names to check
+    :deep:      True to also walk BGZF blocks, False to not decompress
+                plain gzip files.
+    :threads:   Number of threads to check a list of files with.
+    :returns:   True if every file is complete, False on failure
+    """
+    def check(file):
+        """Check a single file."""
+        try:
+            return _gzip_file_ok(file, deep)
+        except (IOError, OSError, EOFError, zlib.error, struct.error):
+            return False
+    return _check_files(check, _to_list(file_list), threads)
+
+
+def bgzf_ok(file_list, deep=False, threads=None):
+    """Check that files are BGZF (bgzip, BAM) and end with the EOF block.
+
+    :file_list: string, list, or tuple of file names to check
+    :deep:      Also walk every block header, see gzip_ok().
+    :threads:   Number of threads to check a list of files with.
+    :returns:   True if every file is complete, False on failure
+    """
+    def check(file):
+        """Check a single file."""
+        try:
+            with open(file, 'rb') as fin:
+                return _bgzf_header(fin) and _bgzf_ok(fin, deep)
+        except (IOError, OSError, struct.error):
+            return False
+    return _check_files(check, _to_list(file_list), threads)
+
+
+def bz2_ok(file_list, threads=None):
+    """Check that bzip2 files end with the end of stream marker.
+
+    Only the header and the last 11 bytes of each file are read. For files
+    with multiple streams (e.g. from pbzip2) only the last one is checked.
+
+    :file_list: string, list, or tuple of file names to check
+    :threads:   Number of threads to check a list of files with.
+    :returns:   True if every file is complete, False on failure
+    """
+    def check(file):
+        """Check a single file."""
+        try:
+            return _bz2_file_ok(file)
+        except (IOError, OSError):
+            return False
+    return _check_files(check, _to_list(file_list), threads)
+
+
+def compressed_ok(file_list, deep=None, threads=None):
+    """Check compressed files of any supported type by extension.
+
+    .bz2 files are checked with bz2_ok(), .bam, .bcf, and .bgz files must be
+    complete BGZF files, and .gz files are checked with gzip_ok(). Any other
+    file only has to exist.
+
+    :file_list: string, list, or tuple of file names to check
+    :deep:      Passed to gzip_ok() and bgzf_ok(), see gzip_ok().
+    :threads:   Number of threads to check a list of files with.
+    :returns:   True if every file is complete, False on failure
+    """
+    def check(file):
+        """Check a single file by extension."""
+        try:
+            if file.endswith('.bz2'):
+                return _bz2_file_ok(file)
+            if file.endswith(BGZF_EXTS):
+                with open(file, 'rb') as fin:
+                    return _bgzf_header(fin) and _bgzf_ok(fin, deep)
+            if file.endswith('.gz'):
+                return _gzip_file_ok(file, deep)
+        except (IOError, OSError, EOFError, zlib.error, struct.error):
+            return False
+        return os.path.isfile(file)
+    return _check_files(check, _to_list(file_list), threads)
+
+
+def _gzip_file_ok(file, deep):
+    """Check a single gzip or BGZF file, see gzip_ok() for deep."""
+    with open(file, 'rb') as fin:
+        if _bgzf_header(fin):
+            return _bgzf_ok(fin, deep)
+        fin.seek(0)
+        header = fin.read(10)
+        if len(header) < 10 or header[:3] != b'\x1f\x8b\x08':
+            return False
+        fin.seek(0, 2)
+        end = fin.tell()
+        if end < 18:  # Smallest possible header and trailer
+            return False
+        if deep is False:
+            # ISIZE can't be more than deflate's best ratio allows
+            fin.seek(end - 4)
+            isize = struct.unpack('<I', fin.read(4))[0]
+            return (end - 18) * DEFLATE_RATIO >= 2**32 or \
+                isize <= (end - 18) * DEFLATE_RATIO
+        fin.seek(0)
+        return _gzip_stream_ok(fin)
+
+
+def _gzip_stream_ok(fin):
+    """Decompress every member of a gzip stream, discarding the output."""
+    decompressor = zlib.decompressobj(31)
+    members = 0
+    while True:
+        data = fin.read(BLOCK_SIZE)
+        if not data:
+            break
+        while data:
+            if decompressor.eof:
+                # Trailing zeros are allowed, anything else is a new member
+                if not data.strip(b'\x00'):
+                    data = b''
+                    break
+                decompressor = zlib.decompressobj(31)
+            decompressor.decompress(data, BLOCK_SIZE)
+            data = decompressor.unconsumed_tail
+            if decompressor.eof:
+                members += 1
+                data = decompressor.unused_data
+    return members > 0 and decompressor.eof
+
+
+def _bgzf_header(fin):
+    """Return True if the file starts with a BGZF block header."""
+    fin.seek(0)
+    header = fin.read(18)
+    return (len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and
+            header[12:16] == b'BC\x02\x00')
+
+
+def _bgzf_ok(fin, deep):
+    """Check a BGZF file ends with the EOF block, optionally walk blocks."""
+    fin.seek(0, 2)
+    end = fin.tell()
+    if end < len(BGZF_EOF):
+        return False
+    fin.seek(end - len(BGZF_EOF))
+    if fin.read(len(BGZF_EOF)) != BGZF_EOF:
+        return False
+    if not deep:
+        return True
+    position = 0
+    while position < end:
+        fin.seek(position)
+        header = fin.read(18)
+        if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04':
+            return False
+        position += struct.unpack('<H', header[16:18])[0] + 1
+    return position == end
+
+
+def _bz2_file_ok(file):
+    """Check a bzip2 file header and end of stream marker."""
+    with open(file, 'rb') as fin:
+        header = fin.read(4)
+        if header[:3] != b'BZh' or header[3:4] not in b'123456789':
+            return False
+        fin.seek(0, 2)
+        if fin.tell() < 14:  # An empty stream is 14 bytes
+            return False
+        fin.seek(-11, 2)
+        tail = fin.read(11)
+    # The marker is not byte aligned, it is followed by a 32 bit CRC and up
+    # to 7 bits of padding.
+    value = int(codecs.encode(tail, 'hex'), 16)
+    for padding in range(8):
+        if (value >> (32 + padding)) & 0xFFFFFFFFFFFF == BZ2_EOS:
+            return True
+    return False
+
+
+def _to_list(file_list):
+    """Return file_list as a list, which can be a string, list, or tuple."""
+    if isinstance(file_list, str):
+        return [file_list]
+    elif isinstance(file_list, (tuple, list)):
+        return list(file_list)
+    raise Exception('Invalid object type: {}. '.format(type(file_list)) +
+                    'Must be string, tuple, or list.')
+
+
+def _check_files(check, files, threads=None):
+    """Run check on every file, return False as soon as one fails.
+
+    :check:   A function that takes a file name and returns True or False.
+    :threads: Number of threads to use, defaults to THREADS, 1 for serial.
+    """
+    threads = threads if threads else THREADS
+    if threads == 1 or len(files) < 2:
+        for file in files:
+            if not check(file):
+                return False
+        return True
+    executor = ThreadPoolExecutor(max_workers=min(threads, len(files)))
+    futures  = [executor.submit(check, file) for file in files]
+    try:
+        for future in as_completed(futures):
+            if not future.result():
+                return False
+        return True
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _tail_match_file(file, pattern, regex, window):
+    """Return True if pattern is in the last window bytes of file."""
+    if file.endswith(('.gz', '.bz2')):
+        tail = bytearray()
+        with _open_zipped(file, 'rb') as fin:
+            while True:
+                block = fin.read(BLOCK_SIZE)
+                if not block:
+                    break
+                tail += block
+                if window:
+                    if len(tail) > window:
+                        del tail[:len(tail) - window]
+                elif not regex:
+                    if pattern in tail:
+                        return True
+                    del tail[:-len(pattern)]
+        return bool(pattern.search(tail)) if regex else pattern in tail
+
+    with open(file, 'rb') as fin:
+        fin.seek(0, 2)
+        end   = fin.tell()
+        limit = max(0, end - window) if window else 0
+        if end == 0:
+            return bool(pattern.search(b'')) if regex else not pattern
+        if regex:
+            # Search in place, doubling the searched region backwards, so a
+            # match near the end is found fast and a miss searches the
+            # window about twice rather than once per block.
+            region = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = end
+                size  = BLOCK_SIZE
+                while start > limit:
+                    start = max(limit, end - size)
+                    if pattern.search(region, start, end):
+                        return True
+                    size *= 2
+                return False
+            finally:
+                region.close()
+        # Literal: read blocks backwards, keeping enough overlap for a match
+        # across the block boundary.
+        overlap = b''
+        start   = end
+        while start > limit:
+            size  = min(BLOCK_SIZE, start - limit)
+            start = start - size
+            fin.seek(start)
+            block = fin.read(size) + overlap
+            if pattern in block:
+                return True
+            overlap = block[:len(pattern) - 1] if len(pattern) > 1 else b''
+        return False
+
+
+def _exists_in_dir(directory, entries):
+    """Test existence of entries in a single directory.
+
+    Directories with fewer than SCANDIR_MIN entries to check are checked with
+    stat, otherwise the directory is listed once. Symlinks, and names that are
+    not in the listing (e.g. on case-insensitive filesystems), fall back to
+    stat so the result always matches os.path.exists.
+
+    :directory: The parent directory, '' for the current directory.
+    :entries:   A list of (name, kind, path) tuples, kind may be None.
+    :returns:   True if every entry exists, False otherwise
+    """
+    if len(entries) < SCANDIR_MIN:
+        listing = {}
+    else:
+        try:
+            listing = dict((i.name, i) for i in _scandir(directory or '.'))
+        except OSError:
+            return False
+    for name, kind, path in entries:
+        entry = listing.get(name)
+        if entry is None or entry.is_symlink():
+            found = _test_file(path, kind) if kind else os.path.exists(path)
+        elif not kind:
+            found = True
+        elif kind.lower().startswith('dir'):
+            found = entry.is_dir()
+        else:
+            found = entry.is_file()
+        if not found:
+            return False
+    return True
+
+
+def _scandir(directory):
+    """Return os.scandir(directory), or the same made with listdir on <3.5."""
+    if hasattr(os, 'scandir'):
+        return os.scandir(directory)
+    return [_DirEntry(directory, i) for i in os.listdir(directory)]
+
+
+class _DirEntry(object):
+
+    """The parts of os.DirEntry used here, lstat is called on first use."""
+
+    def __init__(self, directory, name):
+        """Store the path, don't stat it yet."""
+        self.name  = name
+        self.path  = os.path.join(directory, name)
+        self._mode = None
+
+    def _test(self, test):
+        """Run a stat module test on the mode, False if it can't be read."""
+        if self._mode is None:
+            try:
+                self._mode = os.lstat(self.path).st_mode
+            except OSError:
+                return False
+        return test(self._mode)
+
+    def is_symlink(self):
+        """True if this is a symlink."""
+        return self._test(stat.S_ISLNK)
+
+    def is_dir(self):
+        """True if this is a directory, symlinks are tested with stat."""
+        return self._test(stat.S_ISDIR)
+
+    def is_file(self):
+        """True if this is a regular file."""
+        return self._test(stat.S_ISREG)
+
+
+def _check_kind(kind):
+    """Raise an Exception if kind is not 'file' or 'directory'."""
+    if not kind.lower().startswith('dir') and kind.lower() != 'file':
+        raise Exception("Invalid kind: {}. ".format(kind) +
+                        "Must be 'directory' or 'file'")
 
 
 def _test_file(file, kind):
@@ -0,0 +1,262 @@
+"""
+Export pipeline runs as a Chrome Trace Event timeline.
+
+============================================================================
+
+        AUTHOR: Michael D Dacre, mike.dacre@gmail.com
+  ORGANIZATION: Stanford University
+       LICENSE: MIT License, property of Stanford, use as you wish
+       CREATED: 2016-04-06 11:05
+ Last modified: 2016-04-06 11:05
+
+   DESCRIPTION: Builds a timeline from the start_time and end_time recorded
+                on every step and substep. Steps with a file list get a span
+                on the 'steps' lane, everything that actually ran (single
+                steps and substeps) goes on the lane of the worker process
+                that ran it, with the worker pid as the thread id, so there
+                is one lane per pool worker. The substeps of one batch share
+                a worker and a time span, so they share a lane. Runs with
+                no worker recorded, from older pickles, are packed onto
+                extra lanes, the lowest free lane first.
+                Gaps between spans on a worker lane are written as 'idle'
+                spans.
+
+                The JSON file can be opened in chrome://tracing or
+                https://ui.perfetto.dev. A text summary of pool utilisation,
+                idle time, and the critical path is also returned.
+
+         USAGE: summary = project.export_trace('run.trace.json')
+                print(summary)
+
+============================================================================
+"""
+import json
+import heapq
+
+__all__ = ['export_trace', 'get_spans', 'assign_lanes', 'summarize']
+
+
+def export_trace(pipeline, path):
+    """Write a Chrome Trace Event JSON file for pipeline to path.
+
+    :returns: A text summary, see summarize().
+    """
+    spans = get_spans(pipeline)
+    lanes = assign_lanes([i for i in spans if i['kind'] == 'run'])
+    with open(path, 'w') as fout:
+        json.dump({'traceEvents': trace_events(spans, lanes),
+                   'displayTimeUnit': 'ms'}, fout)
+    return summarize(pipeline, spans, lanes)
+
+
+def get_spans(pipeline):
+    """Return a list of span dictionaries for every step that has run.
+
+    Every span has name, step, file, start, end, state, and kind, which is
+    'step' for steps with substeps and 'run' for everything that ran.
+    """
+    spans = []
+    for step in pipeline:
+        if step.steps:
+            if step.start_time and step.end_time:
+                spans.append(_span(step, step.name, None, 'step'))
+            for substep in step.steps:
+                if substep.start_time and substep.end_time:
+                    spans.append(_span(substep, step.name, substep.name,
+                                       'run'))
+        elif step.start_time and step.end_time:
+            spans.append(_span(step, step.name, None, 'run'))
+    return spans
+
+
+def assign_lanes(spans):
+    """Put spans on the lane of their worker, return a list of lanes.
+
+    Each lane is a list of spans in start order, lanes are in the order
+    their workers first started something. Spans without a worker are
+    packed onto extra lanes, see pack_lanes().
+    """
+    workers = {}
+    unknown = []
+    for span in sorted(spans, key=lambda i: (i['start'], i['end'])):
+        if span.get('worker') is None:
+            unknown.append(span)
+        else:
+            workers.setdefault(span['worker'], []).append(span)
+    return (sorted(workers.values(), key=lambda i: i[0]['start']) +
+            pack_lanes(unknown))
+
+
+def pack_lanes(spans):
+    """Pack spans onto the lowest free lane, return a list of lanes.
+
+    Each lane is a list of spans in start order. Spans that start exactly
+    when another ends can share a lane.
+    """
+    lanes = []
+    free  = []  # Heap of (end time, lane number) for every lane
+    for span in sorted(spans, key=lambda i: (i['start'], i['end'])):
+        available = []
+        while free and free[0][0] <= span['start']:
+            available.append(heapq.heappop(free)[1])
+        if available:
+            lane = min(available)
+            for other in available:
+                if other != lane:
+                    heapq.heappush(free, (lanes[other][-1]['end'], other))
+        else:
+            lane = len(lanes)
+            lanes.append([])
+        lanes[lane].append(span)
+        heapq.heappush(free, (span['end'], lane))
+    return lanes
+
+
+def trace_events(spans, lanes):
+    """Return the list of Chrome trace events for spans packed in lanes."""
+    if not spans:
+        return []
+    origin = min(i['start'] for i in spans)
+    events = [_meta('thread_name', 0, 'steps'),
+              _meta('thread_sort_index', 0, 0)]
+    for span in spans:
+        if span['kind'] == 'step':
+            events.append(_complete(span, 0, origin))
+    for number, lane in enumerate(lanes, 1):
+        worker = lane[0].get('worker')
+        tid    = worker if worker is not None else number
+        events.append(_meta('thread_name', tid, 'worker {}'.format(
+            'pid {}'.format(worker) if worker is not None else number)))
+        events.append(_meta('thread_sort_index', tid, number))
+        last = None
+        for span in lane:
+            if last is not None and span['start'] > last:
+                events.append(_complete(
+                    {'name': 'idle', 'start': last, 'end': span['start'],
+                     'kind': 'idle', 'step': None, 'file': None,
+                     'state': 'idle'}, tid, origin))
+            events.append(_complete(span, tid, origin))
+            last = max(last, span['end']) if last is not None else span['end']
+    return events
+
+
+def summarize(pipeline, spans, lanes):
+    """Return a text summary of utilisation and the critical path."""
+    runs = [i for i in spans if i['kind'] == 'run']
+    if not runs:
+        return 'Nothing has run yet'
+    start    = min(i['start'] for i in runs)
+    end      = max(i['end'] for i in runs)
+    makespan = end - start
+    busy     = sum(_busy(lane) for lane in lanes)
+    capacity = makespan * len(lanes)
+    lines = ['Makespan:    {:.3f}s'.format(makespan),
+             'Lanes:       {}'.format(len(lanes)),
+             'Busy:        {:.3f}s'.format(busy),
+             'Idle:        {:.3f}s'.format(capacity - busy),
+             'Utilisation: {:.1%}'.format(busy / capacity if capacity
+                                          else 1.0)]
+
+    # Per step, for steps with substeps
+    for span in spans:
+        if span['kind'] != 'step':
+            continue
+        subs  = [i for i in runs if i['step'] == span['step']]
+        if not subs:
+            continue
+        wall  = span['end'] - span['start']
+        used  = [[i for i in lane if i['step'] == span['step']]
+                 for lane in lanes]
+        used  = [i for i in used if i]
+        total = sum(_busy(i) for i in used)
+        width = max(len(used), 1)
+        long  = max(subs, key=lambda i: i['end'] - i['start'])
+        lines.append(('{}: {} substeps on {} lanes, {:.3f}s wall, ' +
+                      '{:.1%} busy, longest {} {:.3f}s').format(
+                          span['step'], len(subs), width, wall,
+                          total / (wall * width) if wall else 1.0,
+                          long['file'], long['end'] - long['start']))
+
+    path, length = critical_path(pipeline)
+    lines.append('Critical path ({:.3f}s): {}'.format(
+        length, ' -> '.join(path) if path else 'None'))
+    return '\n'.join(lines)
+
+
+def critical_path(pipeline):
+    """Return the longest chain of steps through their depends lists.
+
+    :returns: (list of step names, total seconds)
+    """
+    durations = {}
+    for step in pipeline:
+        if step.start_time and step.end_time:
+            durations[step.name] = step.end_time - step.start_time
+        else:
+            durations[step.name] = 0.0
+    best = {}
+
+    def longest(name, seen):
+        """Longest path ending at name."""
+        if name in best:
+            return best[name]
+        if name in seen or name not in durations:
+            return [], 0.0  # Missing step or dependency loop
+        seen = seen | {name}
+        chain, length = [], 0.0
+        for dependency in pipeline[name].depends:
+            sub_chain, sub_length = longest(dependency, seen)
+            if sub_length > length:
+                chain, length = sub_chain, sub_length
+        best[name] = (chain + [name], length + durations[name])
+        return best[name]
+
+    result = ([], 0.0)
+    for name in durations:
+        path = longest(name, set())
+        if path[1] > result[1]:
+            result = path
+    return result
+
+
+###############################################################################
+#                              Private Functions                              #
+###############################################################################
+
+
+def _span(step, name, file, kind):
+    """Return a span dictionary for step."""
+    state = 'failed' if step.failed else 'done' if step.done else 'not run'
+    return {'name': file if file else name, 'step': name, 'file': file,
+            'start': step.start_time, 'end': step.end_time, 'kind': kind,
+            'state': state, 'code': step.code,
+            'worker': getattr(step, 'worker', None)}
+
+
+def _complete(span, lane, origin):
+    """Return a complete ('X') trace event for span."""
+    args = dict((k, span[k]) for k in ('step', 'file', 'state', 'code')
+                if span.get(k) is not None)
+    return {'name': span['name'], 'cat': span['kind'], 'ph': 'X',
+            'ts': (span['start'] - origin) * 1e6,
+            'dur': (span['end'] - span['start']) * 1e6,
+            'pid': 1, 'tid': lane, 'args': args}
+
+
+def _meta(name, lane, value):
+    """Return a metadata ('M') trace event."""
+    key = 'sort_index' if name.endswith('sort_index') else 'name'
+    return {'name': name, 'ph': 'M', 'pid': 1, 'tid': lane,
+            'args': {key: value}}
+
+
+def _busy(lane):
+    """Return the seconds a lane was running, batches are counted once."""
+    busy = 0.0
+    last = None
+    for span in lane:  # In start order
+        start = span['start'] if last is None else max(span['start'], last)
+        if span['end'] > start:
+            busy += span['end'] - start
+        last = span['end'] if last is None else max(last, span['end'])
+    return busy
@@ -0,0 +1,68 @@
+"""Test the JSONL event stream."""
+import os
+import json
+import gzip
+import pipeline as pl
+from pipeline.events import EventLog
+
+PIPELINE_FILE = 'events.test'
+
+
+def read_events(path):
+    """Return a list of events from a JSONL file."""
+    with open(path) as fin:
+        return [json.loads(i) for i in fin]
+
+
+def test_rotation():
+    """Files are rotated and compressed when they grow too large."""
+    events = EventLog('rotate.jsonl', max_bytes=1000, backups=2)
+    for i in range(100):
+        events.emit('test', number=i)
+    events.close()
+    assert os.path.exists('rotate.jsonl.1.gz')
+    assert os.path.exists('rotate.jsonl.2.gz')
+    assert not os.path.exists('rotate.jsonl.3.gz')
+    with gzip.open('rotate.jsonl.1.gz', 'rt') as fin:
+        rotated = [json.loads(i) for i in fin]
+    current = read_events('rotate.jsonl')
+    assert rotated[-1]['number'] + 1 == current[0]['number']
+    assert current[-1]['number'] == 99
+    for file in ('rotate.jsonl', 'rotate.jsonl.1.gz', 'rotate.jsonl.2.gz'):
+        os.remove(file)
+
+
+def test_pipeline_events():
+    """Running a pipeline writes lifecycle events."""
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    pip.enable_events()
+    pip.add(str.upper, 'hi', name='upper')
+    pip.add('ls sdlfkjsdf', name='fails')
+    try:
+        pip.run_all()
+    except pl.Command.CommandFailed:
+        pass
+    pip.delete('fails')
+    pip.run_all(skip_pre_donecheck=True)
+    pip = pl.get_pipeline(PIPELINE_FILE)  # Make sure events survive pickle
+    pip.add(os.path.exists, '<StepFile>', name='parallel',
+            file_list=[PIPELINE_FILE, 'sdfjkl'])
+    pip['parallel'].run_parallel(threads=2)
+    events = read_events(PIPELINE_FILE + '.events.jsonl')
+    assert ('added', 'upper') in [(i['event'], i['step']) for i in events]
+    kinds = [(i['event'], i['step'], i['file']) for i in events
+             if i['event'] not in ('saved', 'added')]
+    assert kinds[:3] == [('started', 'upper', None),
+                         ('finished', 'upper', None),
+                         ('started', 'fails', None)]
+    assert ('failed', 'fails', None) in kinds
+    assert ('skipped', 'upper', None) in kinds
+    assert ('queued', 'parallel', 'sdfjkl') in kinds
+    assert ('finished', 'parallel', None) in kinds
+    finished = [i for i in events if i['event'] == 'finished'][0]
+    assert finished['duration'] >= 0
+    assert [i for i in events if i['event'] == 'saved'][0]['bytes'] > 0
+    pip.disable_events()
+    for file in (PIPELINE_FILE, PIPELINE_FILE + '.log',
+                 PIPELINE_FILE + '.events.jsonl'):
+        os.remove(file)
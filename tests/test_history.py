@@ -0,0 +1,86 @@
+"""Test the runtime history and predictions."""
+import os
+import shutil
+import pipeline as pl
+from pipeline import logme
+from pipeline.history import History, fit
+
+PIPELINE_FILE = 'history.test'
+CACHE_DIR     = 'history_cache'
+
+
+def test_fit():
+    """Runtime is fit against bytes, one size gives the mean."""
+    assert fit([(0, 1.0), (0, 3.0)]) == (2.0, 0.0)
+    intercept, slope = fit([(100, 2.0), (200, 3.0), (300, 4.0)])
+    assert round(intercept, 6) == 1.0 and round(slope, 6) == 0.01
+    assert fit([(100, 4.0), (200, 2.0)]) == (3.0, 0.0)
+
+
+def test_shared_history():
+    """Histories sharing a directory see each other's runs."""
+    first  = History(CACHE_DIR)
+    second = History(CACHE_DIR)
+    assert first.predict('step') is None
+    first.record('step', 10.0, size=1000)
+    first.record('step', 20.0, size=2000)
+    first.record('step', 99.0, size=3000, failed=True)
+    second.refresh()
+    assert round(second.predict('step', 3000), 6) == 30.0
+    first.close()
+    shutil.rmtree(CACHE_DIR)
+
+
+def test_pipeline_eta():
+    """Pipelines record runtimes and predict ETAs from them."""
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    pip.enable_history(CACHE_DIR)
+    pip.add(os.path.exists, '<StepFile>', name='exists',
+            file_list=[PIPELINE_FILE, 'README.rst'])
+    assert pip.get_eta() is None
+    pip.run_all()
+    assert pip['exists'].predict_runtime() >= 0
+    assert pip.get_eta() == 0
+    for step in pip['exists'].steps:
+        step.done = False
+    assert pip['exists'].get_eta(threads=2) >= 0
+    assert 'Estimated time remaining' in pip.get_stats()
+    other = pl.get_pipeline(PIPELINE_FILE + '2')
+    other.enable_history(CACHE_DIR)
+    other.add(os.path.exists, '<StepFile>', name='exists', file_list=['LICENSE'])
+    assert other['exists'].predict_runtime() is not None
+    pip.disable_history()
+    other.disable_history()
+    shutil.rmtree(CACHE_DIR)
+    for file in (PIPELINE_FILE, PIPELINE_FILE + '2', PIPELINE_FILE + '.log',
+                 PIPELINE_FILE + '2.log'):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def test_run_all_eta(monkeypatch):
+    """run_all predicts each step once, and only if the ETA is logged."""
+    logme.close()  # Earlier tests deleted the logfile
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    pip.enable_history(CACHE_DIR)
+    for name in ('one', 'two', 'three'):
+        pip.add(str.upper, name, name=name)
+    pip.run_all()
+    calls = []
+    get_eta = pl.Step._get_eta
+    monkeypatch.setattr(pl.Step, '_get_eta', lambda self, *args:
+                        calls.append(self.name) or get_eta(self, *args))
+    for loglev, expected in (('error', []), ('info', ['one', 'two', 'three'])):
+        for step in pip:
+            step.done = False
+        pip.loglev = loglev
+        pip.run_all()
+        assert calls == expected
+    with open(pip.logfile) as fin:
+        assert 'Running three, pipeline ETA' in fin.read()
+    logme.close()
+    pip.disable_history()
+    shutil.rmtree(CACHE_DIR)
+    for file in (PIPELINE_FILE, PIPELINE_FILE + '.log'):
+        if os.path.exists(file):
+            os.remove(file)
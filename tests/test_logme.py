@@ -0,0 +1,74 @@
+"""Test the logme logging functions."""
+import os
+from pipeline import logme
+
+LOGFILE = 'test_logme.log'
+
+
+def read_log():
+    """Return the lines in LOGFILE and delete it."""
+    with open(LOGFILE) as fin:
+        lines = fin.read().rstrip('\n').split('\n')
+    os.remove(LOGFILE)
+    logme.close()
+    return lines
+
+
+def test_min_level():
+    """Messages below min_level are not written."""
+    logme.log('hidden', level='debug', logfile=LOGFILE, min_level='info')
+    logme.log('shown', level='info', logfile=LOGFILE, min_level='info')
+    lines = read_log()
+    assert len(lines) == 1
+    assert lines[0].endswith('INFO --> shown')
+    assert logme.enabled('debug', 'info') is False
+    assert logme.enabled('error', 'info') is True
+
+
+def test_reopen_deleted_logfile():
+    """A cached handle is replaced if the logfile is deleted."""
+    logme.log('first', logfile=LOGFILE)
+    os.remove(LOGFILE)
+    logme._HANDLES['checked'][LOGFILE] = 0  # Force the check
+    logme.log('second', logfile=LOGFILE)
+    assert read_log()[0].endswith('second')
+
+
+def test_background_writer():
+    """The writer thread writes every message, in order."""
+    logme.start_writer()
+    for i in range(5000):
+        logme.log('message {}'.format(i), logfile=LOGFILE)
+    logme.log('multi\nline', logfile=LOGFILE)
+    logme.stop_writer()
+    lines = read_log()
+    assert len(lines) == 5002
+    for i in range(5000):
+        assert lines[i].endswith('INFO --> message {}'.format(i))
+    assert lines[5001].endswith('> line')
+
+
+def log_many(number):
+    """Log messages from a pool worker."""
+    for i in range(200):
+        logme.log('worker {} message {} '.format(number, i) + 'x' * 500,
+                  logfile=LOGFILE)
+    return number
+
+
+def test_aggregator():
+    """Messages from pool workers are all written, none are torn."""
+    from multiprocessing import Pool
+    with logme.Aggregator() as aggregator:
+        pool = Pool(4, initializer=logme.forward_to,
+                    initargs=(aggregator.queue,))
+        assert sorted(pool.map(log_many, range(8))) == list(range(8))
+        pool.close()
+        pool.join()
+    lines = read_log()
+    assert len(lines) == 1600
+    for line in lines:
+        assert line.endswith('x' * 500)
+    for number in range(8):
+        mine = [i for i in lines if ' worker {} '.format(number) in i]
+        assert [i.split()[8] for i in mine] == [str(i) for i in range(200)]
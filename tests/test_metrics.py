@@ -0,0 +1,51 @@
+"""Test the Prometheus textfile metrics."""
+import os
+import re
+import pipeline as pl
+
+PIPELINE_FILE = 'metrics.test'
+
+
+def read_metrics(path):
+    """Return a dictionary of sample line: value."""
+    samples = {}
+    with open(path) as fin:
+        for line in fin:
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                name = re.sub(r',?pipeline="[^"]*",?', ',', name)
+                name = name.replace('{,', '{').replace(',}', '}')
+                samples[name] = float(value)
+    return samples
+
+
+def test_metrics():
+    """Counters follow the steps without scanning them."""
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    pip.add(str.upper, 'hi', name='upper')
+    pip.run_all()
+    pip.enable_metrics(interval=0.05)
+    pip.add(os.path.exists, '<StepFile>', name='parallel',
+            file_list=[PIPELINE_FILE, 'tests'])
+    samples = read_metrics(PIPELINE_FILE + '.prom')
+    assert samples['pipeline_steps{level="step",state="done"}'] == 1
+    pip['parallel'].run_parallel(threads=2)
+    pip.metrics.stop()
+    pip = pl.get_pipeline(PIPELINE_FILE)  # Counters survive the pickle
+    pip.disable_metrics()
+    samples = read_metrics(PIPELINE_FILE + '.prom')
+    assert samples['pipeline_steps{level="step",state="done"}'] == 2
+    assert samples['pipeline_steps{level="substep",state="done"}'] == 2
+    assert samples['pipeline_steps{level="step",state="pending"}'] == 0
+    assert samples['pipeline_completed_total{level="substep"}'] == 2
+    assert samples['pipeline_completed_per_minute{level="substep"}'] == 2
+    assert samples[('pipeline_step_duration_seconds_count{level="substep",' +
+                    'step="parallel"}')] == 2
+    assert samples['pipeline_pool_workers{}'] == 0
+    assert samples['pipeline_save_duration_seconds_count{}'] > 0
+    assert samples['pipeline_last_event_timestamp_seconds{}'] > 0
+    assert not [i for i in os.listdir('.') if i.endswith('.tmp')]
+    for file in (PIPELINE_FILE, PIPELINE_FILE + '.log',
+                 PIPELINE_FILE + '.prom'):
+        if os.path.exists(file):
+            os.remove(file)
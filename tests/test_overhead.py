@@ -0,0 +1,48 @@
+"""Test the framework overhead accounting."""
+import os
+import time
+import pipeline as pl
+from pipeline.overhead import Overhead
+
+PIPELINE_FILE = 'overhead.test'
+
+
+def test_nested_phases():
+    """Each phase is only charged for its own time."""
+    overhead = Overhead()
+    with overhead.phase('outer'):
+        time.sleep(0.02)
+        with overhead.phase('execute'):
+            time.sleep(0.05)
+    assert overhead.phases['outer'][0] == 1
+    assert 0.015 < overhead.phases['outer'][1] < 0.045
+    assert overhead.phases['execute'][1] >= 0.05
+    payload, framework = overhead.split()
+    assert payload > framework
+    assert 'execute *' in overhead.report()
+
+
+def test_pipeline_overhead():
+    """A run is split into payload and framework phases."""
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    pip.add(time.sleep, 0.05, name='sleep')
+    pip.add(os.path.exists, '<StepFile>', name='parallel',
+            file_list=[PIPELINE_FILE, 'README.rst'])
+    pip.run_all()
+    phases = pip.overhead.last_run
+    for phase in ('run_all', 'save', 'execute', 'pre_exec', 'post_exec',
+                  'parse_return', 'step_run_all'):
+        assert phase in phases
+    assert phases['execute'][0] == 3
+    assert phases['execute'][1] >= 0.05
+    pip['parallel'].run_parallel(threads=2, force=True)
+    assert 'pool_wait' in pip.overhead.phases
+    assert 'pool_start' in pip.overhead.phases
+    assert 'Framework:' in pip.get_overhead(last_run=True)
+    pip = pl.get_pipeline(PIPELINE_FILE)  # Timers survive the pickle
+    assert pip.overhead.phases['execute'][0] == 3
+    pip.reset_overhead()
+    assert 'execute' not in pip.overhead.phases
+    for file in (PIPELINE_FILE, PIPELINE_FILE + '.log'):
+        if os.path.exists(file):
+            os.remove(file)
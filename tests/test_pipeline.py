@@ -1,5 +1,6 @@
 """Test the pipeline.py code for errors."""
 import os
+import time
 import pytest
 import pipeline as pl
 from pipeline.pl import RegexError
@@ -59,6 +60,15 @@ def create_files():
     for i in range(1, 10):
         os.system('touch {}.testfile'.format(i))
 
+BATCH_CALLS = []
+
+
+def exists_batch(files):
+    """Check a batch of files and record the batch size."""
+    BATCH_CALLS.append(len(files))
+    return dict((file, os.path.exists(file)) for file in files)
+
+
 def log_os(file):
     """Run os.path.exists and log if fails."""
     pass
@@ -268,6 +278,241 @@ def test_serial_step():
         assert step.failed is False
 
 
+def test_batched_step():
+    """Run a batched function step in serial and in parallel."""
+    create_files()
+    pip = get_pipeline()
+    pip.add(exists_batch, '<StepFile>', file_list=r'[0-9].testfile',
+            name='batched_exists', batched=True, batch_size=4)
+    pip.add(exists_batch, '<StepFile>', file_list=r'[0-9].testfile',
+            name='batched_parallel', batched=True, batch_size=2)
+    pip['batched_exists'].run_all()
+    assert sorted(BATCH_CALLS) == [1, 4, 4]
+    for step in pip['batched_exists'].steps:
+        assert step.done is True
+        assert step.out is True
+    pip['batched_parallel'].run_parallel(threads=2)
+    assert pip['batched_parallel'].done is True
+    for step in pip['batched_parallel'].steps:
+        assert step.out is True
+    os.system('rm -f [0-9].testfile')
+
+
+def test_order_substeps():
+    """Order substeps largest file first."""
+    create_files()
+    for i in range(1, 10):
+        write_file('{}.testfile'.format(i), 'x' * i * 10)
+    pip = get_pipeline()
+    pip.add(os.path.exists, '<StepFile>', file_list=r'[0-9].testfile',
+            name='ordered')
+    step = pip['ordered']
+    ordered = step.order_substeps(step.steps, 'size')
+    assert [os.path.basename(i.name) for i in ordered] == [
+        '{}.testfile'.format(i) for i in range(9, 0, -1)]
+    with pytest.raises(pl.Step.StepError):
+        step.order_substeps(step.steps, 'bob')
+    step.run_parallel(threads=2, order='runtime')
+    assert step.done is True
+    os.system('rm -f [0-9].testfile')
+
+
+def test_resources():
+    """Resource usage is recorded for commands and functions."""
+    pip = get_pipeline()
+    pip.add('python -c "x = [0] * 20000000; sum(range(3000000))"',
+            name='hungry')
+    pip['hungry'].run()
+    usage = pip['hungry'].get_resources()
+    assert usage['utime'] + usage['stime'] > 0
+    assert usage['maxrss'] > 100000  # The list alone is 160MB
+    assert 'Max RSS:' in str(pip['hungry'])
+    code, out, err, usage = pl.pl.run_cmd_rusage('echo hi; exit 3')
+    assert (code, out, err) == (3, 'hi', '')
+    assert pip['run2'].get_resources() is not None
+    assert pip['parallel_file'].get_resources()['maxrss'] > 0
+
+
+def count_to(number):
+    """Count up to number, something to profile."""
+    return sum(range(int(number)))
+
+
+def test_profile(monkeypatch):
+    """Profile a function and a file list step, merging substeps."""
+    import sys
+    import pstats
+    pip = get_pipeline()
+    pip.add(count_to, 100000, name='count', profile='memory')
+    pip['count'].run()
+    assert pip['count'].profile_stats.endswith('count.prof')
+    assert os.path.exists(pip['count'].profile_stats)
+    assert os.path.exists(pip['count'].profile_stats[:-5] + '.snapshot')
+    pip.add(count_to, '<StepFile>', name='counts', profile=True,
+            file_list=['1000', '2000', '3000'])
+    pip['counts'].run_parallel(threads=2)
+    stats = pstats.Stats(pip['counts'].profile_stats)
+    calls = [v[1] for k, v in stats.stats.items() if k[2] == 'count_to']
+    assert calls == [3]
+    with pytest.raises(pl.Step.StepError):
+        pip.add(exists_batch, '<StepFile>', file_list=['a'], batched=True,
+                profile=True, name='badprofile')
+    monkeypatch.setitem(sys.modules, 'tracemalloc', None)  # As on 3.3
+    pip.add(count_to, 1000, name='cpuonly', profile='cpu')
+    pip['cpuonly'].run()
+    assert pip['cpuonly'].done and os.path.exists(
+        pip['cpuonly'].profile_stats)
+    os.system('rm -rf {}.profiles'.format(PIPELINE_FILE))
+
+
+class Table(object):
+
+    """A minimal DataFrame-like table."""
+
+    def __init__(self, rows):
+        """Store rows."""
+        self.rows = rows
+
+    def to_dict(self, orient):
+        """Return the rows as records."""
+        assert orient == 'records'
+        return self.rows
+
+
+def test_add_many():
+    """Add steps in bulk, all or nothing."""
+    pip = get_pipeline()
+    count = len(pip)
+    names = pip.add_many(
+        [('ls', None, 'many_ls'),
+         {'command': write_something, 'args': 'hi', 'name': 'many_write'}] +
+        [('echo {}'.format(i), None, 'many{}'.format(i)) for i in range(100)])
+    assert len(pip) == count + 102
+    assert names[:2] == ['many_ls', 'many_write']
+    assert pip['many_write'].command is write_something
+    names = pip.add_many(Table([{'command': 'ls', 'name': 'many_first',
+                                 'args': float('nan')}]), position=0)
+    assert pip.order[0] == 'many_first'
+    assert pip['many_first'].args is None
+    nan = float('nan')
+    names += pip.add_many(Table([
+        {'command': 'ls', 'name': 'many_mixed_ls', 'args': nan,
+         'batched': nan, 'profile': nan, 'batch_size': nan},
+        {'command': write_something, 'name': 'many_mixed_fn', 'args': 'hi',
+         'batched': nan, 'profile': nan, 'batch_size': nan}]))
+    assert isinstance(pip['many_mixed_ls'], pl.Command)
+    assert pip['many_mixed_fn'].batched is False
+    with pytest.raises(pl.Pipeline.PipelineError):
+        pip.add_many([{'command': 'ls', 'name': 'many_x', 'batched': True}])
+    with pytest.raises(pl.Pipeline.PipelineError) as error:
+        pip.add_many([('ls', None, 'many_ok'), ('ls', None, 'many_ls'),
+                      {'command': 'ls', 'bob': 1}, ('ls', 'x', 'many_bad',
+                                                     'bob')])
+    assert '3 invalid step specs' in str(error.value)
+    assert 'many_ok' not in pip
+    pip = get_pipeline()  # Saved
+    assert 'many99' in pip
+    for name in names + ['many_ls', 'many_write'] + [
+            'many{}'.format(i) for i in range(100)]:
+        pip.delete(name)
+    assert len(pip) == count
+
+
+def raise_error():
+    """A donetest that fails with an Exception."""
+    raise ValueError('not done')
+
+
+def test_check_all():
+    """Run every donetest concurrently and mark passing steps done."""
+    pip = pl.get_pipeline('check.test')
+    for i in range(1, 7):
+        write_file('{}.checkfile'.format(i))
+        if i % 2:
+            write_file('{}.checkfile.out'.format(i))
+    pip.add(os.path.getsize, '<StepFile>', file_list=r'[0-9]\.checkfile$',
+            donetest=(os.path.exists, ('<StepFile>.out',)), name='files')
+    pip.add('ls', name='checked', donetest=(os.path.isdir, '.'))
+    pip.add('ls', name='broken', donetest=raise_error)
+    pip.add('ls', name='untested')
+    assert pip.check_all(threads=4) == (4, 4)
+    assert pip['checked'].done and not pip['broken'].done
+    assert not pip['broken'].failed and pip['broken'].failed_done
+    assert pip['files'].get_counts()['done'] == 3 and not pip['files'].done
+    assert pl.get_pipeline('check.test')['checked'].done  # Saved
+    pip.check_all(fail_on_error=True)
+    assert pip['broken'].failed and pip['files'].failed
+    with pytest.raises(pl.Pipeline.PipelineError) as error:
+        pip.check('broken', raise_on_error=True)
+    assert 'ValueError: not done' in str(error.value)
+    for i in range(2, 7, 2):
+        write_file('{}.checkfile.out'.format(i))
+    assert pip.check('files', threads=2, processes=True) is True
+    assert pip['files'].done and not pip['files'].failed
+    os.system('rm -f [0-9].checkfile* check.test*')
+
+
+def flaky(path):
+    """Fail the first three times, counting calls in path."""
+    count = int(open(path).read()) if os.path.exists(path) else 0
+    write_file(path, str(count + 1))
+    if count < 3:
+        raise OSError('busy')
+    return count
+
+
+def test_run_parallel():
+    """Run steps in order of dependencies, retrying failures."""
+    pip = pl.get_pipeline('parallel.test')
+    pip.add(flaky, ('flaky.count',), name='flaky')
+    pip.add('ls', name='after', depends='flaky')
+    pip.add('false', name='fails')
+    pip.add('ls', name='blocked', depends=['fails'])
+    assert pip.run_parallel(threads=2) == ['flaky', 'after', 'fails',
+                                          'blocked']
+    assert pip['flaky'].failed and not pip['after'].done
+    retry = pl.Retry(tries=3, delay=0.1, codes=(2,))
+    assert pip.run_parallel(('flaky', 'after'), retry=retry) == ['flaky',
+                                                                 'after']
+    assert open('flaky.count').read() == '2\n'  # OSError has no exit code
+    start = time.time()
+    assert pip.run_parallel(('flaky', 'after'), auto_resubmit=True,
+                            tries=1, delay=0.1) == []  # One resubmit
+    assert time.time() - start >= 0.1
+    assert pip['flaky'].out == 3 and pip['after'].done
+    with pytest.raises(pl.Pipeline.PipelineError) as error:
+        pip.run_parallel(['blocked'])
+    assert 'which is not done' in str(error.value)
+    with pytest.raises(pl.Pipeline.PipelineError) as error:
+        pip.run_parallel(['fails', 'blocked'], raise_on_error=True)
+    assert 'blocked (not run)' in str(error.value)
+    os.system('rm -f flaky.count parallel.test*')
+
+
+def test_check_step_donetest():
+    """Run the step-level donetest of a step with substeps."""
+    pip = pl.get_pipeline('check.test')
+    for i in range(1, 4):
+        write_file('{}.checkfile'.format(i))
+    pip.add(os.path.getsize, '<StepFile>', file_list=r'[0-9]\.checkfile$',
+            donetest=(os.path.exists, ('merged.checkfile',)), name='fl')
+    assert pip.check('fl') is False
+    assert pip.check_all() == (0, 1)
+    assert not pip['fl'].done and pip['fl'].failed_done
+    pip.check_all(fail_on_error=True)
+    assert pip['fl'].failed
+    write_file('merged.checkfile')
+    assert pip.check('fl') is True
+    assert pip['fl'].done and not pip['fl'].failed
+    pip.add(os.path.getsize, '<StepFile>', file_list=r'[0-9]\.checkfile$',
+            donetest=(os.path.exists, ('merged.checkfile',)),
+            name='both')
+    pip['both'].steps[0].donetest = (os.path.exists, ('missing.checkfile',))
+    assert pip.check('both') is False
+    assert not pip['both'].done  # A failed substep test vetoes the step
+    os.system('rm -f [0-9].checkfile merged.checkfile check.test*')
+
+
 #  def test_sub_pipeline():
     #  """Add and run a subpipeline."""
     #  pip = get_pipeline()
@@ -0,0 +1,164 @@
+"""Test the ordered step registry."""
+import os
+import time
+import pickle
+import pytest
+import pipeline as pl
+from pipeline import registry
+from pipeline.registry import StepOrder
+
+PIPELINE_FILE = 'registry.test'
+
+
+def test_step_order():
+    """Append, insert, remove, and index keep the order consistent."""
+    order = StepOrder('abc')
+    order.append('d')
+    order.insert(1, 'x')
+    assert order == ('a', 'x', 'b', 'c', 'd')
+    assert order.index('b') == 2
+    order.remove('x')
+    order.remove('a')
+    assert 'a' not in order and 'b' in order
+    assert order.index('d') == 2
+    assert order[0] == 'b' and order[-1] == 'd' and order[1:] == ('c', 'd')
+    order.insert(-1, 'y')
+    assert list(order) == ['b', 'c', 'y', 'd']
+    with pytest.raises(ValueError):
+        order.append('b')
+    with pytest.raises(ValueError):
+        order.remove('a')
+    for name in list(order):  # Iteration is over a copy
+        order.remove(name)
+    assert len(order) == 0 and not order
+    big = StepOrder(str(i) for i in range(10000))
+    for i in range(0, 10000, 2):
+        big.remove(str(i))
+    assert len(big) == 5000 and big.index('9999') == 4999
+    assert pickle.loads(pickle.dumps(big)) == big
+
+
+def test_step_order_interleaved(monkeypatch):
+    """Mixed removes, lookups, and inserts match a list, with small blocks."""
+    monkeypatch.setattr(registry, 'LOAD', 4)
+    names = [str(i) for i in range(100)]
+    order = StepOrder(names)
+    for i in range(200):
+        name = names[(i * 7) % len(names)]
+        names.remove(name)
+        order.remove(name)
+        assert order.index(names[-1 - i % 10]) == len(names) - 1 - i % 10
+        assert order[i % len(names)] == names[i % len(names)]
+        if i % 3:
+            names.insert(i % 50, name)
+            order.insert(i % 50, name)
+    assert list(order) == names and len(order) == len(names)
+    for name in names[5:]:
+        order.remove(name)
+    assert order == tuple(names[:5]) and order.index(names[4]) == 4
+
+
+def test_step_order_scaling():
+    """Removing, finding, and inserting again does not touch every name."""
+    order = StepOrder(str(i) for i in range(50000))
+    start = time.time()
+    for i in range(2000):
+        name = str(i * 7)
+        order.remove(name)
+        assert order.index('49999') == 49998
+        order.insert(i, name)
+    assert time.time() - start < 2  # About 0.05s, a rebuild each time is 10s
+    assert order[1999] == str(1999 * 7) and len(order) == 50000
+
+
+def test_pipeline_position():
+    """Steps can be added at a position and old tuple orders still load."""
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    pip.add('ls', name='last')
+    pip.add('ls', name='first', position=0)
+    pip.add(str.upper, 'hi', name='middle', position=1)
+    assert [i.name for i in pip] == ['first', 'middle', 'last']
+    del pip['middle']
+    assert 'middle' not in pip and pip['middle'] is None
+    assert pip.order == ('first', 'last')
+    pip.order = tuple(pip.order)  # As saved by older versions
+    pip.save()
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    assert isinstance(pip.order, StepOrder)
+    assert pip.order.index('last') == 1
+    for file in (PIPELINE_FILE, PIPELINE_FILE + '.log'):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def test_state_counts():
+    """Counts and the current step follow every state change."""
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    for name in ('one', 'two', 'three'):
+        pip.add(str.upper, name, name=name)
+    assert pip.get_counts() == {'pending': 3, 'running': 0, 'done': 0,
+                                'failed': 0}
+    pip._get_current()
+    assert pip.current == 'one'
+    pip['one'].done = True
+    pip['two'].failed = True
+    assert pip.get_counts()['done'] == 1 and pip.get_counts()['failed'] == 1
+    pip._get_current()
+    assert pip.current == 'two'
+    pip['two'].failed = False
+    pip['two'].done   = True
+    pip._get_current()
+    assert pip.current == 'three'
+    pip['one'].done = False  # Moves the pointer back
+    pip._get_current()
+    assert pip.current == 'one'
+    del pip['one']
+    pip._get_current()
+    assert pip.current == 'three'
+    assert pip.get_counts() == {'pending': 1, 'running': 0, 'done': 1,
+                                'failed': 0}
+    pip.run_all()
+    assert pip.get_counts()['done'] == 2 and pip.current is None
+    pip.save()
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    assert pip['two'].state == 'done' and pip.get_counts()['done'] == 2
+    for file in (PIPELINE_FILE, PIPELINE_FILE + '.log'):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def test_lazy_pointer():
+    """Deletes, inserts, and state changes find the same first step."""
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    pip.save = lambda: None  # Only the order and states matter here
+    for i in range(40):
+        pip.add(str.upper, 'x', name=str(i))
+
+    def first():
+        """The first incomplete step, the slow way."""
+        for name in pip.order:
+            if not pip[name].done or pip[name].failed:
+                return name
+
+    for i in range(40):
+        name = str(i)
+        if i % 4 == 0:
+            pip.delete(name)
+        elif i % 4 == 1:
+            pip[name].done = True
+        elif i % 4 == 2:
+            pip.add(str.upper, 'x', name='new' + name, position=i // 2)
+            pip['new' + name].done = i % 8 == 2
+        if i % 3 == 0:
+            assert pip._first_incomplete() == first()
+        if i % 5 == 0:
+            pip[pip.order[i // 3]].done = False
+    assert pip._first_incomplete() == first()
+    while first():
+        pip[first()].done = True
+        if len(pip.order) % 2:
+            pip.delete(pip.order[-1])
+    assert pip._first_incomplete() is None
+    for file in (PIPELINE_FILE, PIPELINE_FILE + '.log'):
+        if os.path.exists(file):
+            os.remove(file)
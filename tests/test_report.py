@@ -0,0 +1,53 @@
+"""Test the streaming, filtered reports."""
+import os
+import io
+import pipeline as pl
+
+PIPELINE_FILE = 'report.test'
+FILES         = ['{}.reportfile'.format(i) for i in range(6)]
+
+
+def test_reports():
+    """Filters and pages apply to steps and substeps, output is streamed."""
+    for file in FILES:
+        open(file, 'w').close()
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    pip.add(str.upper, 'hi', name='upper')
+    pip.add(os.path.getsize, '<StepFile>', file_list=r'[0-9]\.reportfile',
+            name='sizes')
+    pip.add(str.lower, 'HI', name='lower')
+    pip.run_all()
+    substeps = pip['sizes'].steps
+    substeps[1].failed = True
+    substeps[4].failed = True
+    pip['lower'].failed = True
+
+    stats = pip.get_stats()
+    out   = io.StringIO()
+    pip.print_stats(out)
+    assert out.getvalue() == stats + '\n'
+    assert 'Output:\nHI' not in stats
+    assert 'Output:\nHI' in pip.get_stats(include_outputs=True)
+    assert str(pip) in stats
+
+    failed = pip.get_stats(failed=True)
+    assert 'Step:      upper' not in failed
+    assert 'Step:      sizes' in failed and 'Step:      lower' in failed
+    assert failed.count('\tStep:') == 2
+    assert 'Running' not in failed and '2      lower' in failed
+
+    page = pip.get_stats(pattern='^(upper|lower)$', limit=1)
+    assert 'Step:      upper' in page and 'Step:      lower' not in page
+    assert page.endswith('use offset=1 for the next page')
+    page = pip.get_stats(pattern='^(upper|lower)$', offset=1, limit=1)
+    assert 'Step:      lower' in page and 'next page' not in page
+    assert 'No matching steps' in pip.get_stats(pattern='nothing')
+
+    steps = pip['sizes'].get_steps(failed=True, limit=1)
+    assert steps.count('Step:') == 1 and 'offset=1' in steps
+    assert pip['sizes'].get_steps(failed=True, offset=1).count('Step:') == 1
+    assert pip['sizes'].get_steps(pattern='3').count('Step:') == 1
+    assert pip.get_stats(substep_limit=2).count('\tStep:') == 2
+    for file in FILES + [PIPELINE_FILE, PIPELINE_FILE + '.log']:
+        if os.path.exists(file):
+            os.remove(file)
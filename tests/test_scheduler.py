@@ -0,0 +1,76 @@
+"""Test the chunked dispatcher in scheduler.py."""
+import time
+from multiprocessing import Pool
+from pipeline.scheduler import Dispatcher, Retry
+
+
+def square(number):
+    """Return number squared, fail on negative numbers."""
+    if number < 0:
+        raise ValueError('negative')
+    return number * number
+
+
+def test_dispatcher_results():
+    """All tasks should be returned exactly once with the right result."""
+    pool = Pool(2)
+    dispatcher = Dispatcher(pool, 2)
+    tasks = [(i, i) for i in range(200)]
+    results = {}
+    chunks = 0
+    for chunk in dispatcher.run(square, tasks):
+        chunks += 1
+        for key, out in chunk:
+            assert key not in results
+            results[key] = out
+    pool.close()
+    pool.join()
+    assert results == dict((i, i * i) for i in range(200))
+    assert chunks < 200  # Fast tasks should have been grouped
+
+
+def test_dispatcher_exceptions():
+    """Exceptions are returned in place of the result."""
+    pool = Pool(2)
+    dispatcher = Dispatcher(pool, 2, chunksize=3)
+    results = dict(i for chunk in dispatcher.run(square, [(1, 1), (2, -2)])
+                   for i in chunk)
+    pool.close()
+    pool.join()
+    assert results[1] == 1
+    assert isinstance(results[2], ValueError)
+
+
+def test_dispatcher_defer():
+    """Deferred tasks run after their delay without blocking other tasks."""
+    pool = Pool(2)
+    dispatcher = Dispatcher(pool, 2)
+    start = time.time()
+    seen  = {}
+    for chunk in dispatcher.run(square, [(i, i) for i in range(4)]):
+        for key, out in chunk:
+            seen[key] = time.time() - start
+            if key == 0:
+                dispatcher.defer(('late', 5), 0.3)
+                dispatcher.add([('added', 6)])
+    pool.close()
+    pool.join()
+    assert sorted(seen, key=str) == [0, 1, 2, 3, 'added', 'late']
+    assert seen['late'] >= 0.3
+    assert seen['added'] < 0.3
+
+
+def test_retry():
+    """Only retry failures with matching codes, with growing waits."""
+    retry = Retry(tries=3, delay=10, backoff=2, max_delay=30, jitter=0)
+    assert retry.should_retry({'failed': True, 'code': 1}, 1)
+    assert not retry.should_retry({'failed': True, 'code': 1}, 3)
+    assert not retry.should_retry({'done': True, 'code': 0}, 1)
+    assert retry.should_retry(ValueError(), 2)
+    assert [retry.wait(i) for i in (1, 2, 3)] == [10, 20, 30]
+    retry = Retry(delay=10, jitter=0.5, codes=(75,))
+    assert retry.should_retry({'failed': True, 'code': 75}, 1)
+    assert not retry.should_retry({'failed': True, 'code': 1}, 1)
+    assert not retry.should_retry({'failed': True, 'EXCEPTION': OSError()},
+                                  1)
+    assert all(5 <= retry.wait(1) <= 15 for _ in range(100))
@@ -0,0 +1,77 @@
+"""Test the status summary and the status command."""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import pipeline as pl
+from pipeline import status
+
+PIPELINE_FILE = 'status.test'
+HERE          = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_status():
+    """The summary is current after every save and needs no step modules."""
+    # A step function whose module the status command cannot import
+    module = tempfile.mkdtemp()
+    with open(os.path.join(module, 'status_steps.py'), 'w') as fout:
+        fout.write('def fail():\n    raise ValueError("no")\n')
+    sys.path.insert(0, module)
+    import status_steps
+
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    assert not os.path.exists(PIPELINE_FILE + '.status.json')  # Opt-in
+    pip.enable_status()
+    pip.add(str.upper, 'hi', name='first')
+    pip.add(status_steps.fail, name='broken')
+    pip.add(str.lower, 'HI', name='last')
+    summary = status.read(PIPELINE_FILE)
+    assert summary['counts']['pending'] == 3
+    assert summary['current'] == 'first' and summary['steps'] == 3
+    try:
+        pip.run_all()
+    except Exception:
+        pass
+    summary = status.read(PIPELINE_FILE + '.status.json')
+    assert summary['counts']['done'] == 1 and summary['counts']['failed'] == 1
+    assert summary['current'] == 'broken' and summary['failed'] == ['broken']
+    assert 'Failed:    broken' in status.format_status(summary)
+
+    env = dict(os.environ, PYTHONPATH=HERE)
+    out = subprocess.check_output(
+        [sys.executable, '-m', 'pipeline', 'status', PIPELINE_FILE],
+        env=env, universal_newlines=True)
+    assert 'Steps:     3 (1 done, 0 running, 1 pending, 1 failed)' in out
+    assert 'Current:   broken' in out
+    out = subprocess.check_output(
+        [sys.executable, '-m', 'pipeline', 'status', '--json',
+         PIPELINE_FILE], env=env, universal_newlines=True)
+    assert json.loads(out)['failed_total'] == 1
+    code = subprocess.call(
+        [sys.executable, '-m', 'pipeline', 'status', 'missing.pickle'],
+        env=env, stderr=subprocess.DEVNULL)
+    assert code == 1
+
+    sys.path.remove(module)
+    shutil.rmtree(module)
+    for file in (PIPELINE_FILE, PIPELINE_FILE + '.log',
+                 PIPELINE_FILE + '.status.json'):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def test_light_import():
+    """Importing the package and the status module loads no machinery."""
+    heavy = ('pipeline.pl', 'multiprocessing', 'subprocess', 'pickle',
+             'logging', 'pstats', 'tracemalloc')
+    code  = ('import sys, pipeline, pipeline.status\n'
+             'print([i for i in {!r} if i in sys.modules])\n'
+             'print(pipeline.Pipeline.__name__, pipeline.pl.__name__)\n'
+             ).format(heavy)
+    out = subprocess.check_output(
+        [sys.executable, '-c', code], env=dict(os.environ, PYTHONPATH=HERE),
+        universal_newlines=True).split('\n')
+    assert out[0] == '[]'
+    assert out[1] == 'Pipeline pipeline.pl'
@@ -1,5 +1,6 @@
 """Test the functions in the tests.py file."""
 import os
+import pytest
 from pipeline import tests
 
 
@@ -54,3 +55,142 @@ def test_exists_dict():
     assert tests.exists(file_list) is True
     files = create_rm_files('delete', 'file')
     dirs = create_rm_files('delete', 'dir', 'iosjdf')
+
+
+def test_tail_match():
+    """Match strings and regexes at the end of plain and zipped files."""
+    import gzip
+    from pipeline.tests import BLOCK_SIZE
+    body = ('x' * 99 + '\n') * (3 * BLOCK_SIZE // 100)
+    with open('tailtest.log', 'w') as fout:
+        fout.write('started\n' + body + 'finished successfully\n')
+    with gzip.open('tailtest.log.gz', 'wt') as fout:
+        fout.write('started\n' + body + 'finished successfully\n')
+    files = ['tailtest.log', 'tailtest.log.gz']
+    assert tests.tail_match(files, 'finished successfully') is True
+    assert tests.tail_match(files, r'finished \w+ly', regex=True) is True
+    assert tests.tail_match('tailtest.log', 'started') is True
+    assert tests.tail_match(files, 'started', window=1024) is False
+    assert tests.tail_match(files, r'^started', regex=True,
+                            window=1024) is False
+    assert tests.tail_match(files + ['sdfjkl.log'], 'finished') is False
+    assert tests.tail_match('tailtest.log', r'^start\w+', regex=True,
+                            window=None) is True
+    assert tests.tail_match('tailtest.log', r'x{100}', regex=True,
+                            window=None) is False
+    os.remove('tailtest.log')
+    os.remove('tailtest.log.gz')
+
+
+@pytest.mark.parametrize('scandir', [True, False])
+def test_exists_many(scandir, monkeypatch):
+    """Check many files in several directories, with and without threads."""
+    if not scandir:  # Python < 3.5
+        monkeypatch.delattr(os, 'scandir')
+    files = []
+    for directory in ('exists_a', 'exists_b'):
+        os.mkdir(directory)
+        for i in range(20):
+            file = os.path.join(directory, 'file{}'.format(i))
+            open(file, 'w').close()
+            files.append(file)
+    os.symlink('file0', os.path.join('exists_a', 'link'))
+    os.symlink('nothere', os.path.join('exists_a', 'badlink'))
+    assert tests.exists(files) is True
+    assert tests.exists(files, 'file', threads=2) is True
+    assert tests.exists(files, 'directory') is False
+    assert tests.exists(files + [os.path.join('exists_a', 'link')]) is True
+    assert tests.exists(files + [os.path.join('exists_a', 'badlink')]) is False
+    assert tests.exists(files + [os.path.join('exists_c', 'file1')],
+                        threads=4) is False
+    assert tests.exists({'exists_a': 'directory', files[0]: 'file'}) is True
+    os.system('rm -rf exists_a exists_b')
+
+
+def test_checksum():
+    """Verify digests against a dict, a checksum file, and sidecar files."""
+    import hashlib
+    os.mkdir('hash_dir')
+    files = []
+    digests = {}
+    for i in range(5):
+        file = os.path.join('hash_dir', 'file{}'.format(i))
+        with open(file, 'w') as fout:
+            fout.write('contents {}\n'.format(i) * 1000)
+        files.append(file)
+        with open(file, 'rb') as fin:
+            digests[file] = hashlib.md5(fin.read()).hexdigest()
+        with open(file + '.md5', 'w') as fout:
+            fout.write('{}  {}\n'.format(digests[file], 'file{}'.format(i)))
+    with open(os.path.join('hash_dir', 'all.sha'), 'w') as fout:
+        for file in files:
+            fout.write('{}  {}\n'.format(digests[file],
+                                         os.path.basename(file)))
+    assert tests.hash_files(files) == digests
+    assert os.path.exists(os.path.join('hash_dir', tests.HASH_CACHE))
+    assert tests.checksum(files, digests) is True
+    assert tests.checksum(files, os.path.join('hash_dir', 'all.sha')) is True
+    assert tests.checksum(files) is True
+    # Truncate a file, the cache must not hide it
+    with open(files[2], 'w') as fout:
+        fout.write('contents 2\n')
+    assert tests.checksum(files) is False
+    assert tests.checksum(files + ['hash_dir/missing'], digests) is False
+    os.system('rm -rf hash_dir')
+
+
+def test_checksum_concurrent():
+    """Checksums run at once in one directory all end up in the cache."""
+    import json
+    import hashlib
+    from concurrent.futures import ThreadPoolExecutor
+    os.mkdir('hash_many')
+    files = [os.path.join('hash_many', 'file{}'.format(i))
+             for i in range(200)]
+    for file in files:
+        with open(file, 'w') as fout:
+            fout.write(file)
+    digests = dict((i, hashlib.md5(i.encode()).hexdigest()) for i in files)
+    with ThreadPoolExecutor(16) as executor:
+        assert all(executor.map(
+            lambda i: tests.checksum(i, {i: digests[i]}), files))
+    with open(os.path.join('hash_many', tests.HASH_CACHE)) as fin:
+        assert len(json.load(fin)) == 200
+    os.system('rm -rf hash_many')
+
+
+def test_compressed_ok():
+    """Detect truncated gzip, bz2, and BGZF files."""
+    import bz2
+    import gzip
+    data = os.urandom(200000)
+    with gzip.open('integrity.gz', 'wb') as fout:
+        fout.write(data)
+    with gzip.open('integrity.gz', 'ab') as fout:  # A second member
+        fout.write(data)
+    with bz2.BZ2File('integrity.bz2', 'wb') as fout:
+        fout.write(data)
+    with open('integrity.bam', 'wb') as fout:  # Smallest valid BGZF file
+        fout.write(tests.BGZF_EOF)
+    files = ['integrity.gz', 'integrity.bz2', 'integrity.bam']
+    assert tests.compressed_ok(files) is True
+    assert tests.compressed_ok(files, deep=True) is True
+    assert tests.bgzf_ok('integrity.bam', deep=True) is True
+    assert tests.bgzf_ok('integrity.gz') is False
+    for file in files:
+        size = os.path.getsize(file)
+        with open(file, 'rb+') as fout:
+            fout.truncate(size - 10)
+    assert tests.gzip_ok('integrity.gz', deep=True) is False
+    assert tests.gzip_ok('integrity.gz') is False
+    assert tests.compressed_ok('integrity.gz') is False
+    assert tests.bz2_ok('integrity.bz2') is False
+    assert tests.bgzf_ok('integrity.bam') is False
+    with gzip.open('truncated.gz', 'wb') as fout:
+        fout.write(b'\x00' * 10000000)  # ~10kb, compresses well
+    with open('truncated.gz', 'rb+') as fout:  # Lose the trailer
+        fout.truncate(os.path.getsize('truncated.gz') - 8)
+    assert tests.gzip_ok('truncated.gz') is False
+    assert tests.gzip_ok('truncated.gz', deep=False) is False
+    for file in files + ['truncated.gz']:
+        os.remove(file)
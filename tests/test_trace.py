@@ -0,0 +1,74 @@
+"""Test the Chrome trace export."""
+import os
+import json
+import pipeline as pl
+from pipeline import trace
+
+PIPELINE_FILE = 'trace.test'
+
+
+def span(name, start, end, worker=None):
+    """Return a minimal run span."""
+    return {'name': name, 'step': name, 'file': None, 'start': start,
+            'end': end, 'kind': 'run', 'state': 'done', 'code': 0,
+            'worker': worker}
+
+
+def test_assign_lanes():
+    """Spans without a worker reuse the lowest free lane."""
+    lanes = trace.assign_lanes([span('a', 0, 4), span('b', 0, 1),
+                                span('c', 1, 2), span('d', 3, 5),
+                                span('e', 4, 6)])
+    assert [[i['name'] for i in lane] for lane in lanes] == [
+        ['b', 'c', 'd'], ['a', 'e']]
+
+
+def test_assign_lanes_by_worker():
+    """A batch on one worker is one lane, busy time is counted once."""
+    spans = [span('a', 0, 2, 7), span('b', 0, 2, 7), span('c', 0, 2, 7),
+             span('d', 1, 3, 9), span('e', 2, 4, 7)]
+    lanes = trace.assign_lanes(spans)
+    assert [[i['name'] for i in lane] for lane in lanes] == [
+        ['a', 'b', 'c', 'e'], ['d']]
+    events = trace.trace_events(spans, lanes)
+    assert sorted(set(i['tid'] for i in events if i.get('cat') == 'run')) == [
+        7, 9]
+    assert not [i for i in events if i.get('cat') == 'idle']
+    summary = trace.summarize([], spans, lanes)
+    assert 'Lanes:       2' in summary
+    assert 'Busy:        6.000s' in summary
+
+
+def test_export_trace():
+    """Every run step gets a span, idle gaps and the summary are written."""
+    pip = pl.get_pipeline(PIPELINE_FILE)
+    pip.add(str.upper, 'hi', name='first')
+    pip.add(str.lower, 'HI', name='second', depends='first')
+    pip.add('ls', name='files', file_list=['tests', 'pipeline'])
+    pip.run_all()
+    pip['first'].start_time, pip['first'].end_time   = 10.0, 12.0
+    pip['second'].start_time, pip['second'].end_time = 13.0, 14.0
+    pip['files'].start_time, pip['files'].end_time   = 14.0, 16.0
+    pip['files'].steps[0].start_time = 14.0
+    pip['files'].steps[0].end_time   = 16.0
+    pip['files'].steps[1].start_time = 14.0
+    pip['files'].steps[1].end_time   = 15.0
+    for step in (pip['first'], pip['second'], pip['files'].steps[0]):
+        step.worker = 101
+    pip['files'].steps[1].worker = 102
+    summary = pip.export_trace('trace.json')
+    with open('trace.json') as fin:
+        events = json.load(fin)['traceEvents']
+    runs = dict((i['name'], i) for i in events if i.get('cat') == 'run')
+    assert sorted(runs) == ['first', 'pipeline', 'second', 'tests']
+    assert runs['first']['ts'] == 0 and runs['first']['dur'] == 2e6
+    idle = [i for i in events if i.get('cat') == 'idle']
+    assert [(i['tid'], i['ts'], i['dur']) for i in idle] == [(101, 2e6, 1e6)]
+    assert 'Lanes:       2' in summary
+    assert 'Utilisation: 50.0%' in summary
+    assert 'files: 2 substeps on 2 lanes, 2.000s wall, 75.0% busy' in summary
+    assert 'Critical path (3.000s): first -> second' in summary
+    os.remove('trace.json')
+    for file in (PIPELINE_FILE, PIPELINE_FILE + '.log'):
+        if os.path.exists(file):
+            os.remove(file)